@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Кэши листания каталога: страницы категорий, карточки товаров и названия категорий.
+
+Пока покупатель смотрит страницу N, страница N+1 (и её товары) грузится в фоне —
+«➡️» и тап по товару отвечают без похода в БД. Записи живут CATALOG_CACHE_TTL
+секунд: монитор может работать в другом процессе, и цена в листинге отстаёт
+от канала не больше чем на TTL. Корзина и оформление читают товар из БД сами.
+В одном процессе с монитором (scripts/run_all.py) записанный пост сбрасывает кэш сразу.
+"""
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Iterable
+
+log = logging.getLogger("catalog_cache")
+
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", "20") or "0")
+CATALOG_CACHE_SIZE = int(os.getenv("CATALOG_CACHE_SIZE", "2000") or "2000")
+
+
+class TTLCache:
+    """LRU на OrderedDict с временем жизни записи"""
+
+    def __init__(self, ttl: float = CATALOG_CACHE_TTL, maxsize: int = CATALOG_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Any | None:
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and entry[0] >= time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+PAGES = TTLCache()
+PRODUCTS = TTLCache()
+LABELS = TTLCache()
+
+_INFLIGHT: dict[tuple[int, Hashable], asyncio.Task] = {}
+_GENERATION = 0  # invalidate() сдвигает: подгрузка, начатая до сброса, в кэш не попадёт
+
+
+def _start(cache: TTLCache, key: Hashable, load: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+    slot = (id(cache), key)
+    task = _INFLIGHT[slot] = asyncio.create_task(load())
+    gen = _GENERATION
+
+    def _done(t: asyncio.Task) -> None:
+        _INFLIGHT.pop(slot, None)
+        if t.cancelled():
+            return
+        if t.exception() is not None:
+            log.warning("catalog load %s failed: %s", key, t.exception())
+        elif gen == _GENERATION:
+            cache.set(key, t.result())
+
+    task.add_done_callback(_done)
+    return task
+
+
+async def cached(cache: TTLCache, key: Hashable, load: Callable[[], Awaitable[Any]]) -> Any:
+    """Значение из кэша; иначе — load() (один на ключ, даже если фоновая подгрузка уже идёт)"""
+    value = cache.get(key)
+    if value is not None:
+        return value
+    task = _INFLIGHT.get((id(cache), key)) or _start(cache, key, load)
+    return await asyncio.shield(task)
+
+
+def prefetch(cache: TTLCache, key: Hashable, load: Callable[[], Awaitable[Any]]) -> None:
+    """Подгрузить в фоне, если ещё нет в кэше и не грузится; ошибка — только в лог"""
+    if key in cache or (id(cache), key) in _INFLIGHT:
+        return
+    _start(cache, key, load)
+
+
+def remember_products(items: Iterable[Any]) -> None:
+    for p in items:
+        PRODUCTS.set(p.id, p)
+
+
+def invalidate() -> None:
+    """Товары или категории поменялись: всё закэшированное — заново из БД"""
+    global _GENERATION
+    _GENERATION += 1
+    PAGES.clear()
+    PRODUCTS.clear()
+    LABELS.clear()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Категория мониторимого поста — одна для монитора канала и /rescan обоих ботов.
+
+Порядок: категория из monitored_posts, иначе — из карты кнопок меню канала
+(menu_buttons.json для розницы, wholesale_menu_buttons.json для опта: ссылка кнопки
+на пост -> путь «Раздел / Подраздел»), иначе DEFAULT_CATEGORY. Категория входит
+в версию текста поста (repo.post_text_hash) и в контекст строк, так что разные
+ответы для одного поста заставляли бы монитор и /rescan переписывать его товары друг за другом.
+"""
+import os
+import re
+import json
+from functools import lru_cache
+
+DEFAULT_CATEGORY = "Без категории"
+
+CHANNEL_ID_STORE = int(os.getenv("CHANNEL_ID_STORE", "0") or "0")
+CHANNEL_ID_OPT = int(os.getenv("CHANNEL_ID_OPT", "0") or "0")
+
+_MENU_FILES = {
+    CHANNEL_ID_STORE: "menu_buttons.json",          # retail
+    CHANNEL_ID_OPT: "wholesale_menu_buttons.json",  # wholesale
+}
+
+
+def _walk_buttons_to_map(obj, stack, acc):
+    if isinstance(obj, dict):
+        text = (obj.get("text") or obj.get("title") or "").strip()
+        link = obj.get("link") or obj.get("url") or ""
+        if text:
+            stack.append(text)
+        m = re.search(r'/c/-?\d+/(\d+)$', link) or re.search(r'/(\d+)$', link)
+        if m:
+            mid = int(m.group(1))
+            # category path: "Parent / Child / Leaf"
+            cat = " / ".join([s for s in stack if s])
+            acc[mid] = cat
+        for v in obj.values():
+            _walk_buttons_to_map(v, stack, acc)
+        if text:
+            stack.pop()
+    elif isinstance(obj, list):
+        for v in obj:
+            _walk_buttons_to_map(v, stack, acc)
+
+
+@lru_cache(maxsize=None)
+def menu_categories(json_path: str) -> dict[int, str]:
+    """message_id -> путь категории по кнопкам меню; файла нет или он битый — пустая карта"""
+    acc = {}
+    try:
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        _walk_buttons_to_map(data, [], acc)
+    except Exception:
+        pass
+    return acc
+
+
+def post_category(channel_id: int, message_id: int, category: str | None) -> str:
+    """category — значение monitored_posts.category (None/"" — не задана)"""
+    if category:
+        return category
+    path = _MENU_FILES.get(channel_id) if channel_id else None
+    return (menu_categories(path).get(message_id) if path else None) or DEFAULT_CATEGORY
@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
 import os
-from datetime import datetime, UTC
+import logging
+from datetime import date, datetime, UTC
 
 from dotenv import load_dotenv
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncAttrs
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 from sqlalchemy import (
-    String, Integer, BigInteger, Boolean, DateTime, Text, JSON,
-    UniqueConstraint, Index
+    String, Integer, BigInteger, Boolean, DateTime, Text, JSON, LargeBinary,
+    UniqueConstraint, Index, Identity, text
 )
 from sqlalchemy.dialects.postgresql import JSONB
 
@@ -21,7 +22,14 @@ if not DATABASE_URL:
 class Base(AsyncAttrs, DeclarativeBase):
     pass
 
-engine = create_async_engine(DATABASE_URL, echo=False, pool_pre_ping=True)
+# один движок на процесс; при общем запуске (scripts/run_all.py) пул делят оба бота и монитор
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5") or "5")
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10") or "10")
+
+engine = create_async_engine(
+    DATABASE_URL, echo=False, pool_pre_ping=True,
+    pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+)
 Session = async_sessionmaker(engine, expire_on_commit=False)
 
 # --- Models ---
@@ -34,6 +42,13 @@ class ChannelMessage(Base):
     title: Mapped[str | None] = mapped_column(String(400), default=None)
     text_len: Mapped[int | None] = mapped_column(Integer, default=None)
     edited_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    # хеши содержимого поста: сырой текст и разобранные строки (см. repo.upsert_post_text)
+    text_hash: Mapped[str | None] = mapped_column(String(64), default=None)
+    rows_hash: Mapped[str | None] = mapped_column(String(64), default=None)
+    # последний разобранный набор строк поста — по нему следующая правка пишет только дельту
+    rows_json: Mapped[dict | None] = mapped_column(JSONB, default=None)
+    # последний сырой текст поста (repo.pack_post_text): /rescan перечитывает посты из БД, а не через Telegram
+    raw_text: Mapped[bytes | None] = mapped_column(LargeBinary, default=None)
 
     __table_args__ = (
         UniqueConstraint("channel_id", "message_id", name="uq_channel_msg"),
@@ -74,9 +89,84 @@ class Product(Base):
     )
 
 
+class ProductPriceHistory(Base):
+    """
+    Журнал цен, только дописывается: строка на каждое реальное изменение цены товара
+    (появление, смена цены, возврат в наличие, снятие — price=NULL). Пишется в upsert_post_rows.
+    Секционирована по месяцам (RANGE по recorded_at, см. price_history_partitions_ddl):
+    запросы за период читают только свои секции, BRIN по времени почти ничего не весит.
+    """
+    __tablename__ = "product_price_history"
+
+    id: Mapped[int] = mapped_column(BigInteger, Identity(), primary_key=True)
+    # ключ секционирования обязан входить в первичный ключ
+    recorded_at: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+    product_id: Mapped[int | None] = mapped_column(Integer, default=None)
+    channel_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    key: Mapped[str] = mapped_column(String(400), nullable=False)
+    is_used: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+    price_type: Mapped[str] = mapped_column(String(16), nullable=False)  # 'retail' | 'wholesale'
+    old_price: Mapped[int | None] = mapped_column(BigInteger, default=None)
+    price: Mapped[int | None] = mapped_column(BigInteger, default=None)
+
+    __table_args__ = (
+        Index("ix_price_history_product", "channel_id", "key", "is_used", "recorded_at"),
+        Index("ix_price_history_recorded_brin", "recorded_at", postgresql_using="brin"),
+        {"postgresql_partition_by": "RANGE (recorded_at)"},
+    )
+
+
+PRICE_HISTORY_MONTHS_AHEAD = int(os.getenv("PRICE_HISTORY_MONTHS_AHEAD", "3") or "3")
+
+
+def _month_start(d: date, shift: int = 0) -> date:
+    m = d.month - 1 + shift
+    return date(d.year + m // 12, m % 12 + 1, 1)
+
+
+def price_history_partitions_ddl(today: date | None = None, months_ahead: int = PRICE_HISTORY_MONTHS_AHEAD) -> list[str]:
+    """Секции product_price_history: текущий месяц + months_ahead вперёд и DEFAULT на всё остальное"""
+    today = today or datetime.now(UTC).date()
+    ddl = [
+        "CREATE TABLE IF NOT EXISTS product_price_history_default "
+        "PARTITION OF product_price_history DEFAULT"
+    ]
+    for shift in range(months_ahead + 1):
+        lo, hi = _month_start(today, shift), _month_start(today, shift + 1)
+        ddl.append(
+            f"CREATE TABLE IF NOT EXISTS product_price_history_{lo:%Y_%m} "
+            f"PARTITION OF product_price_history FOR VALUES FROM ('{lo}') TO ('{hi}')"
+        )
+    return ddl
+
+
+# create_all не трогает существующие таблицы — новые колонки докатываем сами
+SCHEMA_PATCHES = [
+    "ALTER TABLE channel_messages ADD COLUMN IF NOT EXISTS text_hash VARCHAR(64)",
+    "ALTER TABLE channel_messages ADD COLUMN IF NOT EXISTS rows_hash VARCHAR(64)",
+    "ALTER TABLE channel_messages ADD COLUMN IF NOT EXISTS rows_json JSONB",
+    "ALTER TABLE channel_messages ADD COLUMN IF NOT EXISTS raw_text BYTEA",
+]
+
+
 async def init_models():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        for stmt in SCHEMA_PATCHES:
+            await conn.execute(text(stmt))
+    await ensure_price_history_partitions()
+
+
+async def ensure_price_history_partitions() -> None:
+    """Докатить секции журнала цен вперёд; долго работающий процесс зовёт это периодически"""
+    async with engine.begin() as conn:
+        for stmt in price_history_partitions_ddl():
+            try:
+                async with conn.begin_nested():
+                    await conn.execute(text(stmt))
+            except Exception as e:
+                # строки этого месяца уже легли в DEFAULT-секцию — месяц остаётся в ней
+                logging.getLogger("db").warning("price history partition skipped: %s", e)
 
 
 class MonitoredPost(Base):
@@ -170,6 +260,69 @@ class Cart(Base):
         self.items_json = {'items': value}
 
 
+class ProductSubscription(Base):
+    """Подписка покупателя на товар («🔔 Следить»): снижение цены и возврат в наличие"""
+    __tablename__ = "product_subscriptions"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, nullable=False, index=True)
+    channel_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    # подписка хранится по ключу товара, а не по id: ключ переживает пересоздание строки
+    key: Mapped[str] = mapped_column(String(400), nullable=False)
+    is_used: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=lambda: datetime.now(UTC).replace(tzinfo=None))
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "channel_id", "key", "is_used", name="uq_product_subscription"),
+        Index("ix_product_subscriptions_key", "channel_id", "key", "is_used"),
+    )
+
+
+class RescanRun(Base):
+    """Запуск /rescan по каналу: прерванный (running) или с ошибками (partial) продолжается со своего чекпоинта"""
+    __tablename__ = "rescan_runs"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    channel_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    full: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+    status: Mapped[str] = mapped_column(String(16), nullable=False, default="running")  # running / done / partial / aborted
+    total: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    ok: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    unchanged: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    fail: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    started_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=lambda: datetime.now(UTC).replace(tzinfo=None))
+    finished_at: Mapped[datetime | None] = mapped_column(DateTime, default=None)
+
+    __table_args__ = (
+        Index("ix_rescan_runs_channel", "channel_id", "status"),
+    )
+
+
+class RescanCheckpoint(Base):
+    """Обработанный пост в запуске /rescan: ok — текст записан, unchanged — не менялся, fail — ошибка"""
+    __tablename__ = "rescan_checkpoints"
+
+    run_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    message_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    status: Mapped[str] = mapped_column(String(8), nullable=False)  # ok / fail
+    error: Mapped[str | None] = mapped_column(Text, default=None)
+    processed_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=lambda: datetime.now(UTC).replace(tzinfo=None))
+
+
+class FsmState(Base):
+    """Состояние диалога aiogram (FSM) — общее для всех реплик бота; строки с истёкшим expires_at не читаются"""
+    __tablename__ = "fsm_states"
+
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)  # bot:chat:user:thread:destiny
+    state: Mapped[str | None] = mapped_column(String(255), default=None)
+    data: Mapped[dict] = mapped_column(JSONB, nullable=False, default=dict)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_fsm_states_expires", "expires_at"),
+    )
+
+
 class UserConsent(Base):
     """Таблица для хранения согласий пользователей на обработку ПД"""
     __tablename__ = "user_consents"
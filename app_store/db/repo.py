@@ -1,8 +1,87 @@
+import os
+import json
+import zlib
+import hashlib
+from dataclasses import dataclass, field
 from datetime import datetime, UTC
-from typing import Iterable
-from sqlalchemy import select, update
+from typing import Callable, Iterable, NamedTuple
+from sqlalchemy import select, update, func, and_, or_, not_, null, literal_column
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from .core import ChannelMessage, Product, Order
+from .core import ChannelMessage, Product, Order, ProductPriceHistory
+from ..parsing.price_parser import PriceRow, norm_key, parse_used_attrs
+
+
+class PriceChange(NamedTuple):
+    product_id: int | None
+    key: str
+    name: str              # название вместе с флагом — как показываем покупателю
+    old_price: int | None
+    new_price: int | None
+
+
+@dataclass
+class PostDiff:
+    """
+    Изменения товаров одного поста относительно предыдущего состояния.
+    Собирается прямо из upsert-а поста, без отдельных сканов таблицы.
+    """
+    channel_id: int
+    message_id: int
+    is_used: bool
+    changed: list[PriceChange] = field(default_factory=list)    # цена изменилась
+    restocked: list[PriceChange] = field(default_factory=list)  # было available=False, стало True
+    removed: list[str] = field(default_factory=list)            # ключи, снятые с наличия
+    added: list[str] = field(default_factory=list)              # новые ключи (строк в products ещё не было)
+    # эффективность записи: сколько строк products отправлено в upsert/UPDATE и сколько реально переписано
+    rows_sent: int = 0
+    rows_written: int = 0
+
+    @property
+    def price_drops(self) -> list[PriceChange]:
+        return [c for c in self.changed if c.old_price and c.new_price and c.new_price < c.old_price]
+
+    def __bool__(self) -> bool:
+        return bool(self.changed or self.restocked or self.removed or self.added)
+
+
+class ProductRow(NamedTuple):
+    """Строка прайса, готовая к записи: ключ уже нормализован, атрибуты посчитаны"""
+    key: str
+    name: str
+    price: int
+    flag: str
+    extra_attrs: dict | None
+
+
+def product_rows(rows: Iterable[PriceRow], *, is_used: bool) -> list[ProductRow]:
+    """Строки из parse_rows -> строки для upsert_post_rows (ключ и extra_attrs)"""
+    out = []
+    for name, price, flag in rows:
+        attrs = {
+            **(parse_used_attrs(name) if is_used else {}),
+            **({"flag": flag} if flag else {})
+        }
+        out.append(ProductRow(norm_key(name, flag), name, price, flag, attrs or None))
+    return out
+
+
+# строк в одном INSERT: ~11 параметров на строку, держимся далеко от лимита asyncpg (32767)
+UPSERT_CHUNK = 1000
+
+# extra_attrs дополняется, а не затирается; пустой результат -> NULL.
+# JSON-колонка может хранить 'null' — такие значения считаем пустым объектом.
+_MERGED_EXTRA_ATTRS_SQL = (
+    "NULLIF("
+    "(CASE WHEN jsonb_typeof(products.extra_attrs::jsonb) = 'object' "
+    "THEN products.extra_attrs::jsonb ELSE '{}'::jsonb END) || "
+    "(CASE WHEN jsonb_typeof(excluded.extra_attrs::jsonb) = 'object' "
+    "THEN excluded.extra_attrs::jsonb ELSE '{}'::jsonb END), "
+    "'{}'::jsonb)"
+)
+_MERGED_EXTRA_ATTRS = literal_column(f"{_MERGED_EXTRA_ATTRS_SQL}::json")
+# у json нет оператора равенства — сравниваем как jsonb
+_EXTRA_ATTRS_CHANGED = literal_column(f"products.extra_attrs::jsonb IS DISTINCT FROM {_MERGED_EXTRA_ATTRS_SQL}")
 
 async def save_channel_message(
     s: AsyncSession,
@@ -11,6 +90,9 @@ async def save_channel_message(
     message_id: int,
     title: str | None,
     text_len: int,
+    text_hash: str | None = None,
+    rows_hash: str | None = None,
+    raw_text: bytes | None = None,
 ) -> None:
     # upsert по (channel_id, message_id)
     row = (await s.execute(
@@ -22,85 +104,408 @@ async def save_channel_message(
 
     now = datetime.now(UTC).replace(tzinfo=None)
     if row is None:
-        s.add(ChannelMessage(
+        row = ChannelMessage(
             channel_id=channel_id,
             message_id=message_id,
             title=title,
             text_len=text_len,
             edited_at=now
-        ))
+        )
+        s.add(row)
     else:
-        row.title = title
+        if title is not None:
+            row.title = title
         row.text_len = text_len
         row.edited_at = now
+    if text_hash is not None:
+        row.text_hash = text_hash
+    if rows_hash is not None:
+        row.rows_hash = rows_hash
+    if raw_text is not None:
+        row.raw_text = raw_text
+
+# --- состояние постов: хеши содержимого и последний разобранный набор строк ---
+class PostState(NamedTuple):
+    text_hash: str | None
+    rows_hash: str | None
+    has_text: bool = False  # сырой текст поста сохранён в channel_messages.raw_text
+
+
+
+def _post_ctx(*, is_used: bool, category: str | None, price_field: str) -> list:
+    return [price_field, bool(is_used), category or ""]
+
+
+def _row_state(r: ProductRow) -> list:
+    # то, что пишется в products из строки прайса; формат переживает JSON туда-обратно
+    return [r.name[:400], r.price, r.flag, r.extra_attrs]
+
+
+def post_text_hash(text: str, *, is_used: bool, category: str | None, price_field: str) -> str:
+    """Хеш сырого текста вместе со всем, что кроме текста влияет на запись товаров"""
+    h = hashlib.sha256(f"{price_field}|{int(is_used)}|{category or ''}\n".encode())
+    h.update((text or "").encode())
+    return h.hexdigest()
 
-async def upsert_products_from_group(
+
+def post_rows_hash(rows: Iterable[ProductRow], *, is_used: bool, category: str | None, price_field: str) -> str:
+    """Хеш нормализованных строк прайса: правка эмодзи в шапке поста его не меняет"""
+    h = hashlib.sha256(f"{price_field}|{int(is_used)}|{category or ''}\n".encode())
+    for r in rows:
+        h.update(json.dumps([r.key, *_row_state(r)], ensure_ascii=False, sort_keys=True).encode())
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+# --- сырой текст поста ---
+POST_TEXT_COMPRESS = os.getenv("POST_TEXT_COMPRESS", "1").lower() in ("1", "true", "yes")
+_TEXT_PLAIN, _TEXT_ZLIB = b"t", b"z"
+
+
+def pack_post_text(text: str | None) -> bytes:
+    """Текст поста для channel_messages.raw_text: zlib (POST_TEXT_COMPRESS) или как есть, с байтом-меткой"""
+    data = (text or "").encode("utf-8")
+    if POST_TEXT_COMPRESS:
+        return _TEXT_ZLIB + zlib.compress(data, 6)
+    return _TEXT_PLAIN + data
+
+
+def unpack_post_text(raw: bytes | None) -> str | None:
+    if raw is None:
+        return None
+    raw = bytes(raw)
+    if raw[:1] == _TEXT_ZLIB:
+        return zlib.decompress(raw[1:]).decode("utf-8")
+    return raw[1:].decode("utf-8")
+
+
+async def get_post_texts(s: AsyncSession, channel_id: int, message_ids: Iterable[int]) -> dict[int, str]:
+    """Сохранённые тексты постов канала: message_id -> текст (посты без текста в ответ не попадают)"""
+    rows = (await s.execute(
+        select(ChannelMessage.message_id, ChannelMessage.raw_text).where(
+            ChannelMessage.channel_id == channel_id,
+            ChannelMessage.message_id.in_(list(message_ids)),
+            ChannelMessage.raw_text.isnot(None),
+        )
+    )).all()
+    return {mid: unpack_post_text(raw) for mid, raw in rows}
+
+
+async def get_post_state(s: AsyncSession, channel_id: int, message_id: int) -> PostState:
+    """
+    Хеши поста из channel_messages; строка блокируется (FOR UPDATE) до конца транзакции.
+    Пост пишут монитор и /rescan ботов из разных процессов — «не изменилось» решаем
+    по тому, что лежит в БД, а не по памяти своего процесса.
+    """
+    row = (await s.execute(
+        select(
+            ChannelMessage.text_hash, ChannelMessage.rows_hash, ChannelMessage.raw_text.isnot(None),
+        ).where(
+            ChannelMessage.channel_id == channel_id,
+            ChannelMessage.message_id == message_id
+        ).with_for_update()
+    )).first()
+    return PostState(*row) if row else PostState(None, None, False)
+
+
+async def get_post_rows(s: AsyncSession, channel_id: int, message_id: int) -> dict | None:
+    """
+    Прошлый набор строк поста (channel_messages.rows_json) — база для записи только изменившихся строк:
+    {"ctx": [price_field, is_used, category], "rows": {key: [name, price, flag, extra_attrs]}}.
+    Читается после get_post_state в той же транзакции — строка уже заблокирована.
+    """
+    return (await s.execute(
+        select(ChannelMessage.rows_json).where(
+            ChannelMessage.channel_id == channel_id,
+            ChannelMessage.message_id == message_id
+        )
+    )).scalar_one_or_none()
+
+
+async def upsert_post_text(
     s: AsyncSession,
     *,
     channel_id: int,
-    group_message_id: int,
-    items: Iterable[tuple[str, int]],
-    price_type: str = "retail",  # "retail" or "wholesale"
+    message_id: int,
+    is_used: bool,
+    text: str,
+    parse: Callable[[str], list[ProductRow]],
+    price_field: str,
     category: str | None = None,
-) -> None:
+    title: str | None = None,
+    force: bool = False,
+) -> PostDiff | None:
     """
-    items: итератор кортежей (name, price).
-    Объединяем товары по всему каналу по ключу, обновляем соответствующие цены.
-    price_type: "retail" или "wholesale" - какой тип цены обновляем
+    Записать пост с проверкой хешей содержимого:
+      - текст (с категорией/Б/У/типом цены) не изменился — ничего не делаем
+        (разве что сохраняем сам текст, если его ещё нет в channel_messages);
+      - текст изменился, а разобранные строки нет — обновляем только хеши и текст в channel_messages;
+      - иначе — upsert_post_rows, причём только по изменившимся строкам,
+        если прошлый набор строк поста сохранён для той же категории/Б/У/типа цены.
+    Возвращает None, если товары не трогали. force=True — полная запись всех строк.
+    Коммит — на вызывающей стороне.
     """
-    # Соберём входные ключи
-    normalized = []
-    keys_new = set()
-    for name, price in items:
-        key = normalize_key(name)
-        normalized.append((name.strip(), key, int(price)))
-        keys_new.add(key)
-
-    # Прочитаем ВСЕ товары в канале (не только в группе)
-    existing = (await s.execute(
-        select(Product).where(
-            Product.channel_id == channel_id
+    ctx = dict(is_used=is_used, category=category, price_field=price_field)
+    th = post_text_hash(text, **ctx)
+    state = await get_post_state(s, channel_id, message_id)
+    if force:
+        state = PostState(None, None)
+    raw_text = pack_post_text(text)
+    if state.text_hash == th:
+        if not state.has_text:
+            await save_channel_message(
+                s, channel_id=channel_id, message_id=message_id, title=title,
+                text_len=len(text or ""), text_hash=th, raw_text=raw_text,
+            )
+        return None
+
+    rows = parse(text)
+    rh = post_rows_hash(rows, **ctx)
+    if state.rows_hash == rh:
+        await save_channel_message(
+            s, channel_id=channel_id, message_id=message_id, title=title,
+            text_len=len(text or ""), text_hash=th, rows_hash=rh, raw_text=raw_text,
         )
-    )).scalars().all()
+        return None
+
+    prev_rows = None
+    if not force and state.rows_hash is not None:
+        prev_doc = await get_post_rows(s, channel_id, message_id)
+        if prev_doc and prev_doc.get("ctx") == _post_ctx(**ctx):
+            prev_rows = prev_doc.get("rows")
 
-    existing_by_key = {p.key: p for p in existing}
+    return await upsert_post_rows(
+        s,
+        channel_id=channel_id,
+        message_id=message_id,
+        is_used=is_used,
+        rows=rows,
+        price_field=price_field,
+        category=category,
+        title=title,
+        text_len=len(text or ""),
+        text_hash=th,
+        rows_hash=rh,
+        raw_text=raw_text,
+        prev_rows=prev_rows,
+    )
 
-    # upsert / reactivate
+async def upsert_post_rows(
+    s: AsyncSession,
+    *,
+    channel_id: int,
+    message_id: int,
+    is_used: bool,
+    rows: Iterable[ProductRow],
+    price_field: str,  # "price_retail" или "price_wholesale"
+    category: str | None = None,
+    title: str | None = None,
+    text_len: int | None = None,
+    text_hash: str | None = None,
+    rows_hash: str | None = None,
+    raw_text: bytes | None = None,
+    prev_rows: dict | None = None,
+) -> PostDiff:
+    """
+    Записать товары одного поста набором, а не построчно:
+      1) одна выборка затрагиваемых строк поста (+ upsert ChannelMessage в том же запросе, если передан text_len);
+      2) один многострочный INSERT ... ON CONFLICT ON CONSTRAINT uq_prod_key_in_group DO UPDATE;
+      3) один UPDATE для ключей, пропавших из поста.
+    prev_rows — прошлый набор строк поста (rows_json["rows"]): если он есть, пишутся только
+    добавленные/изменённые/пропавшие ключи, иначе — все строки поста.
+    Коммит — на вызывающей стороне. Возвращает диф поста.
+    """
     now = datetime.now(UTC).replace(tzinfo=None)
-    for name, key, price in normalized:
-        if key in existing_by_key:
-            # Товар уже существует - обновляем только нужную цену
-            p = existing_by_key[key]
-            p.name = name  # Обновляем название на случай изменений
-            if price_type == "retail":
-                p.price_retail = price
-            else:  # wholesale
-                p.price_wholesale = price
-            if category:
-                p.category = category
-            p.available = True
-            p.updated_at = now
+    diff = PostDiff(channel_id=channel_id, message_id=message_id, is_used=is_used)
+
+    # один ключ — одна строка (как и раньше, побеждает последняя в посте)
+    by_key: dict[str, ProductRow] = {}
+    for r in rows:
+        by_key[r.key] = r
+    snapshot = {key: _row_state(r) for key, r in by_key.items()}
+
+    if prev_rows is None:
+        touched = list(by_key)
+        gone_filter = not_(Product.key.in_(touched))
+    else:
+        touched = [key for key, st in snapshot.items() if prev_rows.get(key) != st]
+        gone_keys = [key for key in prev_rows if key not in snapshot]
+        gone_filter = Product.key.in_(gone_keys) if gone_keys else None
+
+    cm_cte = None
+    if text_len is not None:
+        # пустой разбор не затирает прошлый набор строк: по нему считается следующий диф
+        rows_json = {"ctx": _post_ctx(is_used=is_used, category=category, price_field=price_field),
+                     "rows": snapshot} if by_key else None
+        cm_stmt = pg_insert(ChannelMessage).values(
+            channel_id=channel_id,
+            message_id=message_id,
+            title=title,
+            text_len=text_len,
+            text_hash=text_hash,
+            rows_hash=rows_hash,
+            rows_json=rows_json if rows_json is not None else null(),
+            raw_text=raw_text,
+            edited_at=now,
+        )
+        cm_cte = cm_stmt.on_conflict_do_update(
+            constraint="uq_channel_msg",
+            set_={
+                # /rescan заголовок канала не знает — не затираем
+                "title": func.coalesce(cm_stmt.excluded.title, ChannelMessage.title),
+                "text_len": cm_stmt.excluded.text_len,
+                "text_hash": cm_stmt.excluded.text_hash,
+                "rows_hash": cm_stmt.excluded.rows_hash,
+                "rows_json": func.coalesce(cm_stmt.excluded.rows_json, ChannelMessage.rows_json),
+                "raw_text": func.coalesce(cm_stmt.excluded.raw_text, ChannelMessage.raw_text),
+                "edited_at": cm_stmt.excluded.edited_at,
+            },
+        ).returning(ChannelMessage.id).cte("cm_upsert")
+
+    if not by_key or not (touched or gone_filter is not None):
+        if cm_cte is not None:
+            await s.execute(select(literal_column("1")).add_cte(cm_cte))
+        return diff
+
+    price_col = getattr(Product, price_field)
+    existing = {}
+    if touched:
+        existing_q = select(Product.id, Product.key, Product.available, price_col).where(
+            Product.channel_id == channel_id,
+            Product.group_message_id == message_id,
+            Product.is_used == is_used,
+        )
+        if prev_rows is not None:
+            existing_q = existing_q.where(Product.key.in_(touched))
+        if cm_cte is not None:
+            existing_q = existing_q.add_cte(cm_cte)
+            cm_cte = None
+        existing = {key: (pid, available, old) for pid, key, available, old in (await s.execute(existing_q)).all()}
+    elif cm_cte is not None:
+        await s.execute(select(literal_column("1")).add_cte(cm_cte))
+
+    values = []
+    # журнал цен: key -> (product_id, old_price, price); id новых товаров придёт из RETURNING
+    history: dict[str, list] = {}
+    for key in touched:
+        r = by_key[key]
+        cur = existing.get(key)
+        if cur is None:
+            diff.added.append(key)
+            history[key] = [None, None, r.price]
         else:
-            # Создаем новый товар
-            product_data = {
-                "group_message_id": group_message_id,
-                "channel_id": channel_id,
-                "name": name,
-                "key": key,
+            pid, available, old_price = cur
+            if not available:
+                diff.restocked.append(PriceChange(pid, key, f"{r.name}{r.flag}", old_price, r.price))
+            elif old_price != r.price:
+                diff.changed.append(PriceChange(pid, key, f"{r.name}{r.flag}", old_price, r.price))
+            if not available or old_price != r.price:
+                history[key] = [pid, old_price if available else None, r.price]
+        values.append({
+            "channel_id": channel_id,
+            "group_message_id": message_id,
+            "key": key,
+            "name": r.name[:400],
+            "category": category or None,
+            "requires_serial": False,
+            "available": True,
+            "is_used": is_used,
+            "extra_attrs": r.extra_attrs if r.extra_attrs else null(),
+            "updated_at": now,
+            price_field: r.price,
+        })
+
+    for i in range(0, len(values), UPSERT_CHUNK):
+        stmt = pg_insert(Product).values(values[i:i + UPSERT_CHUNK])
+        ex = stmt.excluded
+        upserted = await s.execute(stmt.on_conflict_do_update(
+            constraint="uq_prod_key_in_group",
+            set_={
+                "name": ex.name,
+                price_field: getattr(ex, price_field),
                 "available": True,
-                "updated_at": now
-            }
-            if price_type == "retail":
-                product_data["price_retail"] = price
-                product_data["price_wholesale"] = None
-            else:  # wholesale
-                product_data["price_wholesale"] = price
-                product_data["price_retail"] = None
-            if category:
-                product_data["category"] = category
-            s.add(Product(**product_data))
-
-    # НЕ деактивируем товары, так как они могут быть в других сообщениях
+                # категорию поста не затираем пустой
+                "category": func.coalesce(ex.category, Product.category),
+                "extra_attrs": _MERGED_EXTRA_ATTRS,
+                "updated_at": ex.updated_at,
+            },
+            # строка без изменений не переписывается (новая версия кортежа = bloat и WAL);
+            # такие строки не попадают и в RETURNING
+            where=or_(
+                Product.name.is_distinct_from(ex.name),
+                price_col.is_distinct_from(getattr(ex, price_field)),
+                Product.available.is_distinct_from(True),
+                Product.category.is_distinct_from(func.coalesce(ex.category, Product.category)),
+                _EXTRA_ATTRS_CHANGED,
+            ),
+        ).returning(Product.id, Product.key))
+        returned = upserted.all()
+        diff.rows_written += len(returned)
+        for pid, key in returned:
+            if key in history and history[key][0] is None:
+                history[key][0] = pid
+    diff.rows_sent += len(values)
+
+    # кого нет в посте — снимаем с наличия и чистим цену этого типа и этого is_used
+    if gone_filter is not None:
+        # цена до обновления: RETURNING отдаёт уже новые значения строки
+        # уже снятые строки без цены не трогаем — повторный UPDATE дал бы лишь новую версию кортежа
+        prev = select(Product.id, price_col.label("old_price")).where(
+            and_(
+                Product.channel_id == channel_id,
+                Product.group_message_id == message_id,
+                Product.is_used == is_used,
+                gone_filter,
+                or_(Product.available.is_distinct_from(False), price_col.isnot(None)),
+            )
+        ).subquery("prev")
+        gone = await s.execute(
+            update(Product)
+            .where(Product.id == prev.c.id)
+            .values(available=False, updated_at=now, **{price_field: None})
+            .returning(Product.key, Product.id, prev.c.old_price)
+        )
+        for key, pid, old_price in gone.all():
+            diff.removed.append(key)
+            diff.rows_sent += 1
+            diff.rows_written += 1
+            if old_price is not None:
+                history[key] = [pid, old_price, None]
+
+    await record_price_history(
+        s, channel_id=channel_id, is_used=is_used, price_field=price_field, history=history, now=now,
+    )
+    return diff
+
+
+async def record_price_history(
+    s: AsyncSession,
+    *,
+    channel_id: int,
+    is_used: bool,
+    price_field: str,
+    history: dict[str, list],
+    now: datetime,
+) -> None:
+    """Дописать в product_price_history изменения цен поста: key -> (product_id, old_price, price)"""
+    if not history:
+        return
+    price_type = "wholesale" if price_field == "price_wholesale" else "retail"
+    rows = [
+        {
+            "recorded_at": now,
+            "product_id": pid,
+            "channel_id": channel_id,
+            "key": key,
+            "is_used": is_used,
+            "price_type": price_type,
+            "old_price": old_price,
+            "price": price,
+        }
+        for key, (pid, old_price, price) in history.items()
+    ]
+    for i in range(0, len(rows), UPSERT_CHUNK):
+        await s.execute(pg_insert(ProductPriceHistory).values(rows[i:i + UPSERT_CHUNK]))
 
 async def get_categories(s: AsyncSession, channel_id: int, price_type: str = "retail") -> list[str]:
     """Получить список всех категорий товаров для канала + типа цены"""
@@ -187,17 +592,9 @@ async def get_pending_orders(s: AsyncSession) -> list[Order]:
     )
     return list(result.scalars())
 
-def normalize_key(name: str) -> str:
-    import re
-    s = (name or "").lower()
-    s = re.sub(r"\s+", " ", s)
-    # убираем всё, кроме букв/цифр/пробела и базовых разделителей
-    s = re.sub(r"[^\w\s/\-\+\.]", "", s, flags=re.UNICODE)
-    return s.strip()
-
 
 # === NEW: выборка категорий строго из monitored_posts (по порядку message_id) ===
-from sqlalchemy import select, and_
+from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 async def get_categories(s: AsyncSession, *, channel_id: int, price_type: str='wholesale') -> list[str]:
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Живой список мониторимых постов (monitored_posts) для монитора канала.
+
+Снимок хранится в памяти и подменяется целиком одной операцией присваивания,
+так что проверка «пост под наблюдением?» — это поиск в frozenset, а категория
+и признак Б/У поста берутся из словаря — без запросов к БД на каждый апдейт.
+Обновление:
+  - LISTEN monitored_posts_changed: триггер на monitored_posts шлёт NOTIFY на любую запись,
+    кто бы её ни сделал (оптовый/розничный бот, ручной SQL);
+  - раз в WATCH_POLL_SEC — дешёвая сверка отпечатка (md5 по постам каналов)
+    на случай потери соединения LISTEN или отсутствия прав на триггер.
+"""
+import os
+import asyncio
+import logging
+from typing import Iterable, NamedTuple
+
+from sqlalchemy import select, func, literal, Text
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from .core import engine, Session, MonitoredPost
+
+log = logging.getLogger("watch")
+
+WATCH_NOTIFY_CHANNEL = "monitored_posts_changed"
+WATCH_POLL_SEC = float(os.getenv("WATCH_POLL_SEC", "60") or "60")
+
+# exec_driver_sql: тело функции не должно проходить через разбор :bind-параметров
+_TRIGGER_DDL = [
+    f"""
+    CREATE OR REPLACE FUNCTION notify_monitored_posts_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{WATCH_NOTIFY_CHANNEL}', TG_OP);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS trg_monitored_posts_changed ON monitored_posts",
+    """
+    CREATE TRIGGER trg_monitored_posts_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON monitored_posts
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_monitored_posts_changed()
+    """,
+]
+
+
+async def install_notify_trigger() -> bool:
+    try:
+        async with engine.begin() as conn:
+            for ddl in _TRIGGER_DDL:
+                await conn.exec_driver_sql(ddl)
+        return True
+    except Exception as e:
+        log.warning("⚠️ Не удалось создать триггер NOTIFY на monitored_posts (%s) — остаётся опрос", e)
+        return False
+
+
+class PostMeta(NamedTuple):
+    category: str | None
+    is_used: bool
+    active: bool
+
+
+class WatchRegistry:
+    def __init__(self, channel_ids: Iterable[int], *, poll_interval: float = WATCH_POLL_SEC):
+        self.channel_ids = [cid for cid in channel_ids if cid]
+        self.poll_interval = poll_interval
+        # channel_id -> frozenset(message_id); подменяется целиком, не мутируется
+        self._posts: dict[int, frozenset[int]] = {}
+        # (channel_id, message_id) -> PostMeta, включая неактивные посты; подменяется вместе с _posts
+        self._meta: dict[tuple[int, int], PostMeta] = {}
+        self._fingerprint: tuple | None = None
+        self._dirty = asyncio.Event()
+        self._listen_conn = None
+        self._tasks: list[asyncio.Task] = []
+
+    # --- чтение (горячий путь) ---
+    def is_watched(self, channel_id: int, message_id: int) -> bool:
+        ids = self._posts.get(channel_id)
+        return ids is not None and message_id in ids
+
+    def meta(self, channel_id: int, message_id: int) -> PostMeta | None:
+        return self._meta.get((channel_id, message_id))
+
+    def snapshot(self) -> dict[int, frozenset[int]]:
+        return self._posts
+
+    def __bool__(self) -> bool:
+        return any(self._posts.values())
+
+    # --- загрузка ---
+    def _fingerprint_query(self):
+        return select(
+            func.count(),
+            func.md5(func.coalesce(func.string_agg(
+                MonitoredPost.channel_id.cast(Text) + "/" + MonitoredPost.message_id.cast(Text)
+                + "/" + MonitoredPost.is_active.cast(Text) + "/" + MonitoredPost.is_used.cast(Text)
+                + "/" + func.coalesce(MonitoredPost.category, ""),
+                aggregate_order_by(literal(","), MonitoredPost.channel_id, MonitoredPost.message_id),
+            ), "")),
+        ).select_from(MonitoredPost).where(
+            MonitoredPost.channel_id.in_(self.channel_ids),
+        )
+
+    async def reload(self) -> bool:
+        """Перечитать посты и подменить снимок. True — если что-то изменилось."""
+        async with Session() as s:
+            fp = tuple((await s.execute(self._fingerprint_query())).one())
+            if fp == self._fingerprint:
+                return False
+            rows = (await s.execute(
+                select(
+                    MonitoredPost.channel_id, MonitoredPost.message_id,
+                    MonitoredPost.category, MonitoredPost.is_used, MonitoredPost.is_active,
+                ).where(MonitoredPost.channel_id.in_(self.channel_ids))
+            )).all()
+        posts: dict[int, set[int]] = {cid: set() for cid in self.channel_ids}
+        meta: dict[tuple[int, int], PostMeta] = {}
+        for cid, mid, category, is_used, active in rows:
+            meta[(cid, mid)] = PostMeta(category, bool(is_used), bool(active))
+            if active:
+                posts[cid].add(mid)
+        self._posts = {cid: frozenset(ids) for cid, ids in posts.items()}
+        self._meta = meta
+        self._fingerprint = fp
+        log.info("📡 WATCH обновлён: %s", {cid: len(ids) for cid, ids in self._posts.items()})
+        return True
+
+    # --- фоновые задачи ---
+    async def start(self) -> None:
+        await install_notify_trigger()
+        await self.reload()
+        await self._listen()
+        self._tasks = [
+            asyncio.create_task(self._reloader()),
+            asyncio.create_task(self._poller()),
+        ]
+
+    async def stop(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._listen_conn is not None:
+            try:
+                await self._listen_conn.close()
+            except Exception:
+                pass
+            self._listen_conn = None
+
+    def _on_notify(self, *_args) -> None:
+        self._dirty.set()
+
+    async def _listen(self) -> None:
+        conn = None
+        try:
+            conn = await engine.connect()
+            raw = await conn.get_raw_connection()
+            await raw.driver_connection.add_listener(WATCH_NOTIFY_CHANNEL, self._on_notify)
+            self._listen_conn = conn
+        except Exception as e:
+            if conn is not None:
+                try:
+                    await conn.close()
+                except Exception:
+                    pass
+            log.warning("⚠️ LISTEN %s недоступен (%s) — остаётся опрос", WATCH_NOTIFY_CHANNEL, e)
+
+    def _listen_alive(self) -> bool:
+        if self._listen_conn is None:
+            return False
+        try:
+            return not self._listen_conn.sync_connection.connection.driver_connection.is_closed()
+        except Exception:
+            return False
+
+    async def _reloader(self) -> None:
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+            try:
+                await self.reload()
+            except Exception as e:
+                log.warning("WATCH reload failed: %s", e)
+
+    async def _poller(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if not self._listen_alive():
+                if self._listen_conn is not None:
+                    try:
+                        await self._listen_conn.close()
+                    except Exception:
+                        pass
+                    self._listen_conn = None
+                await self._listen()
+            self._dirty.set()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Хранилище состояний диалогов (aiogram FSM). FSMContextMiddleware читает состояние
+на каждом апдейте с пользователем или чатом — хранилище стоит на горячем пути.
+
+FSM_STORAGE (по умолчанию — redis, если задан REDIS_URL, иначе memory):
+- memory — в памяти процесса: без сетевых запросов, одна реплика, рестарт сбрасывает правку;
+- redis — aiogram RedisStorage по REDIS_URL (нужен пакет redis), TTL FSM_TTL_SEC: любая
+  реплика продолжает диалог, начатый другой;
+- postgres — таблица fsm_states, TTL тот же; для нескольких реплик без redis, ценой
+  SELECT на каждый апдейт.
+
+Здесь же — состояния админских правок (контакты, шаблоны, админы, категории),
+общие для обоих ботов.
+"""
+import os
+import time
+import logging
+from datetime import datetime, timedelta, UTC
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from sqlalchemy import select, delete, case, null, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app_store.db.core import Session, FsmState
+
+log = logging.getLogger("fsm")
+
+FSM_STORAGE = (os.getenv("FSM_STORAGE") or ("redis" if os.getenv("REDIS_URL") else "memory")).strip().lower()
+FSM_TTL_SEC = int(os.getenv("FSM_TTL_SEC", str(24 * 3600)) or "0")
+FSM_PURGE_SEC = float(os.getenv("FSM_PURGE_SEC", "3600") or "3600")
+
+
+class AdminEdit(StatesGroup):
+    """Админ прислал «✏️ …» и бот ждёт следующее сообщение с новым значением"""
+    contacts = State()
+    template = State()      # data: template
+    admin_add = State()
+    admin_remove = State()
+    category = State()      # data: channel_type, channel_id, message_id
+
+
+def _key(key: StorageKey) -> str:
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+
+def _now() -> datetime:
+    return datetime.now(UTC).replace(tzinfo=None)
+
+
+class PgStorage(BaseStorage):
+    """FSM в Postgres: одна строка на ключ, state и data пишутся UPSERT-ом"""
+
+    def __init__(self, ttl: int = FSM_TTL_SEC):
+        self.ttl = ttl
+        self._last_purge = 0.0
+
+    def _expires(self) -> datetime:
+        # без TTL — «никогда», чтобы не заводить NULL в индексе
+        return _now() + (timedelta(seconds=self.ttl) if self.ttl > 0 else timedelta(days=36500))
+
+    async def _row(self, key: StorageKey) -> Optional[FsmState]:
+        async with Session() as s:
+            return (await s.execute(
+                select(FsmState).where(FsmState.key == _key(key), FsmState.expires_at > _now())
+            )).scalar_one_or_none()
+
+    async def _write(self, key: StorageKey, values: Dict[str, Any]) -> None:
+        k = _key(key)
+        async with Session() as s:
+            row = {"key": k, "expires_at": self._expires(), **values}
+            row.setdefault("data", {})
+            stmt = pg_insert(FsmState).values(row)
+            set_ = {c: stmt.excluded[c] for c in values}
+            # вторую половину (state или data) у истёкшей строки не воскрешаем
+            expired = FsmState.expires_at <= _now()
+            if "state" not in values:
+                set_["state"] = case((expired, null()), else_=FsmState.state)
+            if "data" not in values:
+                set_["data"] = case((expired, text("'{}'::jsonb")), else_=FsmState.data)
+            await s.execute(stmt.on_conflict_do_update(
+                index_elements=[FsmState.key],
+                set_={**set_, "expires_at": stmt.excluded.expires_at},
+            ))
+            # пустое состояние без данных — строку не держим
+            await s.execute(delete(FsmState).where(
+                FsmState.key == k, FsmState.state.is_(None), FsmState.data == {},
+            ))
+            if time.monotonic() - self._last_purge >= FSM_PURGE_SEC:
+                self._last_purge = time.monotonic()
+                res = await s.execute(delete(FsmState).where(FsmState.expires_at <= _now()))
+                if res.rowcount:
+                    log.info("fsm: purged %s expired states", res.rowcount)
+            await s.commit()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await self._write(key, {"state": value})
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self._row(key)
+        return row.state if row else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._write(key, {"data": dict(data)})
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await self._row(key)
+        return dict(row.data) if row and row.data else {}
+
+    async def close(self) -> None:
+        pass
+
+
+def make_storage() -> BaseStorage:
+    if FSM_STORAGE == "postgres":
+        return PgStorage()
+    if FSM_STORAGE == "redis":
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage  # требует пакет redis
+        except ImportError:
+            raise SystemExit("FSM_STORAGE=redis: установите пакет redis")
+        ttl = FSM_TTL_SEC or None
+        return RedisStorage.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"), state_ttl=ttl, data_ttl=ttl)
+    return MemoryStorage()
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк и «золотой» корпус для разбора прайсов.
+
+    python -m app_store.parsing.bench               # замер + сверка с bench_baseline.json
+    python -m app_store.parsing.bench --update      # записать текущие результаты как baseline
+
+Корпус: сохранённые посты из архива SAMPLES_DIR (см. app_store.utils.sampling; старые *.lines.txt тоже)
+краевые случаи (EDGE_POSTS) и синтетические посты по 500 строк (флаги, Б/У, разные разделители,
+мусорные цены).
+
+Эталон — reference_parse_lines, неизменная копия parse_lines, которым боты разбирали
+прайсы до общего движка. Золотые выходы (sha256 строк) в baseline пишутся им, а не parse_rows.
+Каждый пост корпуса проверяется дважды: parse_rows против эталона вживую (так проверяются
+и локальные посты, которых нет в baseline) и эталон против baseline (эталон и корпус
+не поменялись). Код выхода 1 — при любом расхождении.
+"""
+import os
+import re
+import sys
+import json
+import glob
+import time
+import random
+import hashlib
+import argparse
+import platform
+import tracemalloc
+
+from app_store.parsing import price_parser
+from app_store.parsing.price_parser import parse_rows, norm_key, normalize_key
+from app_store.utils.sampling import SAMPLES_DIR, iter_samples
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+SYNTH_POSTS = 8
+SYNTH_LINES = 500
+
+_MODELS = [
+    "iPhone 15 Pro", "iPhone 15 Pro Max", "iPhone 14", "iPhone 13 mini", "AirPods Pro 2",
+    "Apple Watch S9 45mm", "MacBook Air M2", "iPad Air 5", "Galaxy S24 Ultra", "Galaxy Z Flip5",
+    "Pixel 8 Pro", "Xiaomi 14", "Dyson V15", "PlayStation 5 Slim", "Steam Deck OLED",
+]
+_MEMORY = ["64", "128", "256", "512", "1TB", "8/256", "12/512"]
+_COLORS = ["Black", "White", "Blue", "Natural Titanium", "Midnight", "Starlight", "Graphite"]
+_FLAGS = ["🇺🇸", "🇯🇵", "🇪🇺", "🇨🇳", "🇭🇰", "🇰🇷", "🇮🇳"]
+_USED_NOTES = ["1 год", "2 года", "3 месяца", "6 недель", "полный комплект", "без коробки", "АКБ 89%"]
+_HEADERS = [
+    "🍏 Apple 🍏", "━━━━━━━━━━━━", "📦 Наличие уточняйте у менеджера", "",
+    "🔥 ГОРЯЧЕЕ ПРЕДЛОЖЕНИЕ 🔥", "Доставка по городу — бесплатно", "Б/У техника:", "⬇️⬇️⬇️",
+]
+
+
+def _synthetic_post(seed: int) -> str:
+    rnd = random.Random(seed)
+    lines = []
+    for _ in range(SYNTH_LINES):
+        roll = rnd.random()
+        if roll < 0.12:
+            lines.append(rnd.choice(_HEADERS))
+            continue
+        name = f"{rnd.choice(_MODELS)} {rnd.choice(_MEMORY)} {rnd.choice(_COLORS)}"
+        if rnd.random() < 0.2:
+            name += f" Б/У {rnd.choice(_USED_NOTES)}"
+        price = rnd.randint(900, 450_000)
+        price_txt = rnd.choice([
+            str(price),
+            f"{price:,}".replace(",", " "),
+            f"{price:,}".replace(",", "."),
+            f"{price}.{rnd.randint(0, 99):02d}",
+            f"{price}000" if rnd.random() < 0.3 else str(price),  # лишние нули
+        ])
+        sep = rnd.choice([" - ", "-", " – ", ": ", " : ", " -  "])
+        flags = "".join(rnd.sample(_FLAGS, rnd.choice([0, 0, 1, 1, 2])))
+        tail = rnd.choice(["", " р", "₽", " руб.", " 🔥", " (последний)"])
+        if flags and rnd.random() < 0.5:
+            lines.append(f"{flags} {name}{sep}{price_txt}{tail}")
+        else:
+            lines.append(f"{name}{sep}{price_txt}{tail} {flags}".rstrip())
+    return "\n".join(lines)
+
+
+# --- эталон: разбор строк прайса в том виде, в каком он был в ботах; не оптимизировать ---
+_REF_PRICE_RE = re.compile(r"^\s*(?P<name>.+?)\s*[-:]\s*(?P<price>[\d\s.]{2,})(?P<rest>.*)$")
+
+
+def reference_parse_lines(text: str) -> list[tuple[str, int, str]]:
+    items = []
+    for raw in (text or "").splitlines():
+        m = _REF_PRICE_RE.match(raw)
+        if not m:
+            continue
+        name = m.group("name").strip()
+        price_str = m.group("price") or ""
+        rest = m.group("rest") or ""
+
+        price_clean = re.sub(r"[^\d.]", "", price_str)
+        if "." in price_clean:
+            parts = price_clean.split(".")
+            if len(parts) == 2:
+                if len(parts[1]) == 3:
+                    price_clean = parts[0] + parts[1]
+                elif len(parts[1]) <= 2:
+                    price_clean = parts[0]
+                else:
+                    price_clean = parts[0] + parts[1]
+            elif len(parts) > 2:
+                price_clean = "".join(parts)
+
+        if not price_clean:
+            continue
+        try:
+            price = int(price_clean)
+        except Exception:
+            continue
+        if price <= 0:
+            continue
+        if price > 2_000_000 and price % 1000 == 0 and (price // 1000) <= 5_000_000:
+            price //= 1000
+        if price > 5_000_000:
+            continue
+
+        flags = []
+        flags.extend(re.findall(r"[\U0001F1E6-\U0001F1FF]{2}", rest))
+        flags.extend(re.findall(r"[\U0001F1E6-\U0001F1FF]{2}", name))
+        clean_name = re.sub(r"[\U0001F1E6-\U0001F1FF]{2}\s*", "", name).strip()
+
+        if flags:
+            for flag in flags:
+                items.append((clean_name, price, flag))
+        else:
+            items.append((clean_name, price, ""))
+    return items
+
+
+# краевые случаи разбора цены и флагов, которые синтетика задевает редко
+EDGE_POSTS = {
+    "edge:prices": "\n".join([
+        "iPhone 15 128 - 5.990р", "iPhone 15 256 - 89.99", "iPhone 15 512 - 10.5000",
+        "MacBook Pro 16 - 1.234.567", "AirPods 2 - 12 990 ₽", "AirPods 3 : 15990",
+        "Galaxy S24 - 99000000", "Galaxy S23 - 7000000", "Pixel 8 - 0", "Pixel 7 - 00",
+        "Xiaomi 14 -- 45000", "Watch S9 - 1 2 3", "Dyson V15 - .99", "Steam Deck - 4.",
+        "Без цены", "- 1000", "iPad 10: 35000 (предзаказ)",
+    ]),
+    "edge:flags": "\n".join([
+        "🇺🇸 iPhone 15 Pro 256 - 99990", "iPhone 15 Pro 256 - 99990 🇯🇵", "iPhone 15 Pro 256 🇪🇺 - 98000 🇭🇰",
+        "🇺🇸🇯🇵 iPhone 14 128 - 60000", "iPhone 14 128 - 60000 🇺🇸🇯🇵🇨🇳", "iPhone 13 🇺🇸mini - 40000",
+        "🇺 iPhone 12 - 30000", "Galaxy S24 Ultra Б/У 1 год - 70000 🇰🇷",
+    ]),
+}
+
+
+def load_corpus(samples_dir: str) -> dict[str, str]:
+    corpus = {}
+    for path in sorted(glob.glob(os.path.join(samples_dir, "*.lines.txt"))):
+        with open(path, encoding="utf-8") as f:
+            corpus[f"sample:{os.path.basename(path)}"] = f.read()
+    for rec in iter_samples(samples_dir):
+        corpus[f"sample:{rec['channel_id']}_{rec['message_id']}_{rec['ts']}"] = rec["text"]
+    corpus.update(EDGE_POSTS)
+    for i in range(SYNTH_POSTS):
+        corpus[f"synthetic:{i}"] = _synthetic_post(1000 + i)
+    return corpus
+
+
+def _digest(rows) -> str:
+    payload = json.dumps([list(r) for r in rows], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _clear_cache() -> None:
+    cache_clear = getattr(price_parser._parse_line, "cache_clear", None)
+    if cache_clear:
+        cache_clear()
+
+
+def _rate(fn, units: int, repeat: int) -> float:
+    """Лучшая скорость (единиц/сек) из repeat прогонов."""
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return units / best if best > 0 else float("inf")
+
+
+def run(corpus: dict[str, str], repeat: int) -> dict:
+    texts = list(corpus.values())
+    n_lines = sum(t.count("\n") + 1 for t in texts)
+    names = [r.name for t in texts for r in parse_rows(t)]
+
+    def parse_cold():
+        _clear_cache()
+        for t in texts:
+            parse_rows(t)
+
+    def parse_warm():
+        for t in texts:
+            parse_rows(t)
+
+    perf = {
+        "parse_rows_cold_lines_per_sec": _rate(parse_cold, n_lines, repeat),
+        "parse_rows_warm_lines_per_sec": _rate(parse_warm, n_lines, repeat),
+        "norm_key_per_sec": _rate(lambda: [norm_key(n, "🇺🇸") for n in names], len(names), repeat),
+        "normalize_key_per_sec": _rate(lambda: [normalize_key(n) for n in names], len(names), repeat),
+    }
+
+    _clear_cache()
+    tracemalloc.start()
+    for t in texts:
+        parse_rows(t)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    perf["parse_rows_peak_kib"] = peak / 1024
+    perf["parse_rows_retained_kib"] = current / 1024
+
+    golden, current = {}, {}
+    for name, text in corpus.items():
+        ref = reference_parse_lines(text)
+        rows = parse_rows(text)
+        golden[name] = {"rows": len(ref), "sha256": _digest(ref)}
+        current[name] = {"rows": len(rows), "sha256": _digest(rows)}
+
+    return {"lines": n_lines, "posts": len(texts), "perf": perf, "golden": golden, "current": current}
+
+
+def _fmt_delta(cur: float, base: float | None, higher_is_better: bool = True) -> str:
+    if not base:
+        return "(нет baseline)"
+    pct = (cur - base) / base * 100
+    if abs(pct) < 2:
+        mark = "≈"  # в пределах шума замера
+    else:
+        mark = "✓" if (pct > 0) == higher_is_better else "✗"
+    return f"(baseline {base:,.0f}, {pct:+.1f}% {mark})"
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m app_store.parsing.bench")
+    ap.add_argument("--samples-dir", default=SAMPLES_DIR)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--baseline", default=BASELINE_PATH)
+    ap.add_argument("--update", action="store_true", help="сохранить текущий результат как baseline")
+    args = ap.parse_args(argv)
+
+    corpus = load_corpus(args.samples_dir)
+    res = run(corpus, args.repeat)
+
+    base = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            base = json.load(f)
+    base_perf = base.get("perf", {})
+    base_golden = base.get("golden", {})
+
+    print(f"Корпус: {res['posts']} постов, {res['lines']} строк "
+          f"(samples: {sum(1 for k in corpus if k.startswith('sample:'))}, из {args.samples_dir})")
+    for key, val in res["perf"].items():
+        lower_better = key.endswith("_kib")
+        unit = "KiB" if lower_better else "/s"
+        print(f"  {key:32s} {val:14,.0f} {unit:3s} {_fmt_delta(val, base_perf.get(key), not lower_better)}")
+
+    # parse_rows против эталона — по всему корпусу, в том числе по постам, которых нет в baseline
+    mismatched = [(name, res["golden"][name], cur) for name, cur in res["current"].items()
+                  if cur != res["golden"][name]]
+    # эталон против baseline: поменялись эталон или тексты корпуса
+    drifted, new = [], []
+    for name, g in res["golden"].items():
+        ref = base_golden.get(name)
+        if ref is None:
+            new.append(name)
+        elif ref != g:
+            drifted.append((name, ref, g))
+
+    if mismatched:
+        print(f"❌ parse_rows: {len(mismatched)} постов разобраны иначе, чем эталонным разбором:")
+        for name, ref, g in mismatched:
+            print(f"   {name}: rows {ref['rows']} -> {g['rows']}")
+    else:
+        print(f"✅ parse_rows: все {len(res['current'])} постов совпадают с эталонным разбором")
+    if drifted:
+        print(f"❌ Золотой корпус: у {len(drifted)} постов эталон разобрал не то, что записано в baseline:")
+        for name, ref, g in drifted:
+            print(f"   {name}: rows {ref['rows']} -> {g['rows']}")
+    if new:
+        print(f"⚠️  Золотой корпус: {len(new)} постов нет в baseline — сверены только с эталоном вживую"
+              f" (добавить: --update):")
+        for name in new:
+            print(f"   {name}")
+    if not drifted and not new:
+        print(f"✅ Золотой корпус: все {len(res['golden'])} постов совпадают с baseline")
+
+    failed = bool(mismatched or drifted)
+    if args.update:
+        if mismatched:
+            print("⛔ baseline не записан: parse_rows расходится с эталоном")
+            return 1
+        res["python"] = platform.python_version()
+        del res["current"]
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(res, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"💾 baseline записан: {args.baseline}")
+        return 0
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,71 +1,165 @@
+import os
 import re
 import logging
-from typing import Iterable, Tuple
+from functools import lru_cache
+from typing import Iterable, NamedTuple, Tuple
 
 logger = logging.getLogger(__name__)
 
-PRICE_LINE = re.compile(
-    r"""
-    ^\s*
-    (?P<name>.+?)              # всё до разделителя — имя
-    \s+[-—:]\s+               # разделитель: дефис/тире/двоеточие ОБЯЗАТЕЛЬНО с пробелами
-    (?P<price>[\d\s\.,]+)    # цена: цифры, пробелы, точки, запятые
-    (?:\s*[₽рR]\.?)?          # необязательная валюта: ₽/р/R, с точкой или без
-    (?:\D.*)?                  # дальше могут быть эмодзи/флаги/комментарии
-    $
-    """,
-    re.VERBOSE | re.IGNORECASE | re.UNICODE
-)
-
-# Дополнительный паттерн для случаев без пробела перед дефисом
-PRICE_LINE_NO_SPACE = re.compile(
-    r"""
-    ^\s*
-    (?P<name>.+?)              # всё до дефиса — имя
-    [-—:](?P<price>[\d\s\.,]+)    # дефис/тире/двоеточие сразу за именем, затем цена
-    (?:\s*[₽рR]\.?)?          # необязательная валюта: ₽/р/R, с точкой или без
-    (?:\D.*)?                  # дальше могут быть эмодзи/флаги/комментарии
-    $
-    """,
-    re.VERBOSE | re.IGNORECASE | re.UNICODE
-)
+
+class PriceRow(NamedTuple):
+    """Строка прайса: имя без флагов, цена в рублях, emoji-флаг страны (или "")"""
+    name: str
+    price: int
+    flag: str
+
+
+# Единый разбор строк прайса для оптового, розничного бота и монитора каналов.
+# Все шаблоны компилируются один раз при импорте.
+PRICE_RE = re.compile(r"^\s*(?P<name>.+?)\s*[-:]\s*(?P<price>[\d\s.]{2,})(?P<rest>.*)$")
+_FLAG_RE = re.compile(r"[\U0001F1E6-\U0001F1FF]{2}")
+_FLAG_WS_RE = re.compile(r"[\U0001F1E6-\U0001F1FF]{2}\s*")
+_NOT_PRICE_CHAR_RE = re.compile(r"[^\d.]")
+_DIGIT_RE = re.compile(r"\d")
+_RI_FIRST = "\U0001F1E6"  # первый regional indicator: строки, где все символы меньше, флагов не содержат
+
+_KEY_JUNK_RE = re.compile(r"[^\w\s/\-\+\.]", re.UNICODE)
+_USAGE_RE = re.compile(r"(\d+)\s*(?:год|года|лет|месяц|месяца|недел)")
+_WS_RE = re.compile(r"\s+")
+
+
+def _normalize_price(price_str: str) -> int | None:
+    # Обрабатываем случаи типа "5.990р" -> "5990"
+    price_clean = _NOT_PRICE_CHAR_RE.sub("", price_str)
+
+    # Если есть точка, проверяем - это разделитель тысяч или копейки
+    if "." in price_clean:
+        parts = price_clean.split(".")
+        if len(parts) == 2:
+            # 1-2 цифры после точки — копейки, отбрасываем; 3 и больше — разделитель тысяч (5.990, 10.500)
+            if len(parts[1]) <= 2:
+                price_clean = parts[0]
+            else:
+                price_clean = parts[0] + parts[1]
+        else:
+            # Несколько точек - это разделители тысяч (1.234.567)
+            price_clean = "".join(parts)
+
+    if not price_clean:
+        return None
+    try:
+        price = int(price_clean)
+    except ValueError:
+        return None
+    if price <= 0:
+        return None
+    # защита от лишних нулей: только делим на 1000, НИКОГДА не делим на 100
+    # пример: "50000000" -> "50000", если выглядит как три лишних нуля
+    if price > 2_000_000 and price % 1000 == 0 and (price // 1000) <= 5_000_000:
+        price //= 1000
+    if price > 5_000_000:
+        return None
+    return price
+
+
+# Разобранные строки кешируются: правка большого поста обычно меняет одну-две строки,
+# остальные берутся из кеша без регулярок.
+PARSE_LINE_CACHE = int(os.getenv("PARSE_LINE_CACHE", "20000") or "0")
+
+
+def _parse_line(raw: str) -> tuple[PriceRow, ...]:
+    m = PRICE_RE.match(raw)
+    if not m:
+        return ()
+    name, price_str = m.group("name", "price")
+    price_str = price_str.strip()
+    # частый случай — цена одними цифрами в разумных пределах
+    if price_str.isdigit() and 0 < (price := int(price_str)) <= 2_000_000:
+        pass
+    elif (price := _normalize_price(price_str)) is None:
+        return ()
+
+    name = name.strip()
+    if max(raw) < _RI_FIRST:
+        return (PriceRow(name, price, ""),)
+
+    # флаги: один проход по строке, по позиции делим на флаги имени и флаги хвоста
+    name_end = m.end("name")
+    flags_in_tail: list[str] = []
+    flags_in_name: list[str] = []
+    for fm in _FLAG_RE.finditer(raw):
+        (flags_in_name if fm.start() < name_end else flags_in_tail).append(fm.group())
+    if flags_in_name:
+        name = _FLAG_WS_RE.sub("", name).strip()
+    flags = flags_in_tail + flags_in_name
+    if not flags:
+        return (PriceRow(name, price, ""),)
+    return tuple(PriceRow(name, price, flag) for flag in flags)
+
+
+if PARSE_LINE_CACHE > 0:
+    _parse_line = lru_cache(maxsize=PARSE_LINE_CACHE)(_parse_line)
+
+
+def parse_rows(text: str) -> list[PriceRow]:
+    """
+    Разобрать пост-прайс на строки (name, price, flag).
+    Строка с несколькими флагами даёт по записи на каждый флаг (сначала флаги из хвоста, потом из имени).
+    """
+    items: list[PriceRow] = []
+    extend = items.extend
+    parse_line = _parse_line
+    has_digit = _DIGIT_RE.search
+    for raw in (text or "").splitlines():
+        # дешёвый отсев заголовков и пустых строк: без цифр и разделителя цены строка не бывает
+        if ("-" not in raw and ":" not in raw) or not has_digit(raw):
+            continue
+        rows = parse_line(raw)
+        if rows:
+            extend(rows)
+    return items
+
+
+def norm_key(name: str, flag: str = "") -> str:
+    """Ключ товара внутри поста: имя в нижнем регистре с ужатыми пробелами, флаг через '|'"""
+    s = _WS_RE.sub(" ", (name or "").lower()).strip()
+    if flag:
+        s = f"{s}|{flag}"
+    return s
+
+
+def normalize_key(name: str) -> str:
+    """Ключ товара по всему каналу, без флага: без эмодзи и пунктуации"""
+    s = _WS_RE.sub(" ", (name or "").lower())
+    # убираем всё, кроме букв/цифр/пробела и базовых разделителей
+    s = _KEY_JUNK_RE.sub("", s)
+    return s.strip()
+
+
+def parse_used_attrs(name: str) -> dict:
+    s = (name or "").lower()
+    attrs: dict = {}
+    m = _USAGE_RE.search(s)
+    if m:
+        attrs["usage_hint"] = m.group(0)
+    if "полный комплект" in s:
+        attrs["kit"] = "full"
+    if "без короб" in s:
+        attrs["kit"] = "no_box"
+    return attrs
+
 
 def parse_price_post(text: str) -> Iterable[Tuple[str, int]]:
     """
-    Возвращает (name, price) по строкам вида: "iPhone 15 128 black - 49900"
-    Игнорирует заголовки, пустые строки и блоки без цены.
+    Возвращает (name, price) по строкам вида: "iPhone 15 128 black - 49900".
+    Совместимая обёртка над parse_rows: строки с несколькими флагами не дублируются.
     """
     results = []
-    for raw in text.splitlines():
-        line = raw.strip()
-        if not line:
-            continue
-        
-        # Пробуем основной паттерн (с пробелами)
-        m = PRICE_LINE.match(line)
-        if not m:
-            # Пробуем дополнительный паттерн (без пробела перед дефисом)
-            m = PRICE_LINE_NO_SPACE.match(line)
-        
-        if not m:
-            continue
-            
-        name = m.group("name").strip("•.-–—: ")
-        price_raw = m.group("price")
-        # вытащим только цифры (удаляем пробелы/разделители тысяч)
-        digits = "".join(ch for ch in price_raw if ch.isdigit())
-        if not digits:
-            continue
-        try:
-            price = int(digits)
-            # Проверяем разумность цены (максимум 1 миллион рублей)
-            if price > 1_000_000:
-                logger.warning(f"⚠️ Слишком большая цена для товара '{name}': {price:,} руб. Пропускаем.")
-                continue
-        except ValueError:
-            continue
+    seen = set()
+    for row in parse_rows(text):
         # Отсеем слишком короткие "имена", это обычно шум
-        if len(name) < 2:
+        if len(row.name) < 2 or (row.name, row.price) in seen:
             continue
-        results.append((name, price))
+        seen.add((row.name, row.price))
+        results.append((row.name, row.price))
     return results
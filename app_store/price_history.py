@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Чтение журнала цен (product_price_history): история товара для /price_history
+и тренды за период для /diag. Все выборки ограничены по recorded_at —
+Postgres читает только секции нужных месяцев.
+"""
+import os
+from html import escape
+from datetime import datetime, timedelta, UTC
+
+from sqlalchemy import select, func
+
+from app_store.db.core import Session, Product, ProductPriceHistory as H
+
+PRICE_HISTORY_DAYS = int(os.getenv("PRICE_HISTORY_DAYS", "90") or "90")
+PRICE_TREND_DAYS = int(os.getenv("PRICE_TREND_DAYS", "7") or "7")
+
+
+def _fmt_price(p: int | None) -> str:
+    return "—" if p is None else f"{p:,}".replace(",", " ") + " ₽"
+
+
+def _since(days: int) -> datetime:
+    return datetime.now(UTC).replace(tzinfo=None) - timedelta(days=days)
+
+
+async def find_products(channel_id: int, query: str, *, limit: int = 5) -> list[Product]:
+    """Товар по id или по части названия"""
+    query = (query or "").strip()
+    async with Session() as s:
+        if query.isdigit():
+            p = await s.get(Product, int(query))
+            return [p] if p is not None and p.channel_id == channel_id else []
+        return list((await s.execute(
+            select(Product)
+            .where(Product.channel_id == channel_id, Product.name.ilike(f"%{query}%"))
+            .order_by(Product.available.desc(), Product.name)
+            .limit(limit)
+        )).scalars())
+
+
+async def product_history(product: Product, price_type: str, *, days: int = PRICE_HISTORY_DAYS, limit: int = 20) -> list[H]:
+    async with Session() as s:
+        return list((await s.execute(
+            select(H).where(
+                H.channel_id == product.channel_id,
+                H.key == product.key,
+                H.is_used == product.is_used,
+                H.price_type == price_type,
+                H.recorded_at >= _since(days),
+            )
+            .order_by(H.recorded_at.desc())
+            .limit(limit)
+        )).scalars())
+
+
+def format_history(product: Product, rows: list[H], *, days: int = PRICE_HISTORY_DAYS) -> str:
+    lines = [f"📈 <b>История цены</b>: {escape(product.name)}{' (Б/У)' if product.is_used else ''}", ""]
+    if not rows:
+        lines.append(f"Изменений за {days} дн. нет.")
+        return "\n".join(lines)
+    for h in rows:
+        when = h.recorded_at.strftime("%d.%m.%Y %H:%M")
+        if h.price is None:
+            what = f"снят с наличия (было {_fmt_price(h.old_price)})"
+        elif h.old_price is None:
+            what = f"в наличии: {_fmt_price(h.price)}"
+        else:
+            arrow = "🔻" if h.price < h.old_price else "🔺"
+            what = f"{_fmt_price(h.old_price)} → {_fmt_price(h.price)} {arrow}"
+        lines.append(f"• {when}: {what}")
+    return "\n".join(lines)
+
+
+async def price_trends(channel_id: int, price_type: str, *, days: int = PRICE_TREND_DAYS, top: int = 5) -> dict:
+    since = _since(days)
+    flt = (H.channel_id == channel_id, H.price_type == price_type, H.recorded_at >= since)
+    async with Session() as s:
+        changes, ups, downs, added, removed = (await s.execute(
+            select(
+                func.count(),
+                func.count().filter(H.price > H.old_price),
+                func.count().filter(H.price < H.old_price),
+                func.count().filter(H.old_price.is_(None)),
+                func.count().filter(H.price.is_(None)),
+            ).where(*flt)
+        )).one()
+        pct = (H.price - H.old_price) * 100.0 / H.old_price
+        movers = (await s.execute(
+            select(H.key, H.old_price, H.price, pct.label("pct"))
+            .where(*flt, H.price.isnot(None), H.old_price > 0)
+            .order_by(func.abs(pct).desc())
+            .limit(top)
+        )).all()
+    return {
+        "days": days,
+        "changes": changes,
+        "ups": ups,
+        "downs": downs,
+        "added": added,
+        "removed": removed,
+        "movers": movers,
+    }
+
+
+def trends_lines(t: dict) -> list[str]:
+    lines = [
+        "",
+        f"📈 <b>Цены за {t['days']} дн.:</b>",
+        f"• Изменений: <b>{t['changes']}</b> (🔺 {t['ups']}, 🔻 {t['downs']})",
+        f"• Появилось: <b>{t['added']}</b>, снято с наличия: <b>{t['removed']}</b>",
+    ]
+    for key, old, new, pct in t["movers"]:
+        lines.append(f"• {escape(key)}: {_fmt_price(old)} → {_fmt_price(new)} ({pct:+.1f}%)")
+    return lines
@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+"""
+/rescan для обоих ботов: перечитать тексты мониторимых постов и обновить товары.
+Текст поста берётся из channel_messages.raw_text (его сохраняет монитор канала);
+только для постов, которых монитор ещё не видел, — пересылкой в SINK_CHAT_ID
+(Bot API не умеет читать сообщения канала). Запросы к Telegram идут через лимитер
+сессии бота (app_store.utils.ratelimit) с фоновым приоритетом, RESCAN_CONCURRENCY постов
+параллельно; прогресс — правками одного статусного сообщения.
+
+Запуски пишутся в rescan_runs, обработанные посты — в rescan_checkpoints; счётчики
+запуска пересчитываются по чекпоинтам при каждом сбросе, так что и прерванный запуск
+видно. Прерванный (running) или завершённый с ошибками (partial) запуск следующий
+/rescan продолжает: уже сделанные посты пропускаются, пока их записанная версия
+актуальна, упавшие — повторяются. Обычный /rescan берёт только «грязные» посты —
+без сохранённого текста или у которых версия текста (с категорией/Б/У) не совпадает
+с записанной в channel_messages.text_hash.
+/rescan full — новый запуск по всем постам.
+
+Один канал — один перескан: на время запуска берётся advisory lock Postgres (между
+процессами и репликами тоже); второй /rescan получает RescanBusy.
+
+Боты запускают перескан фоновой задачей (spawn_rescan) и сразу отвечают — очередь
+апдейтов админа в UpdateScheduler не ждёт минутный перескан; /rescan status показывает
+счётчики последнего запуска из rescan_runs. drain_rescans при остановке прерывает
+перескан, сохранив чекпоинты.
+"""
+import os
+import time
+import hashlib
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, UTC
+from typing import Any, Awaitable, Callable, Sequence
+
+from aiogram import Bot
+from aiogram.types import Message
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+
+from sqlalchemy import select, update, func, case
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app_store.db.core import engine, Session, MonitoredPost, ChannelMessage, RescanRun, RescanCheckpoint
+from app_store.db.repo import UPSERT_CHUNK, get_post_texts
+from app_store.utils.ratelimit import background
+
+log = logging.getLogger("rescan")
+
+RESCAN_CONCURRENCY = int(os.getenv("RESCAN_CONCURRENCY", "8") or "8")
+RESCAN_PROGRESS_SEC = float(os.getenv("RESCAN_PROGRESS_SEC", "2.5") or "2.5")
+
+
+async def read_post_text(bot: Bot, sink_id: int, from_chat_id: int, message_id: int, *, max_retries: int = 3) -> str:
+    """Текст поста канала: пересылка в sink-чат и сразу удаление копии."""
+    delay = 0.5
+    for attempt in range(1, max_retries + 1):
+        try:
+            forwarded = await bot.forward_message(
+                chat_id=sink_id,
+                from_chat_id=from_chat_id,
+                message_id=message_id,
+                disable_notification=True,
+            )
+            break
+        except TelegramAPIError as e:
+            log.error(f"Error accessing message {message_id}: {e}")
+            if attempt == max_retries:
+                raise
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 4.0)
+
+    text = forwarded.text or forwarded.caption or ""
+    try:
+        await bot.delete_message(chat_id=sink_id, message_id=forwarded.message_id)
+    except TelegramAPIError:
+        pass
+    return text
+
+
+async def stored_texts(channel_id: int, posts: Sequence[MonitoredPost]) -> dict[int, str]:
+    async with Session() as s:
+        return await get_post_texts(s, channel_id, [p.message_id for p in posts])
+
+
+async def ingested_versions(channel_id: int, posts: Sequence[MonitoredPost]) -> dict[int, str]:
+    """message_id -> text_hash последней записанной версии поста"""
+    async with Session() as s:
+        rows = (await s.execute(
+            select(ChannelMessage.message_id, ChannelMessage.text_hash).where(
+                ChannelMessage.channel_id == channel_id,
+                ChannelMessage.message_id.in_([p.message_id for p in posts]),
+                ChannelMessage.text_hash.isnot(None),
+            )
+        )).all()
+    return dict(rows)
+
+
+# --- один перескан на канал ---
+class RescanBusy(Exception):
+    """По каналу уже идёт /rescan — в этом или в другом процессе"""
+
+
+def _lock_key(channel_id: int) -> int:
+    digest = hashlib.blake2b(f"rescan:{channel_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+@asynccontextmanager
+async def channel_lock(channel_id: int):
+    """
+    Сессионный advisory lock на время перескана: держится своим соединением из пула
+    и отпускается сам, если процесс упал и соединение закрылось.
+    """
+    key = _lock_key(channel_id)
+    async with engine.connect() as conn:
+        got = (await conn.execute(select(func.pg_try_advisory_lock(key)))).scalar()
+        await conn.commit()  # блокировка сессионная — транзакцию открытой не держим
+        if not got:
+            raise RescanBusy(channel_id)
+        try:
+            yield
+        finally:
+            try:
+                await conn.execute(select(func.pg_advisory_unlock(key)))
+                await conn.commit()
+            except BaseException:
+                # не вернуть в пул соединение с чужой блокировкой
+                await conn.invalidate()
+                raise
+
+
+# --- запуски и чекпоинты ---
+_RESUMABLE = ("running", "partial")
+_DONE = ("ok", "unchanged")
+
+
+async def open_run(channel_id: int, *, full: bool, total: int) -> tuple[RescanRun, set[int]]:
+    """
+    Прерванный или завершённый с ошибками запуск канала продолжается (возвращаются уже
+    обработанные посты), иначе — новый. full=True всегда начинает новый запуск,
+    незаконченные помечаются aborted. Вызывается под channel_lock.
+    """
+    now = datetime.now(UTC).replace(tzinfo=None)
+    async with Session() as s:
+        resumable = (await s.execute(
+            select(RescanRun).where(RescanRun.channel_id == channel_id, RescanRun.status.in_(_RESUMABLE))
+            .order_by(RescanRun.id.desc())
+        )).scalars().first()
+        if resumable is not None and not full:
+            done = set((await s.execute(
+                select(RescanCheckpoint.message_id).where(
+                    RescanCheckpoint.run_id == resumable.id, RescanCheckpoint.status.in_(_DONE),
+                )
+            )).scalars())
+            resumable.status = "running"
+            resumable.total = total
+            resumable.finished_at = None
+            await s.commit()
+            return resumable, done
+        await s.execute(
+            update(RescanRun)
+            .where(RescanRun.channel_id == channel_id, RescanRun.status.in_(_RESUMABLE))
+            .values(status="aborted", finished_at=now)
+        )
+        run = RescanRun(channel_id=channel_id, full=full, total=total)
+        s.add(run)
+        await s.commit()
+        return run, set()
+
+
+async def _sync_counts(s, run_id: int) -> None:
+    """Счётчики запуска — по его чекпоинтам (пост, упавший и потом сделанный, считается один раз)"""
+    cp = RescanCheckpoint
+    counts = select(
+        func.count().filter(cp.status.in_(_DONE)).label("ok"),
+        func.count().filter(cp.status == "unchanged").label("unchanged"),
+        func.count().filter(cp.status == "fail").label("fail"),
+    ).where(cp.run_id == run_id).subquery("counts")
+    await s.execute(
+        update(RescanRun).where(RescanRun.id == run_id)
+        .values(ok=counts.c.ok, unchanged=counts.c.unchanged, fail=counts.c.fail)
+    )
+
+
+async def _save_checkpoints(run_id: int, items: list[dict]) -> None:
+    if not items:
+        return
+    async with Session() as s:
+        for i in range(0, len(items), UPSERT_CHUNK):
+            stmt = pg_insert(RescanCheckpoint).values([{"run_id": run_id, **it} for it in items[i:i + UPSERT_CHUNK]])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[RescanCheckpoint.run_id, RescanCheckpoint.message_id],
+                set_={
+                    "status": stmt.excluded.status,
+                    "error": stmt.excluded.error,
+                    "processed_at": stmt.excluded.processed_at,
+                },
+            )
+            await s.execute(stmt)
+        await _sync_counts(s, run_id)
+        await s.commit()
+
+
+async def _finish_run(run: RescanRun) -> None:
+    """done — все посты запуска сделаны; partial — есть упавшие, следующий /rescan их повторит"""
+    async with Session() as s:
+        await _sync_counts(s, run.id)
+        await s.execute(
+            update(RescanRun).where(RescanRun.id == run.id).values(
+                status=case((RescanRun.fail > 0, "partial"), else_="done"),
+                finished_at=datetime.now(UTC).replace(tzinfo=None),
+            )
+        )
+        await s.commit()
+
+
+@dataclass
+class RescanStats:
+    total: int
+    done: int = 0
+    ok: int = 0
+    unchanged: int = 0
+    fail: int = 0
+    from_db: int = 0
+    clean: int = 0    # пропущены: записанная версия совпадает с сохранённым текстом
+    resumed: int = 0  # пропущены: уже обработаны в прерванном запуске
+    started: float = 0.0
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def todo(self) -> int:
+        return self.total - self.clean - self.resumed
+
+    def progress(self) -> str:
+        return (f"⏳ Прогресс: {self.done}/{self.todo} "
+                f"(успехов: {self.ok}, без изменений: {self.unchanged}, ошибок: {self.fail})")
+
+
+async def _edit_status(bot: Bot, status: Message, text: str) -> None:
+    try:
+        await status.edit_text(text)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            log.warning("rescan status edit failed: %s", e)
+    except TelegramAPIError as e:
+        log.warning("rescan status edit failed: %s", e)
+
+
+async def run_rescan(
+    bot: Bot,
+    status: Message,
+    channel_id: int,
+    posts: Sequence[MonitoredPost],
+    sink_id: int,
+    handle: Callable[[MonitoredPost, str], Awaitable[Any]],
+    version: Callable[[MonitoredPost, str], str],
+    *,
+    full: bool = False,
+    via_tg: bool = False,
+) -> RescanStats:
+    """
+    Прочитать посты и передать текст в handle(post, text).
+    handle возвращает PostDiff, либо None — «содержимое не менялось»; исключение — ошибка поста.
+    version(post, text) — хеш текста в том виде, в каком его записал бы handle (repo.post_text_hash).
+    via_tg — читать тексты только через Telegram, не из БД.
+    RescanBusy — по каналу уже идёт перескан.
+    """
+    async with channel_lock(channel_id):
+        return await _run_locked(bot, status, channel_id, posts, sink_id, handle, version, full=full, via_tg=via_tg)
+
+
+async def _run_locked(bot, status, channel_id, posts, sink_id, handle, version, *, full, via_tg) -> RescanStats:
+    stats = RescanStats(total=len(posts), started=time.monotonic())
+    run, done_before = await open_run(channel_id, full=full, total=len(posts))
+    known = await stored_texts(channel_id, posts)
+    stored = {} if via_tg else known
+
+    todo = []
+    versions = {} if full else await ingested_versions(channel_id, posts)
+
+    def _current(post: MonitoredPost, text: str | None) -> bool:
+        return text is not None and versions.get(post.message_id) == version(post, text)
+
+    for post in posts:
+        # сделанный в продолжаемом запуске пост пропускаем, только пока записанная версия актуальна:
+        # после того запуска его могли поправить или перенести в другую категорию
+        if post.message_id in done_before and _current(post, known.get(post.message_id)):
+            stats.resumed += 1
+            continue
+        if not full and _current(post, stored.get(post.message_id)):
+            stats.clean += 1
+            continue
+        todo.append(post)
+
+    sem = asyncio.Semaphore(max(1, RESCAN_CONCURRENCY))
+    checkpoints: list[dict] = []
+    last_report = time.monotonic()
+
+    async def _flush() -> None:
+        batch = checkpoints[:]
+        del checkpoints[:len(batch)]
+        try:
+            await _save_checkpoints(run.id, batch)
+        except Exception as e:
+            log.warning("rescan checkpoint save failed: %s", e)
+
+    async def _one(post: MonitoredPost) -> None:
+        nonlocal last_report
+        async with sem:
+            error = None
+            same = False
+            try:
+                text = stored.get(post.message_id)
+                if text is not None:
+                    stats.from_db += 1
+                elif sink_id:
+                    text = await read_post_text(bot, sink_id, post.channel_id, post.message_id)
+                else:
+                    raise ValueError("текста нет в БД, а SINK_CHAT_ID не задан")
+                if await handle(post, text) is None:
+                    stats.unchanged += 1
+                    same = True
+                stats.ok += 1
+            except Exception as e:
+                log.error(f"Error scanning post {post.message_id}: {e}")
+                stats.fail += 1
+                error = str(e)[:1000]
+            # прерванный остановкой пост (CancelledError) чекпоинта не получает — следующий /rescan его повторит
+            stats.done += 1
+            checkpoints.append({
+                "message_id": post.message_id,
+                "status": "fail" if error else ("unchanged" if same else "ok"),
+                "error": error,
+                "processed_at": datetime.now(UTC).replace(tzinfo=None),
+            })
+        now = time.monotonic()
+        if now - last_report >= RESCAN_PROGRESS_SEC and stats.done < len(todo):
+            last_report = now
+            await _flush()
+            await _edit_status(bot, status, stats.progress())
+
+    try:
+        with background():
+            await asyncio.gather(*(_one(p) for p in todo))
+    except asyncio.CancelledError:
+        # остановка процесса: сделанное сохраняем, запуск остаётся running — следующий /rescan продолжит
+        await _flush()
+        raise
+    await _flush()
+    await _finish_run(run)
+    log.info("rescan #%s done: %s/%s ok=%s unchanged=%s fail=%s from_db=%s clean=%s resumed=%s in %.1fs",
+             run.id, stats.done, len(todo), stats.ok, stats.unchanged, stats.fail,
+             stats.from_db, stats.clean, stats.resumed, stats.elapsed)
+    return stats
+
+
+def summary(stats: RescanStats) -> str:
+    """Строки итога: что пропущено и откуда взяты тексты"""
+    return (f"Обработано: {stats.done} из {stats.total} "
+            f"(не менялись с прошлой записи: {stats.clean}, уже сделаны в прерванном запуске: {stats.resumed})\n"
+            f"Из БД: {stats.from_db}, через Telegram: {stats.done - stats.from_db}")
+
+
+async def finish_status(bot: Bot, status: Message, text: str) -> None:
+    await _edit_status(bot, status, text)
+
+
+# --- перескан в фоне ---
+_TASKS: set[asyncio.Task] = set()
+
+
+def _rescan_done(task: asyncio.Task) -> None:
+    _TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error("rescan task failed: %r", task.exception())
+
+
+def spawn_rescan(job: Awaitable[Any]) -> None:
+    """Запустить перескан (корутину бота вокруг run_rescan) фоновой задачей"""
+    task = asyncio.create_task(job)
+    _TASKS.add(task)
+    task.add_done_callback(_rescan_done)
+
+
+async def drain_rescans() -> None:
+    """
+    Shutdown-хендлер: перескан может идти минутами — останавливаем его; сделанные посты
+    уже в чекпоинтах, запуск остаётся running и продолжится следующим /rescan
+    """
+    while _TASKS:
+        tasks = list(_TASKS)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def last_run(channel_id: int) -> RescanRun | None:
+    async with Session() as s:
+        return (await s.execute(
+            select(RescanRun).where(RescanRun.channel_id == channel_id).order_by(RescanRun.id.desc()).limit(1)
+        )).scalars().first()
+
+
+_RUN_STATUS = {
+    "running": "⏳ идёт",
+    "done": "✅ завершён",
+    "partial": "⚠️ завершён с ошибками",
+    "aborted": "⛔ прерван",
+}
+
+
+def run_status(run: RescanRun | None) -> str:
+    """Состояние запуска по счётчикам rescan_runs (их обновляет каждый сброс чекпоинтов)"""
+    if run is None:
+        return "Перескан этого канала ещё не запускался."
+    done = run.ok + run.fail
+    return (f"Перескан #{run.id} ({'full' if run.full else 'изменённые посты'}): {_RUN_STATUS.get(run.status, run.status)}\n"
+            f"Обработано: {done} из {run.total} (успехов: {run.ok}, без изменений: {run.unchanged}, ошибок: {run.fail})\n"
+            f"Начат: {run.started_at:%d.%m %H:%M} UTC"
+            + (f", закончен: {run.finished_at:%d.%m %H:%M} UTC" if run.finished_at else ""))
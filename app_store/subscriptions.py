@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Подписки покупателей на товары («🔔 Следить»).
+Диф поста (PostDiff) считается в upsert-е, здесь — хранение подписок
+и рассылка уведомлений пачками. spawn_notify — рассылка в фоне; задачи держатся
+в _TASKS до конца, drain_notifications дожидается их при остановке.
+"""
+import os
+import asyncio
+import logging
+
+from aiogram import html
+from sqlalchemy import select, delete
+
+from app_store.db.core import Session, ProductSubscription, Product
+from app_store.db.repo import PostDiff, PriceChange
+from app_store.utils.ratelimit import background
+
+log = logging.getLogger("subscriptions")
+
+NOTIFY_BATCH_SIZE = int(os.getenv("NOTIFY_BATCH_SIZE", "25") or "25")
+NOTIFY_BATCH_PAUSE = float(os.getenv("NOTIFY_BATCH_PAUSE", "1.0") or "1.0")
+
+
+def _fmt_price(p: int) -> str:
+    return f"{p:,}".replace(",", " ")
+
+
+async def is_subscribed(user_id: int, product: Product) -> bool:
+    async with Session() as s:
+        row = (await s.execute(
+            select(ProductSubscription.id).where(
+                ProductSubscription.user_id == user_id,
+                ProductSubscription.channel_id == product.channel_id,
+                ProductSubscription.key == product.key,
+                ProductSubscription.is_used == product.is_used,
+            )
+        )).first()
+    return row is not None
+
+
+async def toggle_subscription(user_id: int, product: Product) -> bool:
+    """Включить/выключить подписку на товар. Возвращает новое состояние."""
+    async with Session() as s:
+        res = await s.execute(
+            delete(ProductSubscription).where(
+                ProductSubscription.user_id == user_id,
+                ProductSubscription.channel_id == product.channel_id,
+                ProductSubscription.key == product.key,
+                ProductSubscription.is_used == product.is_used,
+            )
+        )
+        if res.rowcount:
+            await s.commit()
+            return False
+        s.add(ProductSubscription(
+            user_id=user_id,
+            channel_id=product.channel_id,
+            key=product.key,
+            is_used=product.is_used,
+        ))
+        await s.commit()
+        return True
+
+
+def _render(kind: str, ch: PriceChange) -> str:
+    if kind == "drop":
+        return (
+            "🔔 <b>Цена снижена</b>\n\n"
+            f"📦 {html.quote(ch.name)}\n"
+            f"💰 {_fmt_price(ch.old_price)} ₽ → <b>{_fmt_price(ch.new_price)} ₽</b>"
+        )
+    price = f"<b>{_fmt_price(ch.new_price)} ₽</b>" if ch.new_price else "<b>Не указана</b>"
+    return (
+        "🔔 <b>Снова в наличии</b>\n\n"
+        f"📦 {html.quote(ch.name)}\n"
+        f"💰 {price}"
+    )
+
+
+async def notify_post_diff(bot, diff: PostDiff) -> int:
+    """
+    Разослать подписчикам снижения цен и возвраты в наличие из дифа поста.
+    Подписчики выбираются одним запросом по ключам дифа, отправка — пачками
+    по NOTIFY_BATCH_SIZE с паузой между пачками и с фоновым приоритетом в лимитере бота —
+    правки экранов покупателей идут вперёд. Возвращает число отправленных.
+    """
+    events = {}  # type: dict[str, tuple[str, PriceChange]]
+    for ch in diff.price_drops:
+        events[ch.key] = ("drop", ch)
+    for ch in diff.restocked:
+        events[ch.key] = ("restock", ch)
+    if not events:
+        return 0
+
+    async with Session() as s:
+        subs = (await s.execute(
+            select(ProductSubscription.user_id, ProductSubscription.key).where(
+                ProductSubscription.channel_id == diff.channel_id,
+                ProductSubscription.is_used == diff.is_used,
+                ProductSubscription.key.in_(list(events)),
+            )
+        )).all()
+    if not subs:
+        return 0
+
+    outbox = [(uid, _render(*events[key])) for uid, key in subs]
+    sent = 0
+
+    async def _send(uid: int, text: str) -> bool:
+        try:
+            await bot.send_message(uid, text, parse_mode="HTML", disable_notification=False)
+            return True
+        except Exception as e:
+            log.warning("notify %s failed: %s", uid, e)
+            return False
+
+    with background():
+        for i in range(0, len(outbox), NOTIFY_BATCH_SIZE):
+            batch = outbox[i:i + NOTIFY_BATCH_SIZE]
+            results = await asyncio.gather(*(_send(uid, text) for uid, text in batch))
+            sent += sum(1 for ok in results if ok)
+            if i + NOTIFY_BATCH_SIZE < len(outbox):
+                await asyncio.sleep(NOTIFY_BATCH_PAUSE)
+
+    log.info("🔔 post %s/%s: %s notifications sent (%s subscribers)",
+             diff.channel_id, diff.message_id, sent, len(outbox))
+    return sent
+
+
+_TASKS: set[asyncio.Task] = set()
+
+
+def _notify_done(task: asyncio.Task) -> None:
+    _TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error("notify task failed: %r", task.exception())
+
+
+def spawn_notify(bot, diff: PostDiff | None) -> None:
+    """Рассылка по дифу в фоне: вызывающий (апдейт канала, /rescan) не ждёт отправки сообщений"""
+    if not diff:
+        return
+    task = asyncio.create_task(notify_post_diff(bot, diff))
+    _TASKS.add(task)
+    task.add_done_callback(_notify_done)
+
+
+async def drain_notifications() -> None:
+    """Shutdown-хендлер: дождаться начатых рассылок (сессия бота ещё открыта)"""
+    while _TASKS:
+        await asyncio.gather(*list(_TASKS), return_exceptions=True)
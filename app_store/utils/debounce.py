@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Склейка частых событий по ключу: из серии вызовов submit(key, ...) в пределах
+паузы `quiet` выполняется один callback с самыми свежими аргументами.
+`max_wait` ограничивает задержку при непрерывной серии правок.
+Для одного ключа callback-и никогда не выполняются параллельно.
+"""
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Hashable
+
+log = logging.getLogger("debounce")
+
+
+@dataclass
+class _Pending:
+    args: tuple
+    first: float
+    last: float
+    count: int = 1
+
+
+class KeyedDebouncer:
+    def __init__(self, callback: Callable[..., Awaitable[Any]], *, quiet: float, max_wait: float):
+        self._callback = callback
+        self.quiet = quiet
+        self.max_wait = max(max_wait, quiet)
+        self._pending: dict[Hashable, _Pending] = {}
+        self._tasks: dict[Hashable, asyncio.Task] = {}
+        self._wake = asyncio.Event()
+        self._flush_now = False
+
+    def submit(self, key: Hashable, *args) -> None:
+        """Запомнить новейшие аргументы для ключа и (пере)запустить отсчёт паузы."""
+        now = asyncio.get_running_loop().time()
+        p = self._pending.get(key)
+        if p is None:
+            self._pending[key] = _Pending(args, now, now)
+        else:
+            p.args, p.last, p.count = args, now, p.count + 1
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._run(key))
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    async def _run(self, key: Hashable) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while key in self._pending:
+                p = self._pending[key]
+                deadline = min(p.last + self.quiet, p.first + self.max_wait)
+                delay = deadline - loop.time()
+                if delay > 0 and not self._flush_now:
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                p = self._pending.pop(key)
+                if p.count > 1:
+                    log.info("debounce %s: %s updates coalesced into one", key, p.count)
+                try:
+                    await self._callback(*p.args)
+                except Exception:
+                    log.exception("debounced callback failed for %s", key)
+        finally:
+            self._tasks.pop(key, None)
+
+    async def drain(self) -> None:
+        """Выполнить всё отложенное без ожидания паузы (при остановке)."""
+        self._flush_now = True
+        self._wake.set()
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks.values()), return_exceptions=True)
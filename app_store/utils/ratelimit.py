@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Ограничитель запросов к Telegram Bot API — middleware сессии бота (install_rate_limit):
+через него идут все вызовы API, откуда бы они ни делались. Лимиты — свои у каждого бота.
+
+- Общий token bucket на бота (TG_GLOBAL_RPS) — с приоритетами: ожидающие получают
+  токены в порядке приоритета, затем очереди. Правки сообщений и ответы на кнопки
+  (URGENT) обгоняют обычные отправки (INTERACTIVE), а те — фоновые рассылки
+  и перескан (BACKGROUND, см. background()).
+- Bucket на чат для отправки сообщений: личные чаты — TG_CHAT_RPS в секунду,
+  группы и каналы — TG_GROUP_RPM в минуту (лимиты Telegram). Простаивающие
+  bucket-ы с полным запасом (неотличимые от нового) удаляются раз в минуту,
+  а сверх TG_CHAT_BUCKETS — вытесняются самые давние без очереди.
+- TelegramRetryAfter ставит на паузу весь лимитер, а не только упавший запрос —
+  остальные корутины тоже ждут, вместо того чтобы ловить 429 следом; запрос
+  повторяется с растущей добавкой к retry_after.
+"""
+import os
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+log = logging.getLogger("ratelimit")
+
+TG_GLOBAL_RPS = float(os.getenv("TG_GLOBAL_RPS", "25") or "25")
+TG_CHAT_RPS = float(os.getenv("TG_CHAT_RPS", "1") or "1")      # 0 — без лимита на личный чат
+TG_GROUP_RPM = float(os.getenv("TG_GROUP_RPM", "20") or "20")   # 0 — без лимита на группу/канал
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3") or "3")
+TG_CHAT_BUCKETS = int(os.getenv("TG_CHAT_BUCKETS", "10000") or "10000")
+
+_PRUNE_EVERY = 60.0
+
+URGENT, INTERACTIVE, BACKGROUND = 0, 1, 2
+
+# методы, которых покупатель ждёт прямо сейчас: крутилка на кнопке, правка экрана
+_URGENT_METHODS = {
+    "answerCallbackQuery",
+    "editMessageText",
+    "editMessageReplyMarkup",
+    "editMessageCaption",
+    "editMessageMedia",
+}
+# отправки, на которые действуют лимиты Telegram на чат
+_SEND_METHODS = {
+    "sendMessage",
+    "sendPhoto",
+    "sendDocument",
+    "sendMediaGroup",
+    "sendVideo",
+    "sendAnimation",
+    "forwardMessage",
+    "copyMessage",
+}
+
+_PRIORITY: ContextVar[int | None] = ContextVar("tg_priority", default=None)
+
+
+@contextmanager
+def background():
+    """Запросы внутри блока (и созданных в нём задач) — с приоритетом BACKGROUND"""
+    token = _PRIORITY.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _PRIORITY.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.capacity = max(1.0, burst if burst is not None else rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._pump: asyncio.Task | None = None
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float) -> None:
+        """Не выдавать токены seconds секунд, после паузы — без накопленного запаса"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+        self._updated = self._paused_until
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    async def acquire(self, priority: int = INTERACTIVE) -> None:
+        if self.rate <= 0 and self._paused_until <= time.monotonic():
+            return
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run())
+        await fut
+
+    async def _run(self) -> None:
+        """Раздаёт токены ожидающим по (приоритет, очередь)"""
+        while self._waiters:
+            if (delay := self._paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+                continue
+            if self.rate <= 0:
+                self._tokens = 1.0
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.done():  # ожидающего отменили — токен не тратим
+                continue
+            self._tokens -= 1
+            fut.set_result(None)
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def idle(self) -> bool:
+        """Никто не ждёт, паузы нет и запас полный — bucket неотличим от нового"""
+        if self._waiters or self._paused_until > time.monotonic():
+            return False
+        self._refill()
+        return self._tokens >= self.capacity
+
+
+class RateLimiter:
+    def __init__(self, rate: float = TG_GLOBAL_RPS, *, chat_rate: float = TG_CHAT_RPS,
+                 group_rpm: float = TG_GROUP_RPM, max_retries: int = TG_MAX_RETRIES,
+                 max_chats: int = TG_CHAT_BUCKETS):
+        self._global = TokenBucket(rate)
+        self.chat_rate = chat_rate
+        self.group_rpm = group_rpm
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self._chats: OrderedDict[int | str, TokenBucket] = OrderedDict()
+        self._last_prune = time.monotonic()
+        self.retry_after_hits = 0
+
+    def pause(self, seconds: float) -> None:
+        """429: пауза общего bucket-а — встают все, включая уже стоящих в очереди"""
+        self._global.pause(seconds)
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        if now - self._last_prune >= _PRUNE_EVERY:
+            self._last_prune = now
+            for chat_id in [c for c, b in self._chats.items() if b.idle()]:
+                del self._chats[chat_id]
+        if len(self._chats) >= self.max_chats:
+            # место под новый: сначала самые давние; bucket с очередью не трогаем — его ждут
+            for chat_id in [c for c, b in self._chats.items() if not b.waiting]:
+                del self._chats[chat_id]
+                if len(self._chats) < self.max_chats:
+                    break
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket | None:
+        bucket = self._chats.get(chat_id)
+        if bucket is not None:
+            self._chats.move_to_end(chat_id)
+        else:
+            # отрицательный id или @username — группа/канал
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            if is_group:
+                if self.group_rpm <= 0:
+                    return None
+                # лимит поминутный: разрешаем всю минутную квоту пачкой
+                bucket = TokenBucket(self.group_rpm / 60.0, burst=self.group_rpm)
+            else:
+                if self.chat_rate <= 0:
+                    return None
+                bucket = TokenBucket(self.chat_rate)
+            self._evict()
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def acquire(self, chat_id: int | str | None = None, *, priority: int = INTERACTIVE) -> None:
+        if chat_id is not None and (bucket := self._chat_bucket(chat_id)) is not None:
+            await bucket.acquire(priority)
+        await self._global.acquire(priority)
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Request-middleware сессии: лимит, приоритет и повтор на 429 для каждого вызова API.
+    Лимитер выбирается по боту запроса — сессию могут делить несколько ботов.
+    """
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        priority = _PRIORITY.get()
+        if priority is None:
+            priority = URGENT if name in _URGENT_METHODS else INTERACTIVE
+        chat_id = getattr(method, "chat_id", None) if name in _SEND_METHODS else None
+        lim = limiter_for(bot)
+        for attempt in range(lim.max_retries + 1):
+            await lim.acquire(chat_id, priority=priority)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                lim.retry_after_hits += 1
+                if attempt == lim.max_retries:
+                    raise
+                backoff = float(e.retry_after) + 0.5 * 2 ** attempt
+                log.warning("RetryAfter %ss on %s (chat=%s), pausing all requests for %.1fs",
+                            e.retry_after, name, chat_id, backoff)
+                lim.pause(backoff)
+
+
+_LIMITERS: dict[int, RateLimiter] = {}
+
+
+def limiter_for(bot) -> RateLimiter:
+    """Один лимитер на токен бота (лимиты Telegram считаются на бота)."""
+    lim = _LIMITERS.get(bot.id)
+    if lim is None:
+        lim = _LIMITERS[bot.id] = RateLimiter()
+    return lim
+
+
+def install_rate_limit(bot) -> RateLimiter:
+    """Подключить лимитер к сессии бота; повторный вызов (и общая сессия) ничего не добавляет"""
+    if not any(isinstance(m, RateLimitMiddleware) for m in bot.session.middleware):
+        bot.session.middleware(RateLimitMiddleware())
+    return limiter_for(bot)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Отпечатки отрисованных сообщений: LRU (бот, чат, сообщение) -> хеш текста и хеш клавиатуры.
+
+Middleware сессии бота (install_render_cache) видит все отправки и правки:
+- editMessageText с тем же текстом и клавиатурой не уходит в Telegram — сразу
+  TelegramBadRequest «message is not modified», его вызывающий код и так глотает;
+- при том же тексте и другой клавиатуре вместо него уходит editMessageReplyMarkup;
+- editMessageReplyMarkup с той же клавиатурой тоже не уходит.
+Отпечаток запоминается после успешной отправки/правки (и после настоящего
+«not modified»), сбрасывается при ошибке, удалении и прочих правках сообщения.
+
+Сообщение мог поменять не этот процесс (другая реплика бота): outer-middleware
+колбэков (RenderObserver) сверяет клавиатуру сообщения из колбэка с отпечатком
+и при расхождении забывает его.
+
+edit_screen — правка «экрана» по колбэку: текст (или только клавиатура), без
+исключения на «not modified»; если текст не правится (например, у фото) — правит клавиатуру.
+"""
+import os
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any
+
+from aiogram import BaseMiddleware
+from aiogram.client.default import Default
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import (
+    EditMessageText, EditMessageReplyMarkup, EditMessageCaption, EditMessageMedia,
+    DeleteMessage, SendMessage,
+)
+from aiogram.types import CallbackQuery, Message
+
+log = logging.getLogger("render_cache")
+
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "10000") or "0")
+
+_NOT_MODIFIED = "Bad Request: message is not modified (skipped: same content already rendered)"
+
+
+def _digest(*parts: Any) -> bytes:
+    h = hashlib.blake2b(digest_size=8)
+    for p in parts:
+        h.update(repr(p).encode())
+        h.update(b"\x00")
+    return h.digest()
+
+
+def _dump(value: Any) -> Any:
+    # Default(...) — «как у бота по умолчанию»: у sendMessage и editMessageText поля
+    # по умолчанию расходятся (link_preview_options), поэтому для отпечатка это None
+    if isinstance(value, Default):
+        return None
+    return value.model_dump_json(exclude_none=True) if hasattr(value, "model_dump_json") else value
+
+
+def markup_hash(markup) -> bytes:
+    return _digest(_dump(markup))
+
+
+def text_hash(method) -> bytes:
+    entities = [_dump(e) for e in method.entities or ()]
+    return _digest(method.text, _dump(method.parse_mode), entities,
+                   _dump(method.link_preview_options), _dump(method.disable_web_page_preview))
+
+
+class RenderCache:
+    def __init__(self, maxsize: int = RENDER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data: OrderedDict[tuple, tuple[bytes, bytes]] = OrderedDict()
+        self.skipped = 0
+        self.markup_only = 0
+
+    def get(self, key: tuple) -> tuple[bytes, bytes] | None:
+        fp = self._data.get(key)
+        if fp is not None:
+            self._data.move_to_end(key)
+        return fp
+
+    def put(self, key: tuple, text_fp: bytes, markup_fp: bytes) -> None:
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (text_fp, markup_fp)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def forget(self, key: tuple) -> None:
+        self._data.pop(key, None)
+
+    def observe(self, bot_id: int, message: Message) -> None:
+        """Сообщение в том виде, в каком его видит пользователь: разошлась клавиатура — забыть отпечаток"""
+        key = (bot_id, message.chat.id, message.message_id)
+        fp = self._data.get(key)
+        if fp is not None and fp[1] != markup_hash(message.reply_markup):
+            self.forget(key)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+RENDERED = RenderCache()
+
+
+def _key(bot, method) -> tuple | None:
+    if getattr(method, "inline_message_id", None) or method.chat_id is None or method.message_id is None:
+        return None
+    return bot.id, method.chat_id, method.message_id
+
+
+class RenderCacheMiddleware(BaseRequestMiddleware):
+    def __init__(self, cache: RenderCache = RENDERED):
+        self.cache = cache
+
+    async def __call__(self, make_request, bot, method):
+        cache = self.cache
+        if isinstance(method, SendMessage):
+            result = await make_request(bot, method)
+            if isinstance(result, Message):
+                cache.put((bot.id, result.chat.id, result.message_id), text_hash(method), markup_hash(method.reply_markup))
+            return result
+
+        if isinstance(method, (EditMessageText, EditMessageReplyMarkup)):
+            key = _key(bot, method)
+            if key is None:
+                return await make_request(bot, method)
+            known = cache.get(key)
+            new_markup = markup_hash(method.reply_markup)
+            if isinstance(method, EditMessageText):
+                new_text = text_hash(method)
+                if known == (new_text, new_markup):
+                    cache.skipped += 1
+                    raise TelegramBadRequest(method=method, message=_NOT_MODIFIED)
+                call = method
+                if known is not None and known[0] == new_text:
+                    # текст тот же — меняем только клавиатуру
+                    cache.markup_only += 1
+                    call = EditMessageReplyMarkup(chat_id=method.chat_id, message_id=method.message_id,
+                                                  reply_markup=method.reply_markup)
+            else:
+                if known is not None and known[1] == new_markup:
+                    cache.skipped += 1
+                    raise TelegramBadRequest(method=method, message=_NOT_MODIFIED)
+                new_text = known[0] if known is not None else None
+                call = method
+            try:
+                result = await make_request(bot, call)
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e) and new_text is not None:
+                    cache.put(key, new_text, new_markup)
+                else:
+                    cache.forget(key)
+                raise
+            except Exception:
+                cache.forget(key)
+                raise
+            if new_text is not None:
+                cache.put(key, new_text, new_markup)
+            else:
+                cache.forget(key)  # текст неизвестен — клавиатура одна отпечатка не даёт
+            return result
+
+        if isinstance(method, (EditMessageCaption, EditMessageMedia, DeleteMessage)):
+            key = _key(bot, method)
+            if key is not None:
+                cache.forget(key)
+        return await make_request(bot, method)
+
+
+class RenderObserver(BaseMiddleware):
+    """Outer-middleware колбэков: сверить отпечаток с сообщением, на кнопку которого нажали"""
+
+    def __init__(self, cache: RenderCache = RENDERED):
+        self.cache = cache
+
+    async def __call__(self, handler, event: CallbackQuery, data: dict[str, Any]) -> Any:
+        msg = event.message
+        if isinstance(msg, Message) and event.bot is not None:
+            self.cache.observe(event.bot.id, msg)
+        return await handler(event, data)
+
+
+def install_render_cache(bot) -> RenderCache:
+    """Подключить к сессии бота — раньше лимитера, чтобы пропущенная правка не тратила токен"""
+    if not any(isinstance(m, RenderCacheMiddleware) for m in bot.session.middleware):
+        bot.session.middleware(RenderCacheMiddleware())
+    return RENDERED
+
+
+async def edit_screen(message: Message, text: str | None = None, reply_markup=None, **kwargs: Any) -> None:
+    """
+    Перерисовать сообщение-экран: одинаковое содержимое не отправляется (см. RenderCacheMiddleware),
+    «not modified» не считается ошибкой; текст не правится — правим хотя бы клавиатуру.
+    """
+    try:
+        if text is None:
+            await message.edit_reply_markup(reply_markup=reply_markup)
+            return
+        await message.edit_text(text, reply_markup=reply_markup, **kwargs)
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            return
+        if text is None:
+            raise
+        try:
+            await message.edit_reply_markup(reply_markup=reply_markup)
+        except TelegramBadRequest as e2:
+            if "message is not modified" not in str(e2):
+                raise
@@ -1,19 +1,221 @@
-import os, time, pathlib
+# -*- coding: utf-8 -*-
+"""
+Архив сэмплов постов канала (для отладки разбора и бенчмарка app_store.parsing.bench).
+
+Запись не блокирует event loop: submit() кладёт запись в ограниченную очередь
+(при переполнении сэмпл отбрасывается и считается в dropped), фоновая задача
+пишет пачками в отдельном потоке.
+
+Формат в SAMPLES_DIR:
+  samples-000001.jsonl.gz — сегменты; каждая запись — отдельный gzip-член с одной
+                            JSON-строкой, поэтому сегмент читается и целиком (gzip.open),
+                            и точечно по смещению из индекса;
+  index.jsonl             — {"channel_id", "message_id", "ts", "segment", "offset", "length"}.
+Сегмент закрывается при SAMPLE_SEGMENT_BYTES, самые старые сегменты удаляются,
+когда архив превышает SAMPLE_ARCHIVE_MAX_BYTES.
+"""
+import os
+import json
+import time
+import gzip
+import glob
+import asyncio
+import logging
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
+log = logging.getLogger("sampling")
 
 SAMPLES_DIR = os.getenv("SAMPLES_DIR", "app_store/samples")
+SAMPLE_SEGMENT_BYTES = int(os.getenv("SAMPLE_SEGMENT_BYTES", str(8 * 1024 * 1024)) or "0")
+SAMPLE_ARCHIVE_MAX_BYTES = int(os.getenv("SAMPLE_ARCHIVE_MAX_BYTES", str(256 * 1024 * 1024)) or "0")
+SAMPLE_QUEUE_SIZE = int(os.getenv("SAMPLE_QUEUE_SIZE", "1000") or "1000")
+
+INDEX_NAME = "index.jsonl"
+_SEGMENT_GLOB = "samples-*.jsonl.gz"
+
+
+def _segment_name(seq: int) -> str:
+    return f"samples-{seq:06d}.jsonl.gz"
+
+
+def _segment_seq(name: str) -> int:
+    return int(name[len("samples-"):-len(".jsonl.gz")])
+
+
+class SampleArchive:
+    def __init__(
+        self,
+        directory: str = SAMPLES_DIR,
+        *,
+        segment_bytes: int = SAMPLE_SEGMENT_BYTES,
+        max_bytes: int = SAMPLE_ARCHIVE_MAX_BYTES,
+        queue_size: int = SAMPLE_QUEUE_SIZE,
+    ):
+        self.directory = directory
+        self.segment_bytes = max(1, segment_bytes)
+        self.max_bytes = max_bytes
+        self.queue_size = queue_size
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        # один поток: все файловые операции архива строго последовательны
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="samples")
+        self._segment: str | None = None
+        self._segment_size = 0
+        self.written = 0
+        self.dropped = 0
+
+    # --- горячий путь (event loop) ---
+    def submit(self, channel_id: int, message_id: int, title: str | None, text: str | None) -> bool:
+        """Поставить сэмпл в очередь записи. False — очередь полна, сэмпл отброшен."""
+        if self._task is None:
+            self.start()
+        try:
+            self._queue.put_nowait({
+                "channel_id": channel_id,
+                "message_id": message_id,
+                "ts": int(time.time()),
+                "title": title or "",
+                "text": text or "",
+            })
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=max(1, self.queue_size))
+        self._task = asyncio.create_task(self._writer())
+
+    async def _writer(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await loop.run_in_executor(self._executor, self._write_batch, batch)
+                self.written += len(batch)
+            except Exception:
+                log.exception("sample archive: failed to write %s samples", len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def drain(self) -> None:
+        """Дописать очередь и остановить запись (при остановке)."""
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self._executor.shutdown(wait=True)
+        log.info("sample archive drained: written=%s dropped=%s", self.written, self.dropped)
+
+    # --- запись (поток архива) ---
+    def _open_segment(self) -> None:
+        pathlib.Path(self.directory).mkdir(parents=True, exist_ok=True)
+        seqs = [_segment_seq(os.path.basename(p)) for p in glob.glob(os.path.join(self.directory, _SEGMENT_GLOB))]
+        seq = max(seqs, default=0)
+        if seq == 0 or os.path.getsize(os.path.join(self.directory, _segment_name(seq))) >= self.segment_bytes:
+            seq += 1
+        self._segment = _segment_name(seq)
+        path = os.path.join(self.directory, self._segment)
+        self._segment_size = os.path.getsize(path) if os.path.exists(path) else 0
+
+    def _write_batch(self, batch: list[dict]) -> None:
+        if self._segment is None:
+            self._open_segment()
+        index_lines = []
+        rotated = False
+        seg_file = open(os.path.join(self.directory, self._segment), "ab")
+        try:
+            for rec in batch:
+                if self._segment_size >= self.segment_bytes:
+                    seg_file.close()
+                    self._segment = _segment_name(_segment_seq(self._segment) + 1)
+                    self._segment_size = 0
+                    seg_file = open(os.path.join(self.directory, self._segment), "ab")
+                    rotated = True
+                payload = gzip.compress((json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8"))
+                seg_file.write(payload)
+                index_lines.append(json.dumps({
+                    "channel_id": rec["channel_id"],
+                    "message_id": rec["message_id"],
+                    "ts": rec["ts"],
+                    "segment": self._segment,
+                    "offset": self._segment_size,
+                    "length": len(payload),
+                }) + "\n")
+                self._segment_size += len(payload)
+        finally:
+            seg_file.close()
+        with open(os.path.join(self.directory, INDEX_NAME), "a", encoding="utf-8") as f:
+            f.writelines(index_lines)
+        if rotated:
+            self._prune()
+
+    def _prune(self) -> None:
+        """Удалить самые старые закрытые сегменты сверх max_bytes и вычистить их из индекса."""
+        if self.max_bytes <= 0:
+            return
+        segments = sorted(glob.glob(os.path.join(self.directory, _SEGMENT_GLOB)))
+        total = sum(os.path.getsize(p) for p in segments)
+        removed = set()
+        for path in segments[:-1]:  # текущий сегмент не трогаем
+            if total <= self.max_bytes:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+            removed.add(os.path.basename(path))
+        if not removed:
+            return
+        index_path = os.path.join(self.directory, INDEX_NAME)
+        tmp_path = index_path + ".tmp"
+        with open(index_path, encoding="utf-8") as src, open(tmp_path, "w", encoding="utf-8") as dst:
+            for line in src:
+                if json.loads(line).get("segment") not in removed:
+                    dst.write(line)
+        os.replace(tmp_path, index_path)
+        log.info("sample archive: removed %s old segments", len(removed))
+
+
+# --- чтение (скрипты, бенчмарк) ---
+def iter_index(directory: str = SAMPLES_DIR) -> Iterator[dict]:
+    path = os.path.join(directory, INDEX_NAME)
+    if not os.path.exists(path):
+        return
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def find_samples(channel_id: int, message_id: int, directory: str = SAMPLES_DIR) -> list[dict]:
+    """Записи индекса для поста, от старых к новым."""
+    return [e for e in iter_index(directory) if e["channel_id"] == channel_id and e["message_id"] == message_id]
+
+
+def read_sample(entry: dict, directory: str = SAMPLES_DIR) -> dict:
+    with open(os.path.join(directory, entry["segment"]), "rb") as f:
+        f.seek(entry["offset"])
+        return json.loads(gzip.decompress(f.read(entry["length"])))
+
+
+def iter_samples(directory: str = SAMPLES_DIR) -> Iterator[dict]:
+    for path in sorted(glob.glob(os.path.join(directory, _SEGMENT_GLOB))):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+
+ARCHIVE = SampleArchive()
+
 
-def save_channel_sample(channel_id: int, message_id: int, title: str|None, text: str|None):
-    pathlib.Path(SAMPLES_DIR).mkdir(parents=True, exist_ok=True)
-    ts = int(time.time())
-    base = f"{channel_id}_{message_id}_{ts}"
-    meta_path = os.path.join(SAMPLES_DIR, f"{base}.meta.txt")
-    lines_path = os.path.join(SAMPLES_DIR, f"{base}.lines.txt")
-    with open(meta_path, "w", encoding="utf-8") as f:
-        f.write(f"title: {title or ''}\n")
-        f.write(f"channel_id: {channel_id}\nmessage_id: {message_id}\n")
-    if text:
-        with open(lines_path, "w", encoding="utf-8") as f:
-            for ln in text.splitlines():
-                if ln.strip():
-                    f.write(ln.rstrip()+"\n")
-    return lines_path
+def save_channel_sample(channel_id: int, message_id: int, title: str | None, text: str | None) -> bool:
+    """Сохранить сэмпл поста в архив. Вызывать из event loop; не блокирует."""
+    return ARCHIVE.submit(channel_id, message_id, title, text)
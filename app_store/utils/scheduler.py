@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Планировщик апдейтов — outer-middleware диспетчера (dp.update.outer_middleware).
+
+Апдейты разных пользователей идут параллельно, апдейты одного пользователя
+(без пользователя — одного чата) — строго по очереди, в порядке поступления:
+двойной тап по «В корзину» не гоняет read-modify-write корзины наперегонки.
+Замок ключа живёт, пока по ключу есть хоть один апдейт, затем удаляется.
+Всего хендлеров одновременно — не больше UPDATE_MAX_IN_FLIGHT; апдейт, ждущий
+своей очереди по ключу, слот не занимает.
+"""
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Hashable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+log = logging.getLogger("scheduler")
+
+UPDATE_MAX_IN_FLIGHT = int(os.getenv("UPDATE_MAX_IN_FLIGHT", "64") or "64")
+
+
+class _KeyLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class UpdateScheduler(BaseMiddleware):
+    def __init__(self, max_in_flight: int = UPDATE_MAX_IN_FLIGHT):
+        self._slots = asyncio.Semaphore(max(1, max_in_flight))
+        self._keys: dict[Hashable, _KeyLock] = {}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    @staticmethod
+    def _key(data: dict[str, Any]) -> Hashable | None:
+        # event_from_user / event_chat кладёт UserContextMiddleware диспетчера — он стоит раньше
+        user = data.get("event_from_user")
+        if user is not None:
+            return "u", user.id
+        chat = data.get("event_chat")
+        if chat is not None:
+            return "c", chat.id
+        return None
+
+    @property
+    def active_keys(self) -> int:
+        return len(self._keys)
+
+    async def _run(self, handler, event, data) -> Any:
+        async with self._slots:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            try:
+                return await handler(event, data)
+            finally:
+                self.in_flight -= 1
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        key = self._key(data)
+        if key is None:
+            return await self._run(handler, event, data)
+
+        entry = self._keys.get(key)
+        if entry is None:
+            entry = self._keys[key] = _KeyLock()
+        entry.users += 1
+        try:
+            async with entry.lock:  # asyncio.Lock будит ожидающих по очереди (FIFO)
+                return await self._run(handler, event, data)
+        finally:
+            entry.users -= 1
+            if entry.users == 0:
+                self._keys.pop(key, None)
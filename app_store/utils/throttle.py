@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Троттлинг колбэков количества (order:qty:… / cart:qty:…) — outer-middleware
+апдейтов, стоит раньше UpdateScheduler.
+
+Тапы по «➕/➖» одного пользователя в одном сообщении схлопываются: первый тап
+обрабатывается сразу, следующие — не чаще раза в QTY_COALESCE_SEC, и из пачки,
+пришедшей за это время, выполняется только последний. Промежуточным тапам
+отвечаем answerCallbackQuery сами — без SELECT товара и без правки сообщения.
+
+Сверху — бюджет на пользователя (QTY_USER_BURST тапов сразу, дальше QTY_USER_RPS
+в секунду): исчерпан — всплывашка «подождите», в БД не идём.
+"""
+import os
+import re
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Hashable
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+log = logging.getLogger("throttle")
+
+QTY_COALESCE_SEC = float(os.getenv("QTY_COALESCE_SEC", "0.4") or "0")
+QTY_USER_BURST = float(os.getenv("QTY_USER_BURST", "8") or "0")
+QTY_USER_RPS = float(os.getenv("QTY_USER_RPS", "2") or "0")
+
+QTY_CALLBACK = re.compile(r"^(order|cart):qty:")
+
+_PRUNE_EVERY = 60.0
+
+
+class _Slot:
+    __slots__ = ("lock", "seq", "last", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.seq = 0
+        self.last = float("-inf")
+        self.users = 0
+
+
+class _Budget:
+    __slots__ = ("tokens", "stamp")
+
+    def __init__(self, tokens: float, stamp: float):
+        self.tokens = tokens
+        self.stamp = stamp
+
+
+class CallbackThrottle(BaseMiddleware):
+    def __init__(
+        self,
+        pattern: re.Pattern = QTY_CALLBACK,
+        window: float = QTY_COALESCE_SEC,
+        burst: float = QTY_USER_BURST,
+        rate: float = QTY_USER_RPS,
+    ):
+        self.pattern = pattern
+        self.window = window
+        self.burst = burst
+        self.rate = rate
+        self._slots: dict[Hashable, _Slot] = {}
+        self._budgets: dict[int, _Budget] = {}
+        self._last_prune = time.monotonic()
+        self.coalesced = 0
+        self.rejected = 0
+
+    def _prune(self, now: float) -> None:
+        # простаивающие сообщения (окно прошло) и полностью восстановившиеся бюджеты не храним
+        self._last_prune = now
+        for key in [k for k, sl in self._slots.items() if sl.users == 0 and now - sl.last >= self.window]:
+            del self._slots[key]
+        if self.rate > 0:
+            full = self.burst / self.rate
+            for uid in [u for u, b in self._budgets.items() if now - b.stamp >= full]:
+                del self._budgets[uid]
+
+    def _spend(self, user_id: int) -> bool:
+        """Списать тап из бюджета пользователя; False — бюджет исчерпан"""
+        if self.burst <= 0 or self.rate <= 0:
+            return True
+        now = time.monotonic()
+        b = self._budgets.get(user_id)
+        if b is None:
+            b = self._budgets[user_id] = _Budget(self.burst, now)
+        b.tokens = min(self.burst, b.tokens + (now - b.stamp) * self.rate)
+        b.stamp = now
+        if b.tokens < 1:
+            return False
+        b.tokens -= 1
+        return True
+
+    @staticmethod
+    async def _answer(bot, callback_id: str, text: str | None = None) -> None:
+        try:
+            await bot.answer_callback_query(callback_id, text=text)
+        except Exception as e:
+            log.debug("throttle: answer %s failed: %s", callback_id, e)
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: dict[str, Any],
+    ) -> Any:
+        cq = event.callback_query if isinstance(event, Update) else None
+        if cq is None or not cq.data or not self.pattern.match(cq.data) or cq.message is None:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        if now - self._last_prune >= _PRUNE_EVERY:
+            self._prune(now)
+        key = (cq.from_user.id, cq.message.chat.id, cq.message.message_id)
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = _Slot()
+        slot.seq += 1
+        mine = slot.seq
+        slot.users += 1
+        try:
+            async with slot.lock:
+                # пока ждали — пришёл тап новее: он и покажет итог
+                if slot.seq != mine:
+                    self.coalesced += 1
+                    await self._answer(data["bot"], cq.id)
+                    return None
+                wait = slot.last + self.window - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    if slot.seq != mine:
+                        self.coalesced += 1
+                        await self._answer(data["bot"], cq.id)
+                        return None
+                if not self._spend(cq.from_user.id):
+                    self.rejected += 1
+                    await self._answer(data["bot"], cq.id, "Слишком часто — подождите секунду")
+                    return None
+                slot.last = time.monotonic()
+                return await handler(event, data)
+        finally:
+            # слот остаётся до очистки: время последнего тапа нужно и после паузы в пачке
+            slot.users -= 1
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Запуск ботов: long polling (по умолчанию) или webhook — по BOT_MODE.
+run_bots поднимает несколько диспетчеров в одном event loop (scripts/run_all.py),
+run_bot — один. allowed_updates по умолчанию — типы апдейтов, на которые у диспетчера
+есть хендлеры: витрины не получают посты канала, которые только монитор и читает.
+
+Webhook: один aiohttp-сервер на WEBHOOK_HOST:WEBHOOK_PORT, у каждого бота свой путь —
+WEBHOOK_PATH_<NAME>, для единственного бота ещё WEBHOOK_PATH, иначе /tg/<name>;
+адрес для Telegram — WEBHOOK_BASE_URL + путь. Запросы без заголовка
+X-Telegram-Bot-Api-Secret-Token == WEBHOOK_SECRET отклоняются. По умолчанию на webhook
+отвечаем сразу, апдейт обрабатывается в фоне: долгий хендлер (/rescan) не держит запрос
+Telegram и не вызывает повторную доставку. WEBHOOK_REPLY_IN_RESPONSE=1 — ждать хендлер
+и отдать возвращённый им метод API прямо в ответе на webhook, без отдельного запроса.
+setWebhook — когда сервер уже слушает порт; при остановке у всех ботов сначала снимается
+webhook, затем дообрабатываются принятые апдейты, затем shutdown-хендлеры диспетчеров
+(дренаж очередей) и закрытие сессий.
+
+TG_API_BASE — свой адрес Bot API (локальный telegram-bot-api или scripts/fake_bot_api.py).
+make_session отдаёт одну HTTP-сессию на процесс — боты в одном процессе делят пул соединений.
+"""
+import os
+import signal
+import asyncio
+import logging
+import contextlib
+from typing import Sequence
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+log = logging.getLogger("webhook")
+
+BOT_MODE = (os.getenv("BOT_MODE", "polling") or "polling").strip().lower()
+WEBHOOK_BASE_URL = (os.getenv("WEBHOOK_BASE_URL", "") or "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080") or "8080")
+TG_API_BASE = (os.getenv("TG_API_BASE", "") or "").rstrip("/")
+WEBHOOK_REPLY_IN_RESPONSE = os.getenv("WEBHOOK_REPLY_IN_RESPONSE", "0").lower() in ("1", "true", "yes")
+
+
+_SESSION: AiohttpSession | None = None
+
+
+def make_session() -> AiohttpSession:
+    """HTTP-сессия Bot API, общая для всех ботов процесса (TG_API_BASE — свой сервер)"""
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = AiohttpSession(api=TelegramAPIServer.from_base(TG_API_BASE)) if TG_API_BASE else AiohttpSession()
+    return _SESSION
+
+
+def webhook_path(name: str, *, single: bool = True) -> str:
+    return os.getenv(f"WEBHOOK_PATH_{name.upper()}") or (WEBHOOK_PATH if single else "") or f"/tg/{name}"
+
+
+class _WebhookHandler(SimpleRequestHandler):
+    """
+    Апдейт — фоновой задачей с пустым ответом Telegram, или (reply_in_response) ждём хендлер
+    и отдаём его метод API в ответе. delete_webhook и drain — on_shutdown приложения (build_app).
+    """
+
+    def __init__(self, *, name: str, reply_in_response: bool = WEBHOOK_REPLY_IN_RESPONSE, **kwargs):
+        super().__init__(handle_in_background=not reply_in_response, **kwargs)
+        self.name = name
+
+    async def delete_webhook(self, app: web.Application | None = None) -> None:
+        # Telegram перестаёт слать апдейты, пока мы дописываем принятые и очереди
+        try:
+            await self.bot.delete_webhook()
+            log.info("🌐 webhook %s снят", self.name)
+        except Exception as e:
+            log.warning("deleteWebhook %s failed: %s", self.name, e)
+
+    async def drain(self, app: web.Application | None = None) -> None:
+        """Дождаться принятых апдейтов — они могут класть задачи в очереди диспетчера"""
+        while self._background_feed_update_tasks:
+            await asyncio.gather(*list(self._background_feed_update_tasks), return_exceptions=True)
+
+
+def _updates(dp: Dispatcher, allowed_updates: Sequence[str] | None) -> list[str]:
+    return list(allowed_updates) if allowed_updates is not None else dp.resolve_used_update_types()
+
+
+def build_app(bots: Sequence[tuple[Dispatcher, Bot, str]]) -> web.Application:
+    if not WEBHOOK_BASE_URL:
+        raise SystemExit("BOT_MODE=webhook: задайте WEBHOOK_BASE_URL (публичный https-адрес)")
+    if not WEBHOOK_SECRET:
+        raise SystemExit("BOT_MODE=webhook: задайте WEBHOOK_SECRET")
+    single = len(bots) == 1
+
+    app = web.Application()
+    handlers = [
+        _WebhookHandler(dispatcher=dp, bot=bot, name=name, secret_token=WEBHOOK_SECRET)
+        for dp, bot, name in bots
+    ]
+    # порядок важен: on_shutdown aiohttp идут по очереди в порядке добавления —
+    # снять webhook у всех ботов, дообработать принятые апдейты, затем emit_shutdown диспетчеров
+    # (setup_application) и последним закрытие сессий ботов (его добавляет handler.register())
+    for handler in handlers:
+        app.on_shutdown.append(handler.delete_webhook)
+    for handler in handlers:
+        app.on_shutdown.append(handler.drain)
+    for dp, bot, _ in bots:
+        setup_application(app, dp, bot=bot)
+    for handler in handlers:
+        handler.register(app, path=webhook_path(handler.name, single=single))
+    return app
+
+
+async def _serve_webhooks(bots, allowed: dict[str, list[str]]) -> None:
+    app = build_app(bots)
+    runner = web.AppRunner(app)
+    await runner.setup()  # on_startup приложения -> dp.emit_startup
+    try:
+        site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+        await site.start()
+        for dp, bot, name in bots:
+            url = WEBHOOK_BASE_URL + webhook_path(name, single=len(bots) == 1)
+            await bot.set_webhook(url, secret_token=WEBHOOK_SECRET, allowed_updates=allowed[name])
+            log.info("🌐 webhook %s: %s %s (слушаю %s:%s)", name, url, allowed[name], WEBHOOK_HOST, WEBHOOK_PORT)
+        await asyncio.Event().wait()
+    finally:
+        # on_shutdown приложения -> dp.emit_shutdown: deleteWebhook, дренаж очередей, закрытие сессии
+        await runner.cleanup()
+
+
+async def _poll_all(bots, allowed: dict[str, list[str]]) -> None:
+    # сигналы ловим сами: start_polling каждого диспетчера перехватил бы их у соседей
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    tasks = [
+        asyncio.create_task(dp.start_polling(bot, allowed_updates=allowed[name],
+                                             handle_signals=False, close_bot_session=False))
+        for dp, bot, name in bots
+    ]
+    stopper = asyncio.create_task(stop.wait())
+    try:
+        await asyncio.wait([stopper, *tasks], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stopper.cancel()
+        for dp, _, _ in bots:
+            with contextlib.suppress(RuntimeError):  # этот уже остановился
+                await dp.stop_polling()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for bot in {id(b): b for _, b, _ in bots}.values():
+            await bot.session.close()
+    for (_, _, name), res in zip(bots, results):
+        if isinstance(res, BaseException) and not isinstance(res, asyncio.CancelledError):
+            log.error("polling %s failed: %r", name, res)
+
+
+async def run_bots(bots: Sequence[tuple[Dispatcher, Bot, str]]) -> None:
+    """
+    Несколько (dp, bot, name) в одном event loop: polling или webhook — по BOT_MODE;
+    возвращается после остановки всех
+    """
+    allowed = {name: _updates(dp, None) for dp, _, name in bots}
+    if BOT_MODE == "webhook":
+        await _serve_webhooks(bots, allowed)
+    else:
+        await _poll_all(bots, allowed)
+
+
+async def run_bot(dp: Dispatcher, bot: Bot, *, name: str, allowed_updates: Sequence[str] | None = None) -> None:
+    """Один бот: polling или webhook — по BOT_MODE; возвращается после остановки"""
+    allowed = {name: _updates(dp, allowed_updates)}
+    if BOT_MODE == "webhook":
+        await _serve_webhooks([(dp, bot, name)], allowed)
+    else:
+        await dp.start_polling(bot, allowed_updates=allowed[name])
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Пул asyncio-воркеров с ограниченными очередями.
+Задачи с одним ключом всегда попадают к одному воркеру и выполняются в порядке поступления;
+заполненная очередь даёт backpressure — submit() ждёт свободного места.
+"""
+import time
+import asyncio
+import logging
+import zlib
+from typing import Any, Awaitable, Callable, Hashable
+
+log = logging.getLogger("workers")
+
+
+class KeyedWorkerPool:
+    def __init__(
+        self,
+        handler: Callable[..., Awaitable[Any]],
+        *,
+        workers: int = 4,
+        queue_size: int = 1000,
+        name: str = "pool",
+        metrics_interval: float = 60.0,
+    ):
+        self._handler = handler
+        self.name = name
+        self.metrics_interval = metrics_interval
+        n = max(1, workers)
+        # общий лимит queue_size делим между воркерами
+        per_worker = max(1, queue_size // n) if queue_size > 0 else 0
+        self._queues: list[asyncio.Queue] = [asyncio.Queue(maxsize=per_worker) for _ in range(n)]
+        self._tasks: list[asyncio.Task] = []
+        self._closed = False
+        # метрики
+        self.processed = 0
+        self.failed = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def _queue_for(self, key: Hashable) -> asyncio.Queue:
+        # стабильный хеш: hash() строк рандомизирован между запусками, но здесь важна лишь стабильность в процессе
+        h = zlib.crc32(repr(key).encode())
+        return self._queues[h % len(self._queues)]
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker(i, q)) for i, q in enumerate(self._queues)]
+        if self.metrics_interval > 0:
+            self._tasks.append(asyncio.create_task(self._report()))
+
+    async def submit(self, key: Hashable, *args) -> None:
+        if self._closed:
+            raise RuntimeError(f"{self.name}: pool is draining, submit rejected")
+        if not self._tasks:
+            self.start()
+        await self._queue_for(key).put((time.monotonic(), key, args))
+
+    @property
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "per_worker": [q.qsize() for q in self._queues],
+            "processed": self.processed,
+            "failed": self.failed,
+            "last_lag_sec": round(self.last_lag, 3),
+            "max_lag_sec": round(self.max_lag, 3),
+        }
+
+    async def _worker(self, idx: int, q: asyncio.Queue) -> None:
+        while True:
+            enqueued_at, key, args = await q.get()
+            lag = time.monotonic() - enqueued_at
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            try:
+                await self._handler(*args)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                log.exception("%s[%s]: handler failed for %s", self.name, idx, key)
+            finally:
+                q.task_done()
+
+    async def _report(self) -> None:
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            if self.processed or self.depth:
+                log.info("📊 %s: %s", self.name, self.stats())
+
+    async def drain(self) -> None:
+        """Перестать принимать задачи, дождаться обработки очереди и остановить воркеров."""
+        self._closed = True
+        if self._tasks:
+            await asyncio.gather(*(q.join() for q in self._queues))
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        log.info("%s drained: %s", self.name, self.stats())
@@ -12,7 +12,6 @@
 import os
 import re
 import math
-import time
 import asyncio
 import logging
 from datetime import datetime, timezone, UTC
@@ -24,6 +23,7 @@ from aiogram import Bot, Dispatcher, F, html
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.filters import Command
+from aiogram.fsm.context import FSMContext
 from aiogram.types import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -33,17 +33,44 @@ from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
 )
-from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter, TelegramBadRequest, TelegramMigrateToChat
+from aiogram.exceptions import TelegramBadRequest, TelegramMigrateToChat
 
-from sqlalchemy import select, func, text, and_, or_, update, not_
+from sqlalchemy import select, func, text, and_, or_
 
 # БД
-from app_store.db.core import Session, MonitoredPost, BotSetting, Order, BotAdmin, Cart
+from app_store.db.core import Session, MonitoredPost, BotSetting, Order, BotAdmin, Cart, init_models
 from app_store.db.repo import Product
-from app_store.db.repo import create_order
+from app_store.db.repo import create_order, product_rows, upsert_post_text, post_text_hash
+
+# Журнал цен
+from app_store.price_history import price_trends, trends_lines
+
+# Запуск: polling или webhook (BOT_MODE), свой адрес Bot API (TG_API_BASE)
+from app_store.utils.webhook import make_session, run_bot
+
+# Лимит запросов к Bot API (middleware сессии)
+from app_store.utils.ratelimit import install_rate_limit
+
+# Отпечатки отрисованных сообщений: без повторных одинаковых правок
+from app_store.utils.render_cache import install_render_cache, RenderObserver, edit_screen
+
+# Очерёдность апдейтов по пользователю
+from app_store.utils.scheduler import UpdateScheduler
+from app_store.utils.throttle import CallbackThrottle
+
+# Состояния диалогов (FSM_STORAGE: memory по умолчанию, redis/postgres — для нескольких реплик)
+from app_store.fsm import AdminEdit, make_storage
+
+# Кэши листания каталога (страницы, карточки) с подгрузкой следующей страницы
+from app_store import catalog_cache
+
+# Перескан постов
+from app_store.rescan import run_rescan, finish_status, summary as rescan_summary, RescanBusy
+from app_store.rescan import spawn_rescan, drain_rescans, last_run, run_status
+from app_store.categories import post_category
 
 # Парсинг
-from app_store.parsing.price_parser import parse_price_post
+from app_store.parsing.price_parser import parse_rows
 
 # -----------------------------------------------------------------------------
 # Инициализация
@@ -56,8 +83,18 @@ TG_TOKEN_RETAIL = os.getenv("TG_TOKEN_RETAIL")
 if not TG_TOKEN_RETAIL:
     raise SystemExit("Set TG_TOKEN_RETAIL in .env")
 
-bot = Bot(TG_TOKEN_RETAIL, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+bot = Bot(TG_TOKEN_RETAIL, session=make_session(), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+install_render_cache(bot)
+install_rate_limit(bot)
+dp = Dispatcher(storage=make_storage())
+# Тапы «➕/➖» схлопываются до очереди пользователя — иначе каждый ждал бы предыдущий
+dp.update.outer_middleware(CallbackThrottle())
+# Апдейты одного пользователя — по очереди, разных — параллельно (не больше UPDATE_MAX_IN_FLIGHT)
+dp.update.outer_middleware(UpdateScheduler())
+# Сверка отпечатков отрисованных экранов с сообщением из колбэка
+dp.callback_query.outer_middleware(RenderObserver())
+# /rescan идёт фоновой задачей: при остановке прерывается и продолжится со своего чекпоинта
+dp.shutdown.register(drain_rescans)
 
 CHANNEL_ID_STORE = int(os.getenv("CHANNEL_ID_STORE", "0") or "0")
 CHANNEL_ID_OPT = int(os.getenv("CHANNEL_ID_OPT", "0") or "0")
@@ -627,6 +664,28 @@ async def fetch_products_page(group_message_id: int, is_used: bool, page: int, p
         items = list((await s.execute(q)).scalars())
     return items, total, pages, page
 
+def _page_key(mid: int, is_used: bool, page: int, multi_message_ids=None) -> tuple:
+    return (CHANNEL_ID_STORE, mid, is_used, page, tuple(multi_message_ids or ()))
+
+async def _load_page(mid: int, is_used: bool, page: int, multi_message_ids=None):
+    """fetch_products_page + товары страницы в кэш карточек"""
+    res = await fetch_products_page(mid, is_used, page, multi_message_ids=multi_message_ids)
+    catalog_cache.remember_products(res[0])
+    return res
+
+async def cached_products_page(mid: int, is_used: bool, page: int, multi_message_ids=None):
+    """Страница из кэша (или из БД) + фоновая подгрузка следующей"""
+    items, total, pages, page = await catalog_cache.cached(
+        catalog_cache.PAGES, _page_key(mid, is_used, page, multi_message_ids),
+        lambda: _load_page(mid, is_used, page, multi_message_ids),
+    )
+    if page < pages:
+        catalog_cache.prefetch(
+            catalog_cache.PAGES, _page_key(mid, is_used, page + 1, multi_message_ids),
+            lambda: _load_page(mid, is_used, page + 1, multi_message_ids),
+        )
+    return items, total, pages, page
+
 
 @dp.callback_query(F.data.startswith("c|"))
 async def cb_category(c: CallbackQuery):
@@ -642,8 +701,10 @@ async def cb_category(c: CallbackQuery):
     except Exception:
         await c.answer("Некорректные данные", show_alert=True)
         return
+    # гасим «часики» на кнопке сразу, не дожидаясь БД и правки сообщения
+    await c.answer()
 
-    items, total, pages, page = await fetch_products_page(mid, is_used, page, multi_message_ids=multi_message_ids)
+    items, total, pages, page = await cached_products_page(mid, is_used, page, multi_message_ids)
     if not items:
         cats = await fetch_categories()
         max_row_chars = 34 if any(len(t) > 16 for t, _ in cats) else 40
@@ -656,10 +717,6 @@ async def cb_category(c: CallbackQuery):
             )
         except Exception:
             pass
-        try:
-            await c.answer("Категория пуста")
-        except Exception:
-            pass
         return
 
     # Товары в виде адаптивной сетки
@@ -738,25 +795,12 @@ async def cb_category(c: CallbackQuery):
     kb = merge_kb(grid, [bar[0], back_row])
 
     # Получаем название категории
-    category_name = await get_category_name(mid)
+    category_name = await catalog_cache.cached(catalog_cache.LABELS, (CHANNEL_ID_STORE, mid), lambda: get_category_name(mid))
     if is_used:
         category_name = f"🔧 {category_name}"
     
     caption = f"📱 <b>{category_name}</b>\n\nТоваров: {total}"
-    try:
-        await c.message.edit_text(caption, reply_markup=kb, parse_mode="HTML")
-    except TelegramBadRequest as e:
-        if "message is not modified" in str(e):
-            await c.answer()
-            return
-        try:
-            await c.message.edit_reply_markup(reply_markup=kb)
-        except TelegramBadRequest as e2:
-            if "message is not modified" in str(e2):
-                await c.answer()
-                return
-            raise
-    await c.answer()
+    await edit_screen(c.message, caption, reply_markup=kb, parse_mode="HTML")
 
 @dp.callback_query(F.data == "back")
 async def cb_back(c: CallbackQuery):
@@ -766,10 +810,7 @@ async def cb_back(c: CallbackQuery):
     cats = await fetch_categories()
     max_row_chars = 34 if any(len(t) > 16 for t, _ in cats) else 40
     kb = adaptive_kb(cats, max_per_row=2, max_row_chars=max_row_chars) if cats else adaptive_kb([("Категории не настроены", "noop")])
-    try:
-        await c.message.edit_text("Выберите категорию:", reply_markup=kb)
-    except TelegramBadRequest:
-        await c.message.edit_reply_markup(reply_markup=kb)
+    await edit_screen(c.message, "Выберите категорию:", reply_markup=kb)
     await c.answer()
 
 
@@ -788,10 +829,25 @@ async def cb_product(c: CallbackQuery):
         await c.answer("Некорректные данные", show_alert=True)
         return
 
-    async with Session() as s:
-        prod = (await s.execute(select(Product).where(Product.id == pid))).scalar_one_or_none()
+    # гасим «часики» сразу; карточка обычно уже в кэше — её подгрузил листинг
+    await c.answer()
+
+    # Формируем callback data для возврата с учетом множественных постов
+    base_cb = f"c|{mid}|{1 if is_used else 0}|{page}"
+    if multi_message_ids:
+        base_cb += f"|multi|{','.join(map(str, multi_message_ids))}"
+
+    prod = catalog_cache.PRODUCTS.get(pid)
+    if prod is None:
+        async with Session() as s:
+            prod = (await s.execute(select(Product).where(Product.id == pid))).scalar_one_or_none()
+        if prod:
+            catalog_cache.PRODUCTS.set(pid, prod)
     if not prod:
-        await c.answer("Товар не найден", show_alert=True)
+        await edit_screen(c.message, "Товар не найден — возможно, его уже сняли с продажи.",
+                          reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                              [InlineKeyboardButton(text="⬅️ Назад к списку", callback_data=base_cb)],
+                          ]))
         return
 
     price = int(prod.price_retail or 0)
@@ -812,11 +868,6 @@ async def cb_product(c: CallbackQuery):
         lines.append("Состояние: Б/У")
     text_msg = "\n".join(lines)
 
-    # Формируем callback data для возврата с учетом множественных постов
-    base_cb = f"c|{mid}|{1 if is_used else 0}|{page}"
-    if multi_message_ids:
-        base_cb += f"|multi|{','.join(map(str, multi_message_ids))}"
-
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🛒 В корзину", callback_data=f"cart:start:{prod.id}")],
         [InlineKeyboardButton(text="🧾 Оформить сейчас", callback_data=f"order:start:{prod.id}")],
@@ -826,7 +877,6 @@ async def cb_product(c: CallbackQuery):
         await c.message.edit_text(text_msg, reply_markup=kb)
     except TelegramBadRequest:
         await c.message.edit_reply_markup(reply_markup=kb)
-    await c.answer()
 
 def _qty_kb(prefix: str, pid: int, qty: int, price_each: int) -> InlineKeyboardMarkup:
     if qty < 1:
@@ -1241,157 +1291,7 @@ async def cb_cart_checkout(call: CallbackQuery):
 # -----------------------------------------------------------------------------
 # Перескан наблюдаемых постов (опт)
 # -----------------------------------------------------------------------------
-# ВАЖНО: «только /1000» — это не требование кратности, а мягкая нормализация, если цена подозрительно велика.
-PRICE_RE = re.compile(r"^\s*(?P<name>.+?)\s*[-:]\s*(?P<price>[\d\s.]{2,})(?P<rest>.*)$")
-
-def _extract_flag(text: str) -> str:
-    """Попробовать извлечь флаг (emoji-флаг страны) из строки."""
-    try:
-        flag_match = re.search(r"[\U0001F1E6-\U0001F1FF]{2}", text)
-        return flag_match.group(0) if flag_match else ""
-    except Exception:
-        return ""
-
-def parse_lines(text: str) -> List[Tuple[str, int, str]]:
-    items = []  # type: list[tuple[str, int, str]]
-    for raw in (text or "").splitlines():
-        m = PRICE_RE.match(raw)
-        if not m:
-            continue
-        name = m.group("name").strip()
-        price_str = m.group("price") or ""
-        rest = m.group("rest") or ""
-        
-        # Нормализация цены: убираем все кроме цифр и точек
-        # Обрабатываем случаи типа "5.990р" -> "5990"
-        price_clean = re.sub(r"[^\d.]", "", price_str)
-        
-        # Если есть точка, проверяем - это разделитель тысяч или копейки
-        if "." in price_clean:
-            parts = price_clean.split(".")
-            if len(parts) == 2:
-                # Если после точки 3 цифры - это разделитель тысяч (5.990)
-                if len(parts[1]) == 3:
-                    price_clean = parts[0] + parts[1]
-                # Если после точки 1-2 цифры - это копейки, игнорируем их
-                elif len(parts[1]) <= 2:
-                    price_clean = parts[0]
-                # Если после точки больше 3 цифр - это тоже разделитель тысяч (10.500)
-                else:
-                    price_clean = parts[0] + parts[1]
-            elif len(parts) > 2:
-                # Несколько точек - это разделители тысяч (1.234.567)
-                price_clean = "".join(parts)
-        
-        if not price_clean:
-            continue
-        try:
-            price = int(price_clean)
-        except Exception:
-            continue
-        if price <= 0:
-            continue
-        # защита от лишних нулей: только делим на 1000, НИКОГДА не делим на 100
-        # пример: "50000000" -> "50000", если выглядит как три лишних нуля
-        if price > 2_000_000 and price % 1000 == 0 and (price // 1000) <= 5_000_000:
-            price //= 1000
-        if price > 5_000_000:
-            continue
-        
-        # Ищем флаги в строке - может быть несколько
-        flags = []
-        # Ищем флаги в хвосте строки (после цены)
-        flag_matches = re.findall(r"[\U0001F1E6-\U0001F1FF]{2}", rest)
-        flags.extend(flag_matches)
-        # Ищем флаги в названии
-        flag_matches = re.findall(r"[\U0001F1E6-\U0001F1FF]{2}", name)
-        flags.extend(flag_matches)
-        
-        # Убираем флаги из названия для чистоты
-        clean_name = re.sub(r"[\U0001F1E6-\U0001F1FF]{2}\s*", "", name).strip()
-        
-        if flags:
-            # Создаем отдельную запись для каждого флага
-            for flag in flags:
-                items.append((clean_name, price, flag))
-        else:
-            # Если флагов нет, добавляем без флага
-            items.append((clean_name, price, ""))
-    return items
-
-def parse_used_attrs(name: str) -> dict:
-    s = (name or "").lower()
-    attrs: dict = {}
-    m = re.search(r"(\d+)\s*(?:год|года|лет|месяц|месяца|недел)", s)
-    if m:
-        attrs["usage_hint"] = m.group(0)
-    if "полный комплект" in s:
-        attrs["kit"] = "full"
-    if "без короб" in s:
-        attrs["kit"] = "no_box"
-    return attrs
-
-def norm_key(name: str, flag: str = "") -> str:
-    s = (name or "").lower()
-    s = re.sub(r"\s+", " ", s).strip()
-    # Добавляем флаг в ключ для уникальности
-    if flag:
-        s = f"{s}|{flag}"
-    return s
-
-def _now_ms() -> int:
-    return int(time.time() * 1000)
-
-async def _safe_copy_and_read_text(bot: Bot, sink_id: int, from_chat_id: int, message_id: int, *, max_retries: int = 3) -> str:
-    """
-    Получаем текст сообщения напрямую из канала без копирования.
-    """
-    delay = 0.5
-    for attempt in range(1, max_retries + 1):
-        try:
-            # Получаем сообщение напрямую из канала
-            try:
-                # Используем get_chat для получения информации о чате
-                chat = await bot.get_chat(from_chat_id)
-                log.info(f"Got chat: {chat.title}")
-                
-                # Пробуем получить сообщение через forward_message
-                forwarded = await bot.forward_message(
-                    chat_id=SINK_CHAT_ID,
-                    from_chat_id=from_chat_id,
-                    message_id=message_id,
-                    disable_notification=True
-                )
-                
-                # Получаем текст из пересланного сообщения
-                text = ""
-                if hasattr(forwarded, 'text') and forwarded.text:
-                    text = forwarded.text
-                elif hasattr(forwarded, 'caption') and forwarded.caption:
-                    text = forwarded.caption
-                
-                # Удаляем пересланное сообщение
-                try:
-                    await bot.delete_message(chat_id=sink_id, message_id=forwarded.message_id)
-                except TelegramBadRequest:
-                    pass
-                
-                log.info(f"Got text from message {message_id}: {text[:100]}...")
-                return text
-                
-            except Exception as e:
-                log.error(f"Error getting message {message_id}: {e}")
-                return ""
-            
-        except TelegramRetryAfter as e:
-            await asyncio.sleep(float(getattr(e, "retry_after", 1.0)) + 0.5)
-        except TelegramAPIError as e:
-            log.error(f"Error accessing message {message_id}: {e}")
-            if attempt == max_retries:
-                raise
-            await asyncio.sleep(delay)
-            delay = min(delay * 2, 4.0)
-    return ""
+# Разбор строк прайса — app_store.parsing.price_parser.parse_rows (общий для ботов и монитора).
 
 # Функция /rescan для розничного бота
 async def cmd_rescan(message: Message):
@@ -1404,8 +1304,21 @@ async def cmd_rescan(message: Message):
         await message.answer("❌ CHANNEL_ID_STORE не настроен.")
         return
     
-    await message.answer("🔄 <b>Начинаем перескан товаров...</b>")
-    
+    # /rescan — только изменившиеся/упавшие посты, прерванный перескан продолжается с чекпоинта
+    # /rescan full — все посты заново; /rescan force — full + переписать товары даже без изменений
+    # /rescan tg — перечитать тексты через Telegram (SINK_CHAT_ID), а не из БД
+    # /rescan status — состояние последнего запуска (перескан идёт в фоне)
+    args = (message.text or "").split()[1:]
+    if "status" in args:
+        await message.answer(run_status(await last_run(CHANNEL_ID_STORE)))
+        return
+    force = "force" in args
+    full = force or "full" in args
+    via_tg = "tg" in args
+    if via_tg and not SINK_CHAT_ID:
+        await message.answer("❌ Для /rescan tg нужен SINK_CHAT_ID в .env")
+        return
+
     try:
         # Получаем активные посты для розничного канала
         async with Session() as s:
@@ -1413,138 +1326,79 @@ async def cmd_rescan(message: Message):
                 select(MonitoredPost)
                 .where(MonitoredPost.channel_id == CHANNEL_ID_STORE)
                 .where(MonitoredPost.is_active == True)
+                .order_by(MonitoredPost.message_id)
             )).scalars().all()
         
         if not posts:
             await message.answer("❌ Нет активных постов для сканирования.")
             return
         
-        success_count = 0
-        error_count = 0
-        
-        for post in posts:
+        status = await message.answer("🔄 <b>Начинаем перескан товаров...</b>")
+
+        async def _handle(post, text):
+            if not text:
+                raise ValueError("пустой текст поста")
+            return await upsert_for_message_rescan(
+                CHANNEL_ID_STORE, 
+                post.message_id, 
+                post_category(post.channel_id, post.message_id, post.category), 
+                text, 
+                post.is_used,
+                force=force
+            )
+
+        def _version(post, text):
+            category = post_category(post.channel_id, post.message_id, post.category)
+            return post_text_hash(text, is_used=post.is_used, category=category, price_field="price_retail")
+
+        # перескан идёт в фоне: хендлер не держит очередь апдейтов админа (UpdateScheduler)
+        async def _job():
             try:
-                # Получаем текст поста
-                text = await _safe_copy_and_read_text(bot, SINK_CHAT_ID, CHANNEL_ID_STORE, post.message_id)
-                if not text:
-                    error_count += 1
-                    continue
-                
-                # Обновляем товары
-                await upsert_for_message_rescan(
-                    CHANNEL_ID_STORE, 
-                    post.message_id, 
-                    post.category or "Без категории", 
-                    text, 
-                    post.is_used
-                )
-                success_count += 1
-                
+                st = await run_rescan(bot, status, CHANNEL_ID_STORE, posts, SINK_CHAT_ID, _handle, _version, full=full, via_tg=via_tg)
+            except RescanBusy:
+                await finish_status(bot, status, "⏳ Перескан этого канала уже идёт — дождитесь его окончания.")
+                return
             except Exception as e:
-                log.error(f"Error scanning post {post.message_id}: {e}")
-                error_count += 1
-        
-        await message.answer(
-            f"✅ <b>Перескан завершен!</b>\n\n"
-            f"📊 <b>Результаты:</b>\n"
-            f"• Успешно: {success_count}\n"
-            f"• Ошибок: {error_count}\n\n"
-            f"💡 Товары обновлены в каталоге."
-        )
+                log.error(f"Error in rescan: {e}")
+                await finish_status(bot, status, f"❌ Ошибка при перескане: {e}")
+                return
+            await finish_status(
+                bot, status,
+                f"✅ <b>Перескан завершен за {st.elapsed:.0f} с!</b>\n\n"
+                f"📊 <b>Результаты:</b>\n"
+                f"• Успешно: {st.ok}\n"
+                f"• Без изменений: {st.unchanged}\n"
+                f"• Ошибок: {st.fail}\n\n"
+                f"{rescan_summary(st)}\n\n"
+                f"💡 Товары обновлены в каталоге."
+            )
+
+        spawn_rescan(_job())
         
     except Exception as e:
         log.error(f"Error in rescan: {e}")
         await message.answer(f"❌ Ошибка при перескане: {e}")
 
 
-def norm_key(name: str, flag: str = "") -> str:
-    """Нормализация ключа товара"""
-    key = name.lower().strip()
-    if flag:
-        key += f"_{flag}"
-    return key
-
-async def upsert_for_message_rescan(channel_id: int, message_id: int, category: str, text: str, is_used: bool):
+async def upsert_for_message_rescan(channel_id: int, message_id: int, category: str, text: str, is_used: bool, force: bool = False):
     """
     Мини-версия upsert логики для /rescan. Обновляет товары по одному посту.
+    Возвращает None, если содержимое поста не изменилось с прошлой записи (force=True — писать всегда).
     """
-    now = datetime.now(UTC).replace(tzinfo=None)
-    rows = parse_lines(text)
-    keys_in_post = set()
-
     async with Session() as s:
-        for name, price, flag in rows:
-            key = norm_key(name, flag)
-            keys_in_post.add(key)
-
-            prod = (await s.execute(
-                select(Product).where(
-                    and_(
-                        Product.channel_id == channel_id,
-                        Product.group_message_id == message_id,
-                        Product.key == key,
-                        Product.is_used == is_used
-                    )
-                )
-            )).scalar_one_or_none()
-
-            if not prod:
-                prod = Product(
-                    channel_id=channel_id,
-                    group_message_id=message_id,
-                    name=name[:400],
-                    key=key,
-                    category=category,
-                    available=True,
-                    is_used=is_used,
-                    extra_attrs=(
-                        {
-                            **(parse_used_attrs(name) if is_used else {}),
-                            **({"flag": flag} if flag else {})
-                        } or None
-                    ),
-                    updated_at=now
-                )
-                prod.price_retail = price
-                s.add(prod)
-            else:
-                prod.price_retail = price
-                prod.name = name[:400]
-                prod.available = True
-                if category:
-                    prod.category = category
-                prod.is_used = is_used
-                # Обновляем/дополняем extra_attrs
-                try:
-                    cur = dict(prod.extra_attrs or {})
-                except Exception:
-                    cur = {}
-                if is_used:
-                    cur.update(parse_used_attrs(name))
-                if flag:
-                    cur["flag"] = flag
-                prod.extra_attrs = cur or None
-                prod.updated_at = now
-
-        if keys_in_post:
-            await s.execute(
-                update(Product)
-                .where(
-                    and_(
-                        Product.channel_id == channel_id,
-                        Product.group_message_id == message_id,
-                        Product.is_used == is_used,
-                        not_(Product.key.in_(keys_in_post))
-                    )
-                )
-                .values(
-                    available=False,
-                    price_retail=None,
-                    updated_at=now
-                )
-            )
-
+        diff = await upsert_post_text(
+            s,
+            channel_id=channel_id,
+            message_id=message_id,
+            is_used=is_used,
+            text=text,
+            parse=lambda t: product_rows(parse_rows(t), is_used=is_used),
+            price_field="price_retail",
+            category=category,
+            force=force,
+        )
         await s.commit()
+    return diff
 
 # --- Reply-меню и обработчики текстовых кнопок ----------------
 
@@ -1777,6 +1631,12 @@ async def on_diag(m: Message):
             cat_name = cat or "Без категории"
             lines.append(f"• {cat_name}: <b>{cnt}</b> товаров")
     
+    # Тренды цен из журнала product_price_history
+    try:
+        lines.extend(trends_lines(await price_trends(CHANNEL_ID_STORE, "retail")))
+    except Exception as e:
+        log.warning(f"price trends unavailable: {e}")
+    
     # Проверка конфигурации
     lines.extend([
         "",
@@ -2409,18 +2269,14 @@ async def settings_contacts(c: CallbackQuery):
         await c.message.edit_reply_markup(reply_markup=kb)
     await c.answer()
 
-PENDING_TEMPLATE_EDIT = {}  # type: Dict[int, str]  # admin_id -> template_name
-PENDING_CONTACTS_EDIT = {}  # type: Dict[int, bool]  # admin_id -> waiting flag
-PENDING_ADMIN_ADD = {}  # type: Dict[int, bool]
-PENDING_ADMIN_REMOVE = {}  # type: Dict[int, bool]
-PENDING_CATEGORY_EDIT = {}  # type: Dict[int, dict]
+# Режимы редактирования (контакты, шаблон, админы, категория) — состояния AdminEdit в FSM-хранилище
 
 @dp.callback_query(F.data == "settings:contacts:edit")
-async def settings_contacts_edit(c: CallbackQuery):
+async def settings_contacts_edit(c: CallbackQuery, state: FSMContext):
     if not c.from_user or not await _is_manager(c.from_user.id, c.from_user.username, 'retail'):
         await c.answer("⛔ Недостаточно прав.", show_alert=True)
         return
-    PENDING_CONTACTS_EDIT[c.from_user.id] = True
+    await state.set_state(AdminEdit.contacts)
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="❌ Отмена", callback_data="settings:cancel_contacts")]
     ])
@@ -2518,7 +2374,7 @@ async def settings_template_full(c: CallbackQuery):
     await c.answer()
 
 @dp.callback_query(F.data.regexp(r"^settings:tpl_edit:(.+)$"))
-async def settings_template_edit(c: CallbackQuery):
+async def settings_template_edit(c: CallbackQuery, state: FSMContext):
     if not c.from_user or not await _is_manager(c.from_user.id, c.from_user.username, 'retail'):
         await c.answer("⛔ Недостаточно прав.", show_alert=True)
         return
@@ -2526,7 +2382,8 @@ async def settings_template_edit(c: CallbackQuery):
     if name not in DEFAULT_TEMPLATES:
         await c.answer("Неверное имя шаблона.", show_alert=True)
         return
-    PENDING_TEMPLATE_EDIT[c.from_user.id] = name
+    await state.set_state(AdminEdit.template)
+    await state.set_data({"template": name})
     # Определяем плейсхолдеры для каждого шаблона
     placeholders_by_tpl = {
         "order_received": "{product_name}, {quantity}, {price_each}, {total}, {contacts}",
@@ -2858,7 +2715,7 @@ async def on_get_tpl(m: Message):
     await m.answer(f"<b>{name}</b>\n\n<code>{html.quote(tpl)}</code>", parse_mode="HTML")
 
 @dp.message(Command("set_template"))
-async def on_set_tpl(m: Message):
+async def on_set_tpl(m: Message, state: FSMContext):
     if not m.from_user or not await _is_manager(m.from_user.id, m.from_user.username, 'retail'):
         await m.answer("⛔ Недостаточно прав.")
         return
@@ -2870,7 +2727,8 @@ async def on_set_tpl(m: Message):
     if name not in DEFAULT_TEMPLATES:
         await m.answer("Неверное имя шаблона.")
         return
-    PENDING_TEMPLATE_EDIT[m.from_user.id] = name
+    await state.set_state(AdminEdit.template)
+    await state.set_data({"template": name})
     # Определяем плейсхолдеры для каждого шаблона
     placeholders_by_tpl = {
         "order_received": "{product_name}, {quantity}, {price_each}, {total}, {contacts}",
@@ -2894,87 +2752,6 @@ async def on_set_tpl(m: Message):
     )
 
 # Универсальный обработчик перемещен в конец файла
-    uid = m.from_user.id if m.from_user else 0
-    # Не перехватываем команды — пусть обрабатываются целевыми хендлерами
-    if (m.text or "").startswith("/"):
-        return
-    
-    # Проверяем, является ли пользователь админом
-    is_admin_user = False
-    if uid in MANAGER_USER_IDS:
-        is_admin_user = True
-    else:
-        try:
-            is_admin_user = await is_admin(uid, m.from_user.username if m.from_user else None)
-        except Exception:
-            pass
-    
-    if is_admin_user:
-        # Обрабатываем только если админ в режиме редактирования
-        if uid in PENDING_CONTACTS_EDIT:
-            PENDING_CONTACTS_EDIT.pop(uid, None)
-            await set_setting("contacts", m.text)
-            await m.answer("✅ <b>Контакты успешно обновлены!</b>\n\n💡 <i>Новые контакты будут использоваться во всех сообщениях бота.</i>", parse_mode="HTML")
-            return
-        if uid in PENDING_TEMPLATE_EDIT:
-            name = PENDING_TEMPLATE_EDIT.pop(uid)
-            await set_setting(f"tpl:{name}", m.text)
-            await m.answer(f"✅ <b>Шаблон <code>{name}</code> успешно обновлён!</b>\n\n💡 <i>Новый шаблон будет использоваться для соответствующих сообщений.</i>", parse_mode="HTML")
-            return
-        if uid in PENDING_ADMIN_ADD:
-            PENDING_ADMIN_ADD.pop(uid, None)
-            username = (m.text or '').strip()
-            try:
-                ok, msg = await add_admin_by_username(username=username, full_name=None, added_by=uid)
-                await m.answer(("✅ " if ok else "⚠️ ") + msg)
-            except Exception as e:
-                await m.answer(f"❌ Ошибка добавления: {e}")
-            return
-        if uid in PENDING_ADMIN_REMOVE:
-            PENDING_ADMIN_REMOVE.pop(uid, None)
-            username = (m.text or '').strip()
-            try:
-                ok, msg = await remove_admin_by_username(username=username)
-                await m.answer(("✅ " if ok else "⚠️ ") + msg)
-            except Exception as e:
-                await m.answer(f"❌ Ошибка удаления: {e}")
-            return
-        if uid in PENDING_CATEGORY_EDIT:
-            edit_data = PENDING_CATEGORY_EDIT.pop(uid, None)
-            if edit_data:
-                new_category = (m.text or '').strip()
-                try:
-                    async with Session() as s:
-                        await s.execute(text(
-                            """
-                            UPDATE monitored_posts
-                            SET category = :cat
-                            WHERE channel_id = :cid AND message_id = :mid
-                            """
-                        ), {"cat": new_category, "cid": edit_data["channel_id"], "mid": edit_data["message_id"]})
-                        await s.commit()
-                    
-                    channel_name = "Оптовый" if edit_data["channel_type"] == "opt" else "Розничный"
-                    await m.answer(
-                        f"✅ Категория поста {edit_data['message_id']} в {channel_name} канале обновлена на: {new_category}\n\n"
-                        f"💡 Выполните /fix_categories для обновления товаров"
-                    )
-                except Exception as e:
-                    await m.answer(f"❌ Ошибка обновления категории: {e}")
-            return
-
-    # Если не админ или не в режиме редактирования, показываем каталог
-    try:
-        cats = await fetch_categories()
-        if cats:
-            max_row_chars = 34 if any(len(t) > 16 for t, _ in cats) else 40
-            kb = adaptive_kb(cats, max_per_row=2, max_row_chars=max_row_chars)
-            await m.answer("🛍️ <b>Каталог товаров</b>\n\nВыберите категорию:", reply_markup=kb, parse_mode="HTML")
-        else:
-            await m.answer("❌ Категории не настроены. Обратитесь к администратору.")
-    except Exception as e:
-        log.error(f"Error showing catalog: {e}")
-        pass
 
 @dp.callback_query(F.data == "settings:categories")
 async def settings_categories(c: CallbackQuery):
@@ -3130,7 +2907,7 @@ async def settings_categories_edit(c: CallbackQuery):
     await c.answer()
 
 @dp.callback_query(F.data.regexp(r"^settings:categories:edit:(opt|retail):(\d+)$"))
-async def settings_categories_edit_post(c: CallbackQuery):
+async def settings_categories_edit_post(c: CallbackQuery, state: FSMContext):
     """Редактирование категории конкретного поста"""
     if not c.from_user or not await _is_manager(c.from_user.id, c.from_user.username, 'retail'):
         await c.answer("⛔ Недостаточно прав.", show_alert=True)
@@ -3177,11 +2954,12 @@ async def settings_categories_edit_post(c: CallbackQuery):
     text += "💡 <i>Отправьте новую категорию в следующем сообщении</i>"
     
     # Сохраняем состояние редактирования
-    PENDING_CATEGORY_EDIT[c.from_user.id] = {
+    await state.set_state(AdminEdit.category)
+    await state.set_data({
         "channel_type": channel_type,
         "message_id": message_id,
         "channel_id": channel_id
-    }
+    })
     
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="❌ Отмена", callback_data=f"settings:categories:{channel_type}")],
@@ -3232,11 +3010,11 @@ async def settings_admins(c: CallbackQuery):
     await c.answer()
 
 @dp.callback_query(F.data == "settings:admins:add")
-async def settings_admins_add(c: CallbackQuery):
+async def settings_admins_add(c: CallbackQuery, state: FSMContext):
     if not c.from_user or not await _is_manager(c.from_user.id):
         await c.answer("⛔ Недостаточно прав.", show_alert=True)
         return
-    PENDING_ADMIN_ADD[c.from_user.id] = True
+    await state.set_state(AdminEdit.admin_add)
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="❌ Отмена", callback_data="settings:cancel_admin_add")]
     ])
@@ -3247,11 +3025,11 @@ async def settings_admins_add(c: CallbackQuery):
     await c.answer()
 
 @dp.callback_query(F.data == "settings:admins:remove")
-async def settings_admins_remove(c: CallbackQuery):
+async def settings_admins_remove(c: CallbackQuery, state: FSMContext):
     if not c.from_user or not await _is_manager(c.from_user.id):
         await c.answer("⛔ Недостаточно прав.", show_alert=True)
         return
-    PENDING_ADMIN_REMOVE[c.from_user.id] = True
+    await state.set_state(AdminEdit.admin_remove)
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="❌ Отмена", callback_data="settings:cancel_admin_remove")]
     ])
@@ -3631,7 +3409,7 @@ async def cb_noop(c: CallbackQuery):
 
 # Обработчик текстовых сообщений для редактирования настроек
 @dp.message(F.text, F.chat.type.in_({"private"}))
-async def on_possible_settings_text(m: Message):
+async def on_possible_settings_text(m: Message, state: FSMContext):
     uid = m.from_user.id if m.from_user else 0
     # Не перехватываем команды — пусть обрабатываются целевыми хендлерами
     if (m.text or "").startswith("/"):
@@ -3661,25 +3439,25 @@ async def on_possible_settings_text(m: Message):
         return
     
     # Если админ НЕ находится в режиме редактирования, не обрабатываем сообщение
-    if not (uid in PENDING_CONTACTS_EDIT or uid in PENDING_TEMPLATE_EDIT or 
-            uid in PENDING_ADMIN_ADD or uid in PENDING_ADMIN_REMOVE or 
-            uid in PENDING_CATEGORY_EDIT):
+    current = await state.get_state()
+    if current not in AdminEdit.__state_names__:
         return
+    edit_data = await state.get_data()
+    # режим одноразовый: следующее сообщение — уже обычное
+    await state.clear()
     
     if is_admin_user:
         # Обрабатываем только если админ в режиме редактирования
-        if uid in PENDING_CONTACTS_EDIT:
-            PENDING_CONTACTS_EDIT.pop(uid, None)
+        if current == AdminEdit.contacts.state:
             await set_setting("contacts", m.text)
             await m.answer("✅ <b>Контакты успешно обновлены!</b>\n\n💡 <i>Новые контакты будут использоваться во всех сообщениях бота.</i>", parse_mode="HTML")
             return
-        if uid in PENDING_TEMPLATE_EDIT:
-            name = PENDING_TEMPLATE_EDIT.pop(uid)
+        if current == AdminEdit.template.state:
+            name = edit_data.get("template")
             await set_setting(f"tpl:{name}", m.text)
             await m.answer(f"✅ <b>Шаблон <code>{name}</code> успешно обновлён!</b>\n\n💡 <i>Новый шаблон будет использоваться для соответствующих сообщений.</i>", parse_mode="HTML")
             return
-        if uid in PENDING_ADMIN_ADD:
-            PENDING_ADMIN_ADD.pop(uid, None)
+        if current == AdminEdit.admin_add.state:
             username = (m.text or '').strip()
             try:
                 ok, msg = await add_admin_by_username(username=username, full_name=None, added_by=uid)
@@ -3687,8 +3465,7 @@ async def on_possible_settings_text(m: Message):
             except Exception as e:
                 await m.answer(f"❌ Ошибка добавления: {e}")
             return
-        if uid in PENDING_ADMIN_REMOVE:
-            PENDING_ADMIN_REMOVE.pop(uid, None)
+        if current == AdminEdit.admin_remove.state:
             username = (m.text or '').strip()
             try:
                 ok, msg = await remove_admin_by_username(username=username)
@@ -3696,8 +3473,7 @@ async def on_possible_settings_text(m: Message):
             except Exception as e:
                 await m.answer(f"❌ Ошибка удаления: {e}")
             return
-        if uid in PENDING_CATEGORY_EDIT:
-            edit_data = PENDING_CATEGORY_EDIT.pop(uid, None)
+        if current == AdminEdit.category.state:
             if edit_data:
                 new_category = (m.text or '').strip()
                 try:
@@ -3776,38 +3552,38 @@ async def handle_unknown_message(m: Message):
 
 # Обработчики кнопок отмены для режимов редактирования
 @dp.callback_query(F.data == "settings:cancel_contacts")
-async def cancel_contacts_edit(c: CallbackQuery):
+async def cancel_contacts_edit(c: CallbackQuery, state: FSMContext):
     if not c.from_user or not await _is_manager(c.from_user.id, c.from_user.username, 'retail'):
         await c.answer("⛔ Недостаточно прав.", show_alert=True)
         return
-    PENDING_CONTACTS_EDIT.pop(c.from_user.id, None)
+    await state.clear()
     await c.message.edit_text("❌ Редактирование контактов отменено")
     await c.answer()
 
 @dp.callback_query(F.data == "settings:cancel_admin_add")
-async def cancel_admin_add(c: CallbackQuery):
+async def cancel_admin_add(c: CallbackQuery, state: FSMContext):
     if not c.from_user or not await _is_manager(c.from_user.id):
         await c.answer("⛔ Недостаточно прав.", show_alert=True)
         return
-    PENDING_ADMIN_ADD.pop(c.from_user.id, None)
+    await state.clear()
     await c.message.edit_text("❌ Добавление админа отменено")
     await c.answer()
 
 @dp.callback_query(F.data == "settings:cancel_admin_remove")
-async def cancel_admin_remove(c: CallbackQuery):
+async def cancel_admin_remove(c: CallbackQuery, state: FSMContext):
     if not c.from_user or not await _is_manager(c.from_user.id):
         await c.answer("⛔ Недостаточно прав.", show_alert=True)
         return
-    PENDING_ADMIN_REMOVE.pop(c.from_user.id, None)
+    await state.clear()
     await c.message.edit_text("❌ Удаление админа отменено")
     await c.answer()
 
 @dp.callback_query(F.data == "settings:cancel_template")
-async def cancel_template_edit(c: CallbackQuery):
+async def cancel_template_edit(c: CallbackQuery, state: FSMContext):
     if not c.from_user or not await _is_manager(c.from_user.id, c.from_user.username, 'retail'):
         await c.answer("⛔ Недостаточно прав.", show_alert=True)
         return
-    PENDING_TEMPLATE_EDIT.pop(c.from_user.id, None)
+    await state.clear()
     await c.message.edit_text("❌ Редактирование шаблона отменено")
     await c.answer()
 
@@ -3823,15 +3599,15 @@ async def main():
         me = await bot.get_me()
         log.info(f"✅ Бот подключен: @{me.username}")
         
+        # Таблицы и новые колонки (create_all + SCHEMA_PATCHES)
+        await init_models()
+        
         # Проверяем, что обработчики зарегистрированы
         log.info("📝 Обработчики зарегистрированы")
         
-        # Запускаем polling
-        log.info("🔄 Запускаем polling...")
-        await dp.start_polling(
-            bot,
-            allowed_updates=["message", "callback_query", "channel_post", "edited_channel_post", "my_chat_member"]
-        )
+        # Запускаем polling или webhook (BOT_MODE); allowed_updates — по зарегистрированным хендлерам
+        log.info("🔄 Запускаем приём апдейтов...")
+        await run_bot(dp, bot, name="retail")
     except Exception as e:
         log.error(f"❌ Ошибка при запуске бота: {e}")
         import traceback
@@ -14,7 +14,6 @@
 import os
 import re
 import math
-import time
 import asyncio
 import logging
 from datetime import datetime, timezone, UTC
@@ -26,6 +25,7 @@ from aiogram import Bot, Dispatcher, F, html
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.filters import Command
+from aiogram.fsm.context import FSMContext
 from aiogram.types import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -35,17 +35,47 @@ from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
 )
-from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter, TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest
 
-from sqlalchemy import select, func, text, and_, or_, update, not_
+from sqlalchemy import select, func, text, and_, or_
 
 # БД
-from app_store.db.core import Session, MonitoredPost, BotSetting, Order, BotAdmin, Cart
+from app_store.db.core import Session, MonitoredPost, BotSetting, Order, BotAdmin, Cart, init_models
 from app_store.db.repo import Product
-from app_store.db.repo import create_order
+from app_store.db.repo import create_order, product_rows, upsert_post_text, post_text_hash
+
+# Подписки на товары
+from app_store.subscriptions import is_subscribed, toggle_subscription, spawn_notify, drain_notifications
+
+# Журнал цен
+from app_store.price_history import price_trends, trends_lines, find_products, product_history, format_history
+
+# Запуск: polling или webhook (BOT_MODE), свой адрес Bot API (TG_API_BASE)
+from app_store.utils.webhook import make_session, run_bot
+
+# Лимит запросов к Bot API (middleware сессии)
+from app_store.utils.ratelimit import install_rate_limit
+
+# Отпечатки отрисованных сообщений: без повторных одинаковых правок
+from app_store.utils.render_cache import install_render_cache, RenderObserver, edit_screen
+
+# Очерёдность апдейтов по пользователю
+from app_store.utils.scheduler import UpdateScheduler
+from app_store.utils.throttle import CallbackThrottle
+
+# Состояния диалогов (FSM_STORAGE: memory по умолчанию, redis/postgres — для нескольких реплик)
+from app_store.fsm import AdminEdit, make_storage
+
+# Кэши листания каталога (страницы, карточки) с подгрузкой следующей страницы
+from app_store import catalog_cache
+
+# Перескан постов
+from app_store.rescan import run_rescan, finish_status, summary as rescan_summary, RescanBusy
+from app_store.rescan import spawn_rescan, drain_rescans, last_run, run_status
+from app_store.categories import post_category
 
 # Парсинг
-from app_store.parsing.price_parser import parse_price_post
+from app_store.parsing.price_parser import parse_rows
 
 # Система согласия на обработку ПД
 from app_store.privacy import consent_router, ConsentMiddleware, ConsentManager
@@ -61,8 +91,18 @@ TG_TOKEN_OPT = os.getenv("TG_TOKEN_OPT") or os.getenv("TG_TOKEN")
 if not TG_TOKEN_OPT:
     raise SystemExit("Set TG_TOKEN_OPT in .env")
 
-bot = Bot(TG_TOKEN_OPT, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+bot = Bot(TG_TOKEN_OPT, session=make_session(), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+install_render_cache(bot)
+install_rate_limit(bot)
+dp = Dispatcher(storage=make_storage())
+# Тапы «➕/➖» схлопываются до очереди пользователя — иначе каждый ждал бы предыдущий
+dp.update.outer_middleware(CallbackThrottle())
+# Апдейты одного пользователя — по очереди, разных — параллельно (не больше UPDATE_MAX_IN_FLIGHT)
+dp.update.outer_middleware(UpdateScheduler())
+# Сверка отпечатков отрисованных экранов с сообщением из колбэка
+dp.callback_query.outer_middleware(RenderObserver())
+# /rescan идёт фоновой задачей: при остановке прерывается и продолжится со своего чекпоинта
+dp.shutdown.register(drain_rescans)
 
 # Добавляем роутер согласия
 dp.include_router(consent_router)
@@ -844,6 +884,28 @@ async def fetch_products_page(group_message_id: int, is_used: bool, page: int, p
         items = list((await s.execute(q)).scalars())
     return items, total, pages, page
 
+def _page_key(mid: int, is_used: bool, page: int, multi_message_ids=None) -> tuple:
+    return (CHANNEL_ID_OPT, mid, is_used, page, tuple(multi_message_ids or ()))
+
+async def _load_page(mid: int, is_used: bool, page: int, multi_message_ids=None):
+    """fetch_products_page + товары страницы в кэш карточек"""
+    res = await fetch_products_page(mid, is_used, page, multi_message_ids=multi_message_ids)
+    catalog_cache.remember_products(res[0])
+    return res
+
+async def cached_products_page(mid: int, is_used: bool, page: int, multi_message_ids=None):
+    """Страница из кэша (или из БД) + фоновая подгрузка следующей"""
+    items, total, pages, page = await catalog_cache.cached(
+        catalog_cache.PAGES, _page_key(mid, is_used, page, multi_message_ids),
+        lambda: _load_page(mid, is_used, page, multi_message_ids),
+    )
+    if page < pages:
+        catalog_cache.prefetch(
+            catalog_cache.PAGES, _page_key(mid, is_used, page + 1, multi_message_ids),
+            lambda: _load_page(mid, is_used, page + 1, multi_message_ids),
+        )
+    return items, total, pages, page
+
 # @dp.callback_query(F.data == "iphone_filters")
 # async def cb_iphone_filters(c: CallbackQuery):
 #     """Обработчик для кнопки iPhone с фильтрацией"""
@@ -878,14 +940,15 @@ async def cb_category(c: CallbackQuery):
     except Exception:
         await c.answer("Некорректные данные", show_alert=True)
         return
+    # гасим «часики» на кнопке сразу, не дожидаясь БД и правки сообщения
+    await c.answer()
 
-    items, total, pages, page = await fetch_products_page(mid, is_used, page, multi_message_ids=multi_message_ids)
+    items, total, pages, page = await cached_products_page(mid, is_used, page, multi_message_ids)
     if not items:
         cats = await fetch_categories()
         max_row_chars = 34 if any(len(t) > 16 for t, _ in cats) else 40
         kb = adaptive_kb(cats, max_per_row=2, max_row_chars=max_row_chars)
         await safe_edit_message(c.message, "В этой категории сейчас нет товаров.", reply_markup=kb)
-        await c.answer()
         return
 
     # Товары в виде адаптивной сетки
@@ -964,25 +1027,12 @@ async def cb_category(c: CallbackQuery):
     kb = merge_kb(grid, [bar[0], back_row])
 
     # Получаем название категории
-    category_name = await get_category_name(mid)
+    category_name = await catalog_cache.cached(catalog_cache.LABELS, (CHANNEL_ID_OPT, mid), lambda: get_category_name(mid))
     if is_used:
         category_name = f"🔧 {category_name}"
     
     caption = f"📱 <b>{category_name}</b>\n\nТоваров: {total}"
-    try:
-        await c.message.edit_text(caption, reply_markup=kb, parse_mode="HTML")
-    except TelegramBadRequest as e:
-        if "message is not modified" in str(e):
-            await c.answer()
-            return
-        try:
-            await c.message.edit_reply_markup(reply_markup=kb)
-        except TelegramBadRequest as e2:
-            if "message is not modified" in str(e2):
-                await c.answer()
-                return
-            raise
-    await c.answer()
+    await edit_screen(c.message, caption, reply_markup=kb, parse_mode="HTML")
 
 @dp.callback_query(F.data == "back")
 async def cb_back(c: CallbackQuery):
@@ -992,10 +1042,7 @@ async def cb_back(c: CallbackQuery):
     cats = await fetch_categories()
     max_row_chars = 34 if any(len(t) > 16 for t, _ in cats) else 40
     kb = adaptive_kb(cats, max_per_row=2, max_row_chars=max_row_chars) if cats else adaptive_kb([("Категории не настроены", "noop")])
-    try:
-        await c.message.edit_text("Выберите категорию:", reply_markup=kb)
-    except TelegramBadRequest:
-        await c.message.edit_reply_markup(reply_markup=kb)
+    await edit_screen(c.message, "Выберите категорию:", reply_markup=kb)
     await c.answer()
 
 # @dp.callback_query(F.data == "back_to_filters")
@@ -1122,10 +1169,25 @@ async def cb_product(c: CallbackQuery):
         await c.answer("Некорректные данные", show_alert=True)
         return
 
-    async with Session() as s:
-        prod = (await s.execute(select(Product).where(Product.id == pid))).scalar_one_or_none()
+    # гасим «часики» сразу; карточка обычно уже в кэше — её подгрузил листинг
+    await c.answer()
+
+    # Формируем callback data для возврата с учетом множественных постов
+    base_cb = f"c|{mid}|{1 if is_used else 0}|{page}"
+    if multi_message_ids:
+        base_cb += f"|multi|{','.join(map(str, multi_message_ids))}"
+
+    prod = catalog_cache.PRODUCTS.get(pid)
+    if prod is None:
+        async with Session() as s:
+            prod = (await s.execute(select(Product).where(Product.id == pid))).scalar_one_or_none()
+        if prod:
+            catalog_cache.PRODUCTS.set(pid, prod)
     if not prod:
-        await c.answer("Товар не найден", show_alert=True)
+        await safe_edit_message(c.message, "Товар не найден — возможно, его уже сняли с продажи.",
+                                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                                    [InlineKeyboardButton(text="⬅️ Назад к списку", callback_data=base_cb)],
+                                ]))
         return
 
     price = int(prod.price_wholesale or 0)
@@ -1146,21 +1208,47 @@ async def cb_product(c: CallbackQuery):
         lines.append("Состояние: Б/У")
     text_msg = "\n".join(lines)
 
-    # Формируем callback data для возврата с учетом множественных постов
-    base_cb = f"c|{mid}|{1 if is_used else 0}|{page}"
-    if multi_message_ids:
-        base_cb += f"|multi|{','.join(map(str, multi_message_ids))}"
-
+    subscribed = await is_subscribed(c.from_user.id, prod) if c.from_user else False
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🛒 В корзину", callback_data=f"cart:start:{prod.id}")],
         [InlineKeyboardButton(text="🧾 Оформить сейчас", callback_data=f"order:start:{prod.id}")],
+        [_subscribe_button(prod.id, subscribed)],
         [InlineKeyboardButton(text="⬅️ Назад к списку", callback_data=base_cb)],
     ])
     try:
         await c.message.edit_text(text_msg, reply_markup=kb)
     except TelegramBadRequest:
         await c.message.edit_reply_markup(reply_markup=kb)
-    await c.answer()
+
+def _subscribe_button(pid: int, subscribed: bool) -> InlineKeyboardButton:
+    text_btn = "🔕 Не следить" if subscribed else "🔔 Следить"
+    return InlineKeyboardButton(text=text_btn, callback_data=f"sub:{pid}")
+
+@dp.callback_query(F.data.regexp(r"^sub:(\d+)$"))
+async def cb_subscribe_toggle(c: CallbackQuery):
+    """Подписка на снижение цены / возврат в наличие по ключу товара"""
+    pid = int(c.data.split(":")[1])
+    async with Session() as s:
+        prod = (await s.execute(select(Product).where(Product.id == pid))).scalar_one_or_none()
+    if not prod:
+        await c.answer("Товар не найден", show_alert=True)
+        return
+    subscribed = await toggle_subscription(c.from_user.id, prod)
+
+    # меняем только кнопку подписки, остальная клавиатура карточки остаётся как была
+    markup = c.message.reply_markup
+    if markup:
+        rows = [
+            [_subscribe_button(pid, subscribed) if (b.callback_data or "").startswith("sub:") else b for b in row]
+            for row in markup.inline_keyboard
+        ]
+        try:
+            await c.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
+        except TelegramBadRequest:
+            pass
+    await c.answer(
+        "🔔 Сообщим о снижении цены и поступлении" if subscribed else "🔕 Подписка отключена"
+    )
 
 def _qty_kb(prefix: str, pid: int, qty: int, price_each: int) -> InlineKeyboardMarkup:
     if qty < 1:
@@ -1593,103 +1681,7 @@ async def cb_cart_checkout(call: CallbackQuery):
 # -----------------------------------------------------------------------------
 # Перескан наблюдаемых постов (опт)
 # -----------------------------------------------------------------------------
-# ВАЖНО: «только /1000» — это не требование кратности, а мягкая нормализация, если цена подозрительно велика.
-PRICE_RE = re.compile(r"^\s*(?P<name>.+?)\s*[-:]\s*(?P<price>[\d\s.]{2,})(?P<rest>.*)$")
-
-def _extract_flag(text: str) -> str:
-    """Попробовать извлечь флаг (emoji-флаг страны) из строки."""
-    try:
-        flag_match = re.search(r"[\U0001F1E6-\U0001F1FF]{2}", text)
-        return flag_match.group(0) if flag_match else ""
-    except Exception:
-        return ""
-
-def parse_lines(text: str) -> List[Tuple[str, int, str]]:
-    items = []  # type: list[tuple[str, int, str]]
-    for raw in (text or "").splitlines():
-        m = PRICE_RE.match(raw)
-        if not m:
-            continue
-        name = m.group("name").strip()
-        price_str = m.group("price") or ""
-        rest = m.group("rest") or ""
-        
-        # Нормализация цены: убираем все кроме цифр и точек
-        # Обрабатываем случаи типа "5.990р" -> "5990"
-        price_clean = re.sub(r"[^\d.]", "", price_str)
-        
-        # Если есть точка, проверяем - это разделитель тысяч или копейки
-        if "." in price_clean:
-            parts = price_clean.split(".")
-            if len(parts) == 2:
-                # Если после точки 3 цифры - это разделитель тысяч (5.990)
-                if len(parts[1]) == 3:
-                    price_clean = parts[0] + parts[1]
-                # Если после точки 1-2 цифры - это копейки, игнорируем их
-                elif len(parts[1]) <= 2:
-                    price_clean = parts[0]
-                # Если после точки больше 3 цифр - это тоже разделитель тысяч (10.500)
-                else:
-                    price_clean = parts[0] + parts[1]
-            elif len(parts) > 2:
-                # Несколько точек - это разделители тысяч (1.234.567)
-                price_clean = "".join(parts)
-        
-        if not price_clean:
-            continue
-        try:
-            price = int(price_clean)
-        except Exception:
-            continue
-        if price <= 0:
-            continue
-        # защита от лишних нулей: только делим на 1000, НИКОГДА не делим на 100
-        # пример: "50000000" -> "50000", если выглядит как три лишних нуля
-        if price > 2_000_000 and price % 1000 == 0 and (price // 1000) <= 5_000_000:
-            price //= 1000
-        if price > 5_000_000:
-            continue
-        
-        # Ищем флаги в строке - может быть несколько
-        flags = []
-        # Ищем флаги в хвосте строки (после цены)
-        flag_matches = re.findall(r"[\U0001F1E6-\U0001F1FF]{2}", rest)
-        flags.extend(flag_matches)
-        # Ищем флаги в названии
-        flag_matches = re.findall(r"[\U0001F1E6-\U0001F1FF]{2}", name)
-        flags.extend(flag_matches)
-        
-        # Убираем флаги из названия для чистоты
-        clean_name = re.sub(r"[\U0001F1E6-\U0001F1FF]{2}\s*", "", name).strip()
-        
-        if flags:
-            # Создаем отдельную запись для каждого флага
-            for flag in flags:
-                items.append((clean_name, price, flag))
-        else:
-            # Если флагов нет, добавляем без флага
-            items.append((clean_name, price, ""))
-    return items
-
-def parse_used_attrs(name: str) -> dict:
-    s = (name or "").lower()
-    attrs: dict = {}
-    m = re.search(r"(\d+)\s*(?:год|года|лет|месяц|месяца|недел)", s)
-    if m:
-        attrs["usage_hint"] = m.group(0)
-    if "полный комплект" in s:
-        attrs["kit"] = "full"
-    if "без короб" in s:
-        attrs["kit"] = "no_box"
-    return attrs
-
-def norm_key(name: str, flag: str = "") -> str:
-    s = (name or "").lower()
-    s = re.sub(r"\s+", " ", s).strip()
-    # Добавляем флаг в ключ для уникальности
-    if flag:
-        s = f"{s}|{flag}"
-    return s
+# Разбор строк прайса — app_store.parsing.price_parser.parse_rows (общий для ботов и монитора).
 
 async def safe_edit_message(message, text=None, reply_markup=None, parse_mode=None):
     """Безопасное редактирование сообщения с обработкой ошибок"""
@@ -1706,65 +1698,32 @@ async def safe_edit_message(message, text=None, reply_markup=None, parse_mode=No
             # Другие ошибки - пробрасываем дальше
             raise
 
-def _now_ms() -> int:
-    return int(time.time() * 1000)
-
-async def _safe_copy_and_read_text(bot: Bot, sink_id: int, from_chat_id: int, message_id: int, *, max_retries: int = 3) -> str:
-    """
-    Получаем текст сообщения напрямую из канала без копирования.
-    """
-    delay = 0.5
-    for attempt in range(1, max_retries + 1):
-        try:
-            # Используем get_chat для получения информации о чате
-            chat = await bot.get_chat(from_chat_id)
-            log.info(f"Got chat: {chat.title}")
-            
-            # Пробуем получить сообщение через forward_message
-            forwarded = await bot.forward_message(
-                chat_id=sink_id,
-                from_chat_id=from_chat_id,
-                message_id=message_id,
-                disable_notification=True
-            )
-            
-            # Получаем текст из пересланного сообщения
-            text = ""
-            if hasattr(forwarded, 'text') and forwarded.text:
-                text = forwarded.text
-            elif hasattr(forwarded, 'caption') and forwarded.caption:
-                text = forwarded.caption
-            
-            # Удаляем пересланное сообщение
-            try:
-                await bot.delete_message(chat_id=sink_id, message_id=forwarded.message_id)
-            except TelegramBadRequest:
-                pass
-            
-            log.info(f"Got text from message {message_id}: {text[:100]}...")
-            return text
-            
-        except TelegramRetryAfter as e:
-            await asyncio.sleep(float(getattr(e, "retry_after", 1.0)) + 0.5)
-        except TelegramAPIError as e:
-            log.error(f"Error accessing message {message_id}: {e}")
-            if attempt == max_retries:
-                raise
-            await asyncio.sleep(delay)
-            delay = min(delay * 2, 4.0)
-    return ""
-
 @dp.message(Command("rescan"))
 async def cmd_rescan(message: Message):
     if not message.from_user or not await _is_manager(message.from_user.id, message.from_user.username, 'wholesale'):
         await message.answer("⛔ Недостаточно прав.")
         return
 
-    if not (SINK_CHAT_ID and CHANNEL_ID_OPT):
-        await message.answer("❗ Нужны SINK_CHAT_ID и CHANNEL_ID_OPT в .env")
+    if not CHANNEL_ID_OPT:
+        await message.answer("❗ Нужен CHANNEL_ID_OPT в .env")
         return
 
-    await message.answer("🔄 Перескан оптовых постов… (я буду присылать прогресс)")
+    # /rescan — только изменившиеся/упавшие посты, прерванный перескан продолжается с чекпоинта
+    # /rescan full — все посты заново; /rescan force — full + переписать товары даже без изменений
+    # /rescan tg — перечитать тексты через Telegram (SINK_CHAT_ID), а не из БД
+    # /rescan status — состояние последнего запуска (перескан идёт в фоне)
+    args = (message.text or "").split()[1:]
+    if "status" in args:
+        await message.answer(run_status(await last_run(CHANNEL_ID_OPT)))
+        return
+    force = "force" in args
+    full = force or "full" in args
+    via_tg = "tg" in args
+    if via_tg and not SINK_CHAT_ID:
+        await message.answer("❗ Для /rescan tg нужен SINK_CHAT_ID в .env")
+        return
+
+    status = await message.answer("🔄 Перескан оптовых постов…")
 
     async with Session() as s:
         posts = (await s.execute(
@@ -1774,116 +1733,54 @@ async def cmd_rescan(message: Message):
             .order_by(MonitoredPost.message_id)
         )).scalars().all()
 
-    total = len(posts)
-    done = 0
-    ok = 0
-    fail = 0
-    last_progress_ts = _now_ms()
+    async def _handle(post, text_msg):
+        category = post_category(post.channel_id, post.message_id, post.category)
+        diff = await upsert_for_message_rescan(post.channel_id, post.message_id, category, text_msg, post.is_used, force=force)
+        spawn_notify(bot, diff)
+        return diff
 
-    async def _tick():
-        await asyncio.sleep(0.2)
+    def _version(post, text_msg):
+        category = post_category(post.channel_id, post.message_id, post.category)
+        return post_text_hash(text_msg, is_used=post.is_used, category=category, price_field="price_wholesale")
 
-    for post in posts:
+    # перескан идёт в фоне: хендлер не держит очередь апдейтов админа (UpdateScheduler)
+    async def _job():
         try:
-            text_msg = await _safe_copy_and_read_text(bot, SINK_CHAT_ID, post.channel_id, post.message_id)
-            await upsert_for_message_rescan(post.channel_id, post.message_id, post.category or "", text_msg, post.is_used)
-            ok += 1
-        except Exception:
-            fail += 1
-        finally:
-            done += 1
-            await _tick()
-            now = _now_ms()
-            if now - last_progress_ts > 2500:
-                last_progress_ts = now
-                try:
-                    await message.answer(f"⏳ Прогресс: {done}/{total} (успехов: {ok}, ошибок: {fail})")
-                except Exception:
-                    pass
+            st = await run_rescan(bot, status, CHANNEL_ID_OPT, posts, SINK_CHAT_ID, _handle, _version, full=full, via_tg=via_tg)
+        except RescanBusy:
+            await finish_status(bot, status, "⏳ Перескан этого канала уже идёт — дождитесь его окончания.")
+            return
+        except Exception as e:
+            log.error(f"Error in rescan: {e}")
+            await finish_status(bot, status, f"❌ Ошибка при перескане: {e}")
+            return
+        await finish_status(
+            bot, status,
+            f"✅ Перескан завершён за {st.elapsed:.0f} с. Успехов: {st.ok} (без изменений: {st.unchanged}), ошибок: {st.fail}"
+            f"\n{rescan_summary(st)}",
+        )
 
-    await message.answer(f"✅ Перескан завершён. Успехов: {ok}, ошибок: {fail}")
+    spawn_rescan(_job())
 
-async def upsert_for_message_rescan(channel_id: int, message_id: int, category: str, text: str, is_used: bool):
+async def upsert_for_message_rescan(channel_id: int, message_id: int, category: str, text: str, is_used: bool, force: bool = False):
     """
     Мини-версия upsert логики для /rescan. Обновляет товары по одному посту.
+    Возвращает None, если содержимое поста не изменилось с прошлой записи (force=True — писать всегда).
     """
-    now = datetime.now(UTC).replace(tzinfo=None)
-    rows = parse_lines(text)
-    keys_in_post = set()
-
     async with Session() as s:
-        for name, price, flag in rows:
-            key = norm_key(name, flag)
-            keys_in_post.add(key)
-
-            prod = (await s.execute(
-                select(Product).where(
-                    and_(
-                        Product.channel_id == channel_id,
-                        Product.group_message_id == message_id,
-                        Product.key == key,
-                        Product.is_used == is_used
-                    )
-                )
-            )).scalar_one_or_none()
-
-            if not prod:
-                prod = Product(
-                    channel_id=channel_id,
-                    group_message_id=message_id,
-                    name=name[:400],
-                    key=key,
-                    category=category,
-                    available=True,
-                    is_used=is_used,
-                    extra_attrs=(
-                        {
-                            **(parse_used_attrs(name) if is_used else {}),
-                            **({"flag": flag} if flag else {})
-                        } or None
-                    ),
-                    updated_at=now
-                )
-                prod.price_wholesale = price
-                s.add(prod)
-            else:
-                prod.price_wholesale = price
-                prod.name = name[:400]
-                prod.available = True
-                if category:
-                    prod.category = category
-                prod.is_used = is_used
-                # Обновляем/дополняем extra_attrs
-                try:
-                    cur = dict(prod.extra_attrs or {})
-                except Exception:
-                    cur = {}
-                if is_used:
-                    cur.update(parse_used_attrs(name))
-                if flag:
-                    cur["flag"] = flag
-                prod.extra_attrs = cur or None
-                prod.updated_at = now
-
-        if keys_in_post:
-            await s.execute(
-                update(Product)
-                .where(
-                    and_(
-                        Product.channel_id == channel_id,
-                        Product.group_message_id == message_id,
-                        Product.is_used == is_used,
-                        not_(Product.key.in_(keys_in_post))
-                    )
-                )
-                .values(
-                    available=False,
-                    price_wholesale=None,
-                    updated_at=now
-                )
-            )
-
+        diff = await upsert_post_text(
+            s,
+            channel_id=channel_id,
+            message_id=message_id,
+            is_used=is_used,
+            text=text,
+            parse=lambda t: product_rows(parse_rows(t), is_used=is_used),
+            price_field="price_wholesale",
+            category=category,
+            force=force,
+        )
         await s.commit()
+    return diff
 
 # --- Reply-меню и обработчики текстовых кнопок ----------------
 
@@ -2149,11 +2046,9 @@ async def on_menu(m: Message):
     try:
         user_id = m.from_user.id if m.from_user else 0
         # Принудительно отправляем основное меню
-        message = await m.answer("🏠 <b>Главное меню</b>\n\nВыберите действие:", 
+        await m.answer("🏠 <b>Главное меню</b>\n\nВыберите действие:", 
                        parse_mode="HTML", 
                        reply_markup=await main_menu_kb(user_id))
-        # Сохраняем ID сообщения с главным меню
-        LAST_MAIN_MENU_MESSAGE[user_id] = message.message_id
     except Exception as e:
         log.error(f"Error sending main menu: {e}")
         await m.answer("Выберите действие:")
@@ -2184,14 +2079,12 @@ async def on_start(m: Message):
     else:
         # Показываем основное меню
         try:
-            message = await m.answer(
+            await m.answer(
                 "🏠 <b>Добро пожаловать в оптовый магазин!</b>\n\n"
                 "Выберите действие:",
                 parse_mode="HTML",
                 reply_markup=await main_menu_kb(user_id)
             )
-            # Сохраняем ID сообщения с главным меню
-            LAST_MAIN_MENU_MESSAGE[user_id] = message.message_id
         except Exception as e:
             log.error(f"Error sending main menu: {e}")
             await m.answer("Выберите действие:")
@@ -2240,9 +2133,7 @@ async def on_cart_btn(m: Message):
 @dp.message(F.text == "⬅️ Назад в меню")
 async def on_back_to_menu(m: Message):
     user_id = m.from_user.id if m.from_user else 0
-    message = await m.answer("🏠 <b>Главное меню</b>\nВыберите действие:", parse_mode="HTML", reply_markup=await main_menu_kb(user_id))
-    # Сохраняем ID сообщения с главным меню
-    LAST_MAIN_MENU_MESSAGE[user_id] = message.message_id
+    await m.answer("🏠 <b>Главное меню</b>\nВыберите действие:", parse_mode="HTML", reply_markup=await main_menu_kb(user_id))
 
 # # Обработчики фильтрации iPhone
 # @dp.message(F.text == BTN_FILTER_ALL)
@@ -3044,6 +2935,12 @@ async def on_diag(m: Message):
             cat_name = cat or "Без категории"
             lines.append(f"• {cat_name}: <b>{cnt}</b> товаров")
     
+    # Тренды цен из журнала product_price_history
+    try:
+        lines.extend(trends_lines(await price_trends(CHANNEL_ID_OPT, "wholesale")))
+    except Exception as e:
+        log.warning(f"price trends unavailable: {e}")
+    
     # Проверка конфигурации
     lines.extend([
         "",
@@ -3079,6 +2976,27 @@ async def on_diag(m: Message):
     
     await m.answer("\n".join(lines), parse_mode="HTML", reply_markup=await main_menu_kb(m.from_user.id if m.from_user else 0))
 
+@dp.message(Command("price_history"))
+async def cmd_price_history(m: Message):
+    """/price_history <id или часть названия> — изменения цены товара за PRICE_HISTORY_DAYS дней."""
+    if not m.from_user or not await _is_manager(m.from_user.id, m.from_user.username, 'wholesale'):
+        await m.answer("⛔ Недостаточно прав.")
+        return
+    query = (m.text or "").partition(" ")[2].strip()
+    if not query:
+        await m.answer("Использование: <code>/price_history &lt;id или часть названия&gt;</code>", parse_mode="HTML")
+        return
+    products = await find_products(CHANNEL_ID_OPT, query)
+    if not products:
+        await m.answer("❌ Товар не найден.")
+        return
+    if len(products) > 1 and not query.isdigit():
+        variants = "\n".join(f"• <code>/price_history {p.id}</code> — {html.quote(p.name)}" for p in products)
+        await m.answer(f"Найдено несколько товаров:\n{variants}", parse_mode="HTML")
+        return
+    product = products[0]
+    await m.answer(format_history(product, await product_history(product, "wholesale")), parse_mode="HTML")
+
 @dp.message(Command("fix_categories"))
 async def cmd_fix_categories(m: Message):
     """Админ-команда: пересинхронизировать категории товаров из monitored_posts по message_id."""
@@ -3683,36 +3601,27 @@ async def settings_contacts(c: CallbackQuery):
         await c.message.edit_reply_markup(reply_markup=kb)
     await c.answer()
 
-PENDING_TEMPLATE_EDIT = {}  # type: Dict[int, str]  # admin_id -> template_name
-PENDING_CONTACTS_EDIT = {}  # type: Dict[int, bool]  # admin_id -> waiting flag
-PENDING_ADMIN_ADD = {}  # type: Dict[int, bool]
-PENDING_ADMIN_REMOVE = {}  # type: Dict[int, bool]
-PENDING_CATEGORY_EDIT = {}  # type: Dict[int, dict]
-
-# Кэш для хранения ID последнего сообщения с главным меню для каждого пользователя
-LAST_MAIN_MENU_MESSAGE = {}  # user_id -> message_id
+# Режимы редактирования (контакты, шаблон, админы, категория) — состояния AdminEdit в FSM-хранилище
 
 async def update_main_menu_for_user(user_id: int, bot: Bot):
     """Обновляет главное меню для пользователя с актуальным количеством товаров в корзине"""
     try:
         # Отправляем новое сообщение с обновленным главным меню
-        message = await bot.send_message(
+        await bot.send_message(
             chat_id=user_id,
             text="🏠 <b>Главное меню</b>\nВыберите действие:",
             parse_mode="HTML",
             reply_markup=await main_menu_kb(user_id)
         )
-        # Обновляем ID последнего сообщения
-        LAST_MAIN_MENU_MESSAGE[user_id] = message.message_id
     except Exception as e:
         log.error(f"Error updating main menu for user {user_id}: {e}")
 
 @dp.callback_query(F.data == "settings:contacts:edit")
-async def settings_contacts_edit(c: CallbackQuery):
+async def settings_contacts_edit(c: CallbackQuery, state: FSMContext):
     if not c.from_user or not await _is_manager(c.from_user.id, c.from_user.username, 'wholesale'):
         await c.answer("⛔ Недостаточно прав.", show_alert=True)
         return
-    PENDING_CONTACTS_EDIT[c.from_user.id] = True
+    await state.set_state(AdminEdit.contacts)
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="❌ Отмена", callback_data="settings:cancel_contacts")]
     ])
@@ -3818,7 +3727,7 @@ async def settings_template_full(c: CallbackQuery):
     await c.answer()
 
 @dp.callback_query(F.data.regexp(r"^settings:tpl_edit:(.+)$"))
-async def settings_template_edit(c: CallbackQuery):
+async def settings_template_edit(c: CallbackQuery, state: FSMContext):
     if not c.from_user or not await _is_manager(c.from_user.id, c.from_user.username, 'wholesale'):
         await c.answer("⛔ Недостаточно прав.", show_alert=True)
         return
@@ -3826,7 +3735,8 @@ async def settings_template_edit(c: CallbackQuery):
     if name not in DEFAULT_TEMPLATES:
         await c.answer("Неверное имя шаблона.", show_alert=True)
         return
-    PENDING_TEMPLATE_EDIT[c.from_user.id] = name
+    await state.set_state(AdminEdit.template)
+    await state.set_data({"template": name})
     placeholders_by_tpl = {
         "order_received": "{product_name}, {quantity}, {price_each}, {total}, {contacts}",
         "order_approved": "{product_name}, {quantity}, {price_each}, {total}, {address}, {contacts}",
@@ -4156,7 +4066,7 @@ async def on_get_tpl(m: Message):
     await m.answer(f"<b>{name}</b>\n\n<code>{html.quote(tpl)}</code>", parse_mode="HTML")
 
 @dp.message(Command("set_template"))
-async def on_set_tpl(m: Message):
+async def on_set_tpl(m: Message, state: FSMContext):
     if not m.from_user or not await _is_manager(m.from_user.id, m.from_user.username, 'wholesale'):
         await m.answer("⛔ Недостаточно прав.")
         return
@@ -4168,7 +4078,8 @@ async def on_set_tpl(m: Message):
     if name not in DEFAULT_TEMPLATES:
         await m.answer("Неверное имя шаблона.")
         return
-    PENDING_TEMPLATE_EDIT[m.from_user.id] = name
+    await state.set_state(AdminEdit.template)
+    await state.set_data({"template": name})
     await m.answer(
         f"Ок. Пришлите <b>следующим сообщением</b> новый текст шаблона <code>{name}</code>.\n\n"
         "📝 <b>Доступные плейсхолдеры:</b> {product_name}, {quantity}, {price_each}, {total}, {user_id}, {username}, {contacts}\n\n"
@@ -4338,7 +4249,7 @@ async def settings_categories_edit(c: CallbackQuery):
     await c.answer()
 
 @dp.callback_query(F.data.regexp(r"^settings:categories:edit:(opt|retail):(\d+)$"))
-async def settings_categories_edit_post(c: CallbackQuery):
+async def settings_categories_edit_post(c: CallbackQuery, state: FSMContext):
     """Редактирование категории конкретного поста"""
     if not c.from_user or not await _is_manager(c.from_user.id, c.from_user.username, 'wholesale'):
         await c.answer("⛔ Недостаточно прав.", show_alert=True)
@@ -4385,11 +4296,12 @@ async def settings_categories_edit_post(c: CallbackQuery):
     text += "💡 <i>Отправьте новую категорию в следующем сообщении</i>"
     
     # Сохраняем состояние редактирования
-    PENDING_CATEGORY_EDIT[c.from_user.id] = {
+    await state.set_state(AdminEdit.category)
+    await state.set_data({
         "channel_type": channel_type,
         "message_id": message_id,
         "channel_id": channel_id
-    }
+    })
     
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="❌ Отмена", callback_data=f"settings:categories:{channel_type}")],
@@ -4440,11 +4352,11 @@ async def settings_admins(c: CallbackQuery):
     await c.answer()
 
 @dp.callback_query(F.data == "settings:admins:add")
-async def settings_admins_add(c: CallbackQuery):
+async def settings_admins_add(c: CallbackQuery, state: FSMContext):
     if not c.from_user or not await _is_manager(c.from_user.id):
         await c.answer("⛔ Недостаточно прав.", show_alert=True)
         return
-    PENDING_ADMIN_ADD[c.from_user.id] = True
+    await state.set_state(AdminEdit.admin_add)
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="❌ Отмена", callback_data="settings:cancel_admin_add")]
     ])
@@ -4455,11 +4367,11 @@ async def settings_admins_add(c: CallbackQuery):
     await c.answer()
 
 @dp.callback_query(F.data == "settings:admins:remove")
-async def settings_admins_remove(c: CallbackQuery):
+async def settings_admins_remove(c: CallbackQuery, state: FSMContext):
     if not c.from_user or not await _is_manager(c.from_user.id):
         await c.answer("⛔ Недостаточно прав.", show_alert=True)
         return
-    PENDING_ADMIN_REMOVE[c.from_user.id] = True
+    await state.set_state(AdminEdit.admin_remove)
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="❌ Отмена", callback_data="settings:cancel_admin_remove")]
     ])
@@ -5087,7 +4999,7 @@ async def cb_noop(c: CallbackQuery):
 # -----------------------------------------------------------------------------
 # Широкий обработчик для текстовых сообщений (должен быть в конце)
 @dp.message(F.text, F.chat.type.in_({"private"}))
-async def on_possible_settings_text(m: Message):
+async def on_possible_settings_text(m: Message, state: FSMContext):
     uid = m.from_user.id if m.from_user else 0
     
     # Не перехватываем команды — пусть обрабатываются целевыми хендлерами
@@ -5118,25 +5030,25 @@ async def on_possible_settings_text(m: Message):
         return
     
     # Если админ НЕ находится в режиме редактирования, не обрабатываем сообщение
-    if not (uid in PENDING_CONTACTS_EDIT or uid in PENDING_TEMPLATE_EDIT or 
-            uid in PENDING_ADMIN_ADD or uid in PENDING_ADMIN_REMOVE or 
-            uid in PENDING_CATEGORY_EDIT):
+    current = await state.get_state()
+    if current not in AdminEdit.__state_names__:
         return
+    edit_data = await state.get_data()
+    # режим одноразовый: следующее сообщение — уже обычное
+    await state.clear()
     
     if is_admin_user:
         # Обрабатываем только если админ в режиме редактирования
-        if uid in PENDING_CONTACTS_EDIT:
-            PENDING_CONTACTS_EDIT.pop(uid, None)
+        if current == AdminEdit.contacts.state:
             await set_setting("contacts", m.text)
             await m.answer("✅ <b>Контакты успешно обновлены!</b>\n\n💡 <i>Новые контакты будут использоваться во всех сообщениях бота.</i>", parse_mode="HTML")
             return
-        if uid in PENDING_TEMPLATE_EDIT:
-            name = PENDING_TEMPLATE_EDIT.pop(uid)
+        if current == AdminEdit.template.state:
+            name = edit_data.get("template")
             await set_setting(f"tpl:{name}", m.text)
             await m.answer(f"✅ <b>Шаблон <code>{name}</code> успешно обновлён!</b>\n\n💡 <i>Новый шаблон будет использоваться для соответствующих сообщений.</i>", parse_mode="HTML")
             return
-        if uid in PENDING_ADMIN_ADD:
-            PENDING_ADMIN_ADD.pop(uid, None)
+        if current == AdminEdit.admin_add.state:
             username = (m.text or '').strip()
             try:
                 ok, msg = await add_admin_by_username(username=username, full_name=None, added_by=uid)
@@ -5144,8 +5056,7 @@ async def on_possible_settings_text(m: Message):
             except Exception as e:
                 await m.answer(f"❌ Ошибка добавления: {e}")
             return
-        if uid in PENDING_ADMIN_REMOVE:
-            PENDING_ADMIN_REMOVE.pop(uid, None)
+        if current == AdminEdit.admin_remove.state:
             username = (m.text or '').strip()
             try:
                 ok, msg = await remove_admin_by_username(username=username)
@@ -5153,8 +5064,7 @@ async def on_possible_settings_text(m: Message):
             except Exception as e:
                 await m.answer(f"❌ Ошибка удаления: {e}")
             return
-        if uid in PENDING_CATEGORY_EDIT:
-            edit_data = PENDING_CATEGORY_EDIT.pop(uid, None)
+        if current == AdminEdit.category.state:
             if edit_data:
                 new_category = (m.text or '').strip()
                 try:
@@ -5192,38 +5102,38 @@ async def on_possible_settings_text(m: Message):
 
 # Обработчики кнопок отмены для режимов редактирования
 @dp.callback_query(F.data == "settings:cancel_contacts")
-async def cancel_contacts_edit(c: CallbackQuery):
+async def cancel_contacts_edit(c: CallbackQuery, state: FSMContext):
     if not c.from_user or not await _is_manager(c.from_user.id, c.from_user.username, 'wholesale'):
         await c.answer("⛔ Недостаточно прав.", show_alert=True)
         return
-    PENDING_CONTACTS_EDIT.pop(c.from_user.id, None)
+    await state.clear()
     await c.message.edit_text("❌ Редактирование контактов отменено")
     await c.answer()
 
 @dp.callback_query(F.data == "settings:cancel_template")
-async def cancel_template_edit(c: CallbackQuery):
+async def cancel_template_edit(c: CallbackQuery, state: FSMContext):
     if not c.from_user or not await _is_manager(c.from_user.id, c.from_user.username, 'wholesale'):
         await c.answer("⛔ Недостаточно прав.", show_alert=True)
         return
-    PENDING_TEMPLATE_EDIT.pop(c.from_user.id, None)
+    await state.clear()
     await c.message.edit_text("❌ Редактирование шаблона отменено")
     await c.answer()
 
 @dp.callback_query(F.data == "settings:cancel_admin_add")
-async def cancel_admin_add(c: CallbackQuery):
+async def cancel_admin_add(c: CallbackQuery, state: FSMContext):
     if not c.from_user or not await _is_manager(c.from_user.id):
         await c.answer("⛔ Недостаточно прав.", show_alert=True)
         return
-    PENDING_ADMIN_ADD.pop(c.from_user.id, None)
+    await state.clear()
     await c.message.edit_text("❌ Добавление админа отменено")
     await c.answer()
 
 @dp.callback_query(F.data == "settings:cancel_admin_remove")
-async def cancel_admin_remove(c: CallbackQuery):
+async def cancel_admin_remove(c: CallbackQuery, state: FSMContext):
     if not c.from_user or not await _is_manager(c.from_user.id):
         await c.answer("⛔ Недостаточно прав.", show_alert=True)
         return
-    PENDING_ADMIN_REMOVE.pop(c.from_user.id, None)
+    await state.clear()
     await c.message.edit_text("❌ Удаление админа отменено")
     await c.answer()
 
@@ -5271,11 +5181,14 @@ async def main():
         me = await bot.get_me()
         log.info(f"✅ Бот подключен: @{me.username}")
         
-        # Запускаем polling
-        await dp.start_polling(
-            bot,
-            allowed_updates=["message", "callback_query", "channel_post", "edited_channel_post", "my_chat_member"]
-        )
+        # Таблицы и новые колонки (create_all + SCHEMA_PATCHES)
+        await init_models()
+        
+        # рассылки подписчикам, начатые /rescan, дослать до закрытия сессии
+        dp.shutdown.register(drain_notifications)
+
+        # Запускаем polling или webhook (BOT_MODE); allowed_updates — по зарегистрированным хендлерам
+        await run_bot(dp, bot, name="wholesale")
     except Exception as e:
         log.error(f"❌ Ошибка при запуске бота: {e}")
         import traceback
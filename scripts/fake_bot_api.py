@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Локальный фейковый Bot API для проверки webhook-режима без Telegram.
+
+    python scripts/fake_bot_api.py --port 8081
+    TG_API_BASE=http://127.0.0.1:8081 BOT_MODE=webhook WEBHOOK_BASE_URL=http://127.0.0.1:8080 \
+        WEBHOOK_SECRET=test python bot_wholesale.py
+    curl -X POST 'http://127.0.0.1:8081/_push?chat_id=1&text=/start'
+
+Отвечает на /bot<token>/<method> заготовками (getMe, setWebhook, deleteWebhook,
+sendMessage, ...), пишет вызовы в лог. setWebhook запоминает url и secret_token бота;
+/_push отправляет на него апдейт-сообщение с заголовком секрета и печатает ответ
+webhook'а (пустой — апдейт обрабатывается в фоне; с WEBHOOK_REPLY_IN_RESPONSE=1 — метод API,
+возвращённый хендлером); ?token= — какому боту, по умолчанию последнему, поставившему
+webhook. /_calls — журнал вызовов.
+"""
+import argparse
+import itertools
+import json
+import logging
+import time
+
+from aiohttp import web, ClientSession
+
+log = logging.getLogger("fake_bot_api")
+
+_ids = itertools.count(1000)
+STATE = {"hooks": {}, "last": "", "calls": []}  # hooks: token -> (url, secret)
+
+
+def _message(chat_id, text: str = "", **extra) -> dict:
+    return {
+        "message_id": next(_ids),
+        "date": int(time.time()),
+        "chat": {"id": int(chat_id or 0), "type": "private"},
+        "text": text,
+        **extra,
+    }
+
+
+def _result(token: str, method: str, params: dict):
+    m = method.lower()
+    if m == "getme":
+        return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+    if m in ("sendmessage", "forwardmessage", "copymessage", "editmessagetext"):
+        return _message(params.get("chat_id"), params.get("text", ""))
+    if m == "getupdates":
+        return []
+    if m == "getwebhookinfo":
+        url = STATE["hooks"].get(token, ("", ""))[0]
+        return {"url": url, "has_custom_certificate": False, "pending_update_count": 0}
+    return True
+
+
+async def _params(request: web.Request) -> dict:
+    if request.content_type == "application/json":
+        return await request.json()
+    data = await request.post()
+    out = {}
+    for k, v in data.items():
+        try:
+            out[k] = json.loads(v) if isinstance(v, str) and v[:1] in "[{" else v
+        except ValueError:
+            out[k] = v
+    return out
+
+
+async def api(request: web.Request) -> web.Response:
+    token, method = request.match_info["token"], request.match_info["method"]
+    params = await _params(request)
+    STATE["calls"].append({"token": token, "method": method, "params": params})
+    log.info("%s %s %s", token.split(":")[0], method, params)
+    if method.lower() == "setwebhook":
+        STATE["hooks"][token] = (params.get("url", ""), params.get("secret_token", ""))
+        STATE["last"] = token
+    elif method.lower() == "deletewebhook":
+        STATE["hooks"].pop(token, None)
+    return web.json_response({"ok": True, "result": _result(token, method, params)})
+
+
+async def push(request: web.Request) -> web.Response:
+    hook = STATE["hooks"].get(request.query.get("token", STATE["last"]))
+    if hook is None:
+        return web.json_response({"ok": False, "error": "webhook не установлен"}, status=409)
+    url, secret = hook
+    chat_id = int(request.query.get("chat_id", "1"))
+    msg = _message(chat_id, request.query.get("text", "/start"),
+                   **{"from": {"id": chat_id, "is_bot": False, "first_name": "Test"}})
+    update = {"update_id": next(_ids), "message": msg}
+    secret = request.query.get("secret", secret)
+    async with ClientSession() as http:
+        async with http.post(url, json=update,
+                             headers={"X-Telegram-Bot-Api-Secret-Token": secret}) as r:
+            body = await r.text()
+            log.info("webhook -> %s %s", r.status, body)
+            return web.json_response({"status": r.status, "body": body})
+
+
+async def calls(request: web.Request) -> web.Response:
+    return web.json_response(STATE["calls"])
+
+
+def make_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api)
+    app.router.add_post("/_push", push)
+    app.router.add_get("/_calls", calls)
+    return app
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Фейковый Bot API для webhook-режима")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(make_app(), host=args.host, port=args.port)
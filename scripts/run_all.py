@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Общий запуск: розничный бот, оптовый бот и монитор каналов в одном процессе и event loop.
+
+Один движок SQLAlchemy и пул соединений (app_store.db.core), одна HTTP-сессия Bot API
+(app_store.utils.webhook.make_session) и общие кэши модулей app_store — вместо трёх копий.
+allowed_updates у каждого бота свои — по его хендлерам: посты канала получает только
+оптовый бот, на диспетчере которого висит монитор.
+
+    python scripts/run_all.py             # polling обоих ботов
+    BOT_MODE=webhook python scripts/run_all.py   # один порт, пути /tg/wholesale и /tg/retail
+
+По отдельности боты и монитор запускаются как раньше: bot_retail2.py, bot_wholesale.py,
+scripts/run_opt_with_monitor.py.
+"""
+import os
+import sys
+import asyncio
+import logging
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app_store.db.core import init_models
+from app_store.utils.webhook import run_bots
+
+# монитор сам импортирует bot_wholesale и регистрирует хендлеры каналов на его диспетчере
+from run_opt_with_monitor import dp_opt, bot_opt, start_monitor
+import bot_retail2
+
+log = logging.getLogger("run_all")
+
+
+async def main():
+    try:
+        for name, b in (("wholesale", bot_opt), ("retail", bot_retail2.bot)):
+            me = await b.get_me()
+            log.info("✅ %s: @%s", name, me.username)
+
+        # Таблицы и новые колонки (create_all + SCHEMA_PATCHES) — один раз на процесс
+        await init_models()
+        if not await start_monitor():
+            log.warning("⚠️ Монитор не запущен — работают только витрины")
+
+        await run_bots([
+            (dp_opt, bot_opt, "wholesale"),
+            (bot_retail2.dp, bot_retail2.bot, "retail"),
+        ])
+    finally:
+        # сессия общая — закрытие идемпотентно
+        await bot_opt.session.close()
+        await bot_retail2.bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,7 +1,5 @@
 # -*- coding: utf-8 -*-
-import os, re, asyncio, logging, json, json, sys
-from datetime import datetime, timezone, UTC
-from typing import List, Tuple
+import os, re, asyncio, logging, sys
 
 # Добавляем родительскую директорию в путь для импорта
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -10,13 +8,20 @@ from dotenv import load_dotenv
 from aiogram.enums import ChatType
 from aiogram.types import Message
 
-from sqlalchemy import select, update, and_, not_
-
 # берём готовый оптовый бот (dp, bot) и его маршруты
-from bot_wholesale import dp as dp_opt, bot as bot_opt, get_monitored_message_ids, get_master_message_id
-
-from app_store.db.core import Session, MonitoredPost
-from app_store.db.core import Product, ChannelMessage
+from bot_wholesale import dp as dp_opt, bot as bot_opt
+
+from app_store.db.core import Session, init_models, ensure_price_history_partitions
+from app_store.db.repo import product_rows, upsert_post_text
+from app_store.parsing.price_parser import parse_rows
+from app_store.db.watch import WatchRegistry
+from app_store.subscriptions import spawn_notify, drain_notifications
+from app_store.utils.debounce import KeyedDebouncer
+from app_store.utils.workers import KeyedWorkerPool
+from app_store.utils.sampling import ARCHIVE as SAMPLES, save_channel_sample
+from app_store.utils.webhook import run_bot
+from app_store import catalog_cache
+from app_store.categories import post_category
 
 log = logging.getLogger("opt+monitor")
 logging.basicConfig(level=logging.INFO)
@@ -39,316 +44,169 @@ def _csv_to_ids(val):
 CHANNEL_ID_STORE = int(os.getenv("CHANNEL_ID_STORE", "0") or "0")
 CHANNEL_ID_OPT   = int(os.getenv("CHANNEL_ID_OPT",   "0") or "0")
 
-# Списки постов Б/У (пока оставляем из .env)
-USED_STORE = _csv_to_ids(os.getenv("USED_MESSAGE_IDS_STORE", ""))
-USED_OPT   = _csv_to_ids(os.getenv("USED_MESSAGE_IDS_OPT",   ""))
-
-WATCH = {}
-
-# --- category mapping from JSON buttons (both store & wholesale) ---
-def _walk_buttons_to_map(obj, stack, acc):
-    if isinstance(obj, dict):
-        text = (obj.get("text") or obj.get("title") or "").strip()
-        link = obj.get("link") or obj.get("url") or ""
-        if text:
-            stack.append(text)
-        m = re.search(r'/c/-?\d+/(\d+)$', link) or re.search(r'/(\d+)$', link)
-        if m:
-            mid = int(m.group(1))
-            # category path: "Parent / Child / Leaf"
-            cat = " / ".join([s for s in stack if s])
-            acc[mid] = cat
-        for v in obj.values():
-            _walk_buttons_to_map(v, stack, acc)
-        if text:
-            stack.pop()
-    elif isinstance(obj, list):
-        for v in obj:
-            _walk_buttons_to_map(v, stack, acc)
-
-def _build_msgid_to_category(json_path):
-    acc = {}
-    try:
-        with open(json_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        _walk_buttons_to_map(data, [], acc)
-    except Exception:
-        pass
-    return acc
-
-CATMAP_STORE = _build_msgid_to_category("menu_buttons.json")               # retail
-CATMAP_OPT   = _build_msgid_to_category("wholesale_menu_buttons.json")     # wholesale
-
-def _category_for(channel_id, message_id):
-    # Fallback to JSON maps if DB lookup fails; DB is source of truth
-    if channel_id == CHANNEL_ID_STORE:
-        return CATMAP_STORE.get(message_id)
-    if channel_id == CHANNEL_ID_OPT:
-        return CATMAP_OPT.get(message_id)
-    return None
-# Инициализация WATCH будет в main() после загрузки настроек из БД
-
-# ------------- parsing -------------
-PRICE_RE = re.compile(r"^\s*(?P<name>.+?)\s*[-:]\s*(?P<price>[\d\s]{2,})(?P<rest>.*)$")
-
-def _extract_flag(text):
-    """Попробовать извлечь флаг (emoji-флаг страны) из строки."""
-    try:
-        flag_match = re.search(r"[\U0001F1E6-\U0001F1FF]{2}", text)
-        return flag_match.group(0) if flag_match else ""
-    except Exception:
-        return ""
-
-def parse_lines(text):
-    items = []
-    for raw in (text or "").splitlines():
-        m = PRICE_RE.match(raw)
-        if not m:
-            continue
-        name = m.group("name").strip()
-        digits = re.sub(r"\D", "", m.group("price") or "")
-        rest = m.group("rest") or ""
-        
-        if not digits:
-            continue
-        try:
-            price = int(digits)
-        except Exception:
-            continue
-        if price <= 0:
-            continue
-        # защита от лишних нулей
-        if price > 2000000:
-            if price % 1000 == 0 and (price // 1000) <= 500000:
-                price //= 1000
-            elif price % 100 == 0 and (price // 100) <= 500000:
-                price //= 100
-        if price > 5000000:
-            log.warning("Skip unrealistic price %s for line: %r", price, raw)
-            continue
-        
-        # Ищем флаги в строке - может быть несколько
-        flags = []
-        # Ищем флаги в хвосте строки (после цены)
-        flag_matches = re.findall(r"[\U0001F1E6-\U0001F1FF]{2}", rest)
-        flags.extend(flag_matches)
-        # Ищем флаги в названии
-        flag_matches = re.findall(r"[\U0001F1E6-\U0001F1FF]{2}", name)
-        flags.extend(flag_matches)
-        
-        # Убираем флаги из названия для чистоты
-        clean_name = re.sub(r"[\U0001F1E6-\U0001F1FF]{2}\s*", "", name).strip()
-        
-        if flags:
-            # Создаем отдельную запись для каждого флага
-            for flag in flags:
-                items.append((clean_name, price, flag))
-        else:
-            # Если флагов нет, добавляем без флага
-            items.append((clean_name, price, ""))
-    return items
-
-def parse_used_attrs(name):
-    s = (name or "").lower()
-    attrs = {}
-    m = re.search(r"(\d+)\s*(?:год|года|лет|месяц|месяца|недел)", s)
-    if m:
-        attrs["usage_hint"] = m.group(0)
-    if "полный комплект" in s:
-        attrs["kit"] = "full"
-    if "без короб" in s:
-        attrs["kit"] = "no_box"
-    return attrs
-
-def norm_key(name, flag=""):
-    s = (name or "").lower()
-    s = re.sub(r"\s+", " ", s).strip()
-    # Добавляем флаг в ключ для уникальности
-    if flag:
-        s = f"{s}|{flag}"
-    return s
+# Склейка серий правок одного поста: пишем самый свежий текст после паузы,
+# но не позже чем через MAX_WAIT от первой правки. 0 — без склейки.
+EDIT_DEBOUNCE_SEC = float(os.getenv("EDIT_DEBOUNCE_SEC", "3") or "0")
+EDIT_DEBOUNCE_MAX_WAIT_SEC = float(os.getenv("EDIT_DEBOUNCE_MAX_WAIT_SEC", "15") or "0")
+
+# Очередь записи постов: хендлеры только ставят задачу, upsert делают воркеры
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4") or "4")
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "1000") or "1000")
+INGEST_METRICS_SEC = float(os.getenv("INGEST_METRICS_SEC", "60") or "0")
+
+# Сэмплы входящих постов в архив SAMPLES_DIR (для отладки разбора и бенчмарка парсера)
+SAMPLE_CAPTURE = os.getenv("SAMPLE_CAPTURE", "0").lower() in ("1", "true", "yes")
+
+# Мониторимые посты: снимок из monitored_posts, обновляется по LISTEN/NOTIFY и опросом (см. app_store.db.watch)
+WATCH = WatchRegistry([CHANNEL_ID_STORE, CHANNEL_ID_OPT])
 
 # ------------- upsert -------------
+# строки products: отправлено в upsert / реально переписано (no-op обновления отсекает IS DISTINCT FROM)
+_WRITES = {"sent": 0, "written": 0}
+
+# строки прайса разбирает app_store.parsing.price_parser.parse_rows — тот же разбор, что в ботах
 async def upsert_for_message(channel_id, message_id, title, text):
-    now = datetime.now(UTC).replace(tzinfo=None)
     price_field = "price_retail" if channel_id == CHANNEL_ID_STORE else ("price_wholesale" if channel_id == CHANNEL_ID_OPT else None)
     if price_field is None:
-        return
+        return None
 
-    # Б/У определяется списками USED_* из .env для каждого канала
-    is_used = (message_id in (USED_STORE if channel_id == CHANNEL_ID_STORE else USED_OPT))
-
-    # Получаем категорию из БД monitored_posts; если нет — пробуем из JSON карт
-    db_category = None
-    try:
-        async with Session() as s:
-            mp = (await s.execute(
-                select(MonitoredPost).where(
-                    and_(
-                        MonitoredPost.channel_id == channel_id,
-                        MonitoredPost.message_id == message_id
-                    )
-                )
-            )).scalar_one_or_none()
-            if mp:
-                db_category = mp.category
-    except Exception:
-        db_category = None
-
-    category = db_category if db_category is not None else _category_for(channel_id, message_id)
-
-    rows = parse_lines(text)
-    keys_in_post = set()
+    # категория и Б/У — из снимка monitored_posts (WATCH), без запроса к БД;
+    # категория — так же, как в /rescan ботов (app_store.categories)
+    meta = WATCH.meta(channel_id, message_id)
+    is_used = meta.is_used if meta else False
+    category = post_category(channel_id, message_id, meta.category if meta else None)
 
     async with Session() as s:
-        # upsert ChannelMessage
-        cm = (await s.execute(
-            select(ChannelMessage).where(
-                and_(
-                    ChannelMessage.channel_id == channel_id,
-                    ChannelMessage.message_id == message_id
-                )
-            )
-        )).scalar_one_or_none()
-        if not cm:
-            cm = ChannelMessage(
-                channel_id=channel_id,
-                message_id=message_id,
-                title=title or "",
-                text_len=len(text or ""),
-                edited_at=now
-            )
-            s.add(cm)
-        else:
-            cm.title = title or ""
-            cm.text_len = len(text or "")
-            cm.edited_at = now
-
-        # upsert products
-        for name, price, flag in rows:
-            key = norm_key(name, flag)
-            keys_in_post.add(key)
-
-            prod = (await s.execute(
-                select(Product).where(
-                    and_(
-                        Product.channel_id == channel_id,
-                        Product.group_message_id == message_id,
-                        Product.key == key,
-                        Product.is_used == is_used
-                    )
-                )
-            )).scalar_one_or_none()
-
-            if not prod:
-                prod = Product(
-                    channel_id=channel_id,
-                    group_message_id=message_id,
-                    name=name[:400],
-                    key=key,
-                    category=category,
-                    requires_serial=False,
-                    available=True,
-                    is_used=is_used,
-                    extra_attrs=(
-                        {
-                            **(parse_used_attrs(name) if is_used else {}),
-                            **({"flag": flag} if flag else {})
-                        } or None
-                    ),
-                    updated_at=now
-                )
-                setattr(prod, price_field, price)
-                s.add(prod)
-            else:
-                setattr(prod, price_field, price)
-                prod.name = name[:400]
-                prod.available = True
-                if category:
-                    prod.category = category
-                prod.is_used = is_used
-                # Обновляем/дополняем extra_attrs
-                try:
-                    cur = dict(prod.extra_attrs or {})
-                except Exception:
-                    cur = {}
-                if is_used:
-                    cur.update(parse_used_attrs(name))
-                if flag:
-                    cur["flag"] = flag
-                prod.extra_attrs = cur or None
-                prod.updated_at = now
-
-        # кого нет в посте — снимаем с наличия и чистим цену этого типа и этого is_used
-        if keys_in_post:
-            await s.execute(
-                update(Product)
-                .where(
-                    and_(
-                        Product.channel_id == channel_id,
-                        Product.group_message_id == message_id,
-                        Product.is_used == is_used,
-                        not_(Product.key.in_(keys_in_post))
-                    )
-                )
-                .values(
-                    available=False,
-                    **{price_field: None},
-                    updated_at=now
-                )
-            )
-
+        diff = await upsert_post_text(
+            s,
+            channel_id=channel_id,
+            message_id=message_id,
+            is_used=is_used,
+            text=text,
+            parse=lambda t: product_rows(parse_rows(t), is_used=is_used),
+            price_field=price_field,
+            category=category,
+            title=title or "",
+        )
         await s.commit()
 
+    if diff is None:
+        log.info("SKIP [%s] mid=%s: товары не изменились", channel_id, message_id)
+        return None
+    _WRITES["sent"] += diff.rows_sent
+    _WRITES["written"] += diff.rows_written
+    if diff.rows_written:
+        # витрины в этом же процессе (scripts/run_all.py) не ждут TTL кэша листания
+        catalog_cache.invalidate()
+    if diff:
+        log.info("DIFF [%s] mid=%s added=%s changed=%s restocked=%s removed=%s written=%s/%s (total %s/%s)",
+                 channel_id, message_id, len(diff.added), len(diff.changed), len(diff.restocked), len(diff.removed),
+                 diff.rows_written, diff.rows_sent, _WRITES["written"], _WRITES["sent"])
+    return diff
+
+# ------------- notifications -------------
+def _spawn_notify(diff):
+    """Рассылка подписчикам в фоне: апдейт канала не ждёт отправки сообщений."""
+    # подписки оформляются в оптовом боте — уведомляем только по оптовому каналу
+    if not diff or diff.channel_id != CHANNEL_ID_OPT:
+        return
+    spawn_notify(bot_opt, diff)
+
+# ------------- ingestion -------------
+async def _ingest(channel_id, message_id, title, text):
+    _spawn_notify(await upsert_for_message(channel_id, message_id, title, text))
+
+# один пост — всегда один воркер, правки пишутся в порядке поступления
+INGEST = KeyedWorkerPool(
+    _ingest,
+    workers=INGEST_WORKERS,
+    queue_size=INGEST_QUEUE_SIZE,
+    name="ingest",
+    metrics_interval=INGEST_METRICS_SEC,
+)
+
+async def _enqueue(channel_id, message_id, title, text):
+    await INGEST.submit((channel_id, message_id), channel_id, message_id, title, text)
+
+_EDITS = KeyedDebouncer(_enqueue, quiet=EDIT_DEBOUNCE_SEC, max_wait=EDIT_DEBOUNCE_MAX_WAIT_SEC)
+
 # ------------- handlers -------------
 @dp_opt.channel_post()
 async def _on_channel_post(msg: Message):
     if msg.chat.type != ChatType.CHANNEL:
         return
-    if msg.chat.id not in WATCH:
-        return
-    if msg.message_id not in WATCH[msg.chat.id]:
+    if not WATCH.is_watched(msg.chat.id, msg.message_id):
         return
     text = (msg.text or msg.caption or "").strip()
     log.info("NEW  [%s] mid=%s bytes=%s", msg.chat.title, msg.message_id, len(text))
-    await upsert_for_message(msg.chat.id, msg.message_id, msg.chat.title or "", text)
+    if SAMPLE_CAPTURE:
+        save_channel_sample(msg.chat.id, msg.message_id, msg.chat.title, text)
+    await _enqueue(msg.chat.id, msg.message_id, msg.chat.title or "", text)
 
 @dp_opt.edited_channel_post()
 async def _on_edited_channel_post(msg: Message):
     if msg.chat.type != ChatType.CHANNEL:
         return
-    if msg.chat.id not in WATCH:
-        return
-    if msg.message_id not in WATCH[msg.chat.id]:
+    if not WATCH.is_watched(msg.chat.id, msg.message_id):
         return
     text = (msg.text or msg.caption or "").strip()
     log.info("EDIT [%s] mid=%s bytes=%s", msg.chat.title, msg.message_id, len(text))
-    await upsert_for_message(msg.chat.id, msg.message_id, msg.chat.title or "", text)
+    if SAMPLE_CAPTURE:
+        save_channel_sample(msg.chat.id, msg.message_id, msg.chat.title, text)
+    if EDIT_DEBOUNCE_SEC <= 0:
+        await _enqueue(msg.chat.id, msg.message_id, msg.chat.title or "", text)
+        return
+    _EDITS.submit((msg.chat.id, msg.message_id), msg.chat.id, msg.message_id, msg.chat.title or "", text)
+
+# ------------- maintenance -------------
+async def _price_history_partitions_loop():
+    # секции журнала цен создаются на месяцы вперёд; процесс живёт долго — докатываем раз в сутки
+    while True:
+        await asyncio.sleep(24 * 3600)
+        try:
+            await ensure_price_history_partitions()
+        except Exception as e:
+            log.warning("price history partitions: %s", e)
 
 # ------------- entrypoint -------------
-async def main():
-    # Загружаем настройки мониторинга из БД
-    global WATCH
-    
-    MON_STORE = await get_monitored_message_ids("store")
-    MON_OPT = await get_monitored_message_ids("opt")
-    
-    if CHANNEL_ID_STORE and MON_STORE: 
-        WATCH[CHANNEL_ID_STORE] = MON_STORE
-    if CHANNEL_ID_OPT and MON_OPT:     
-        WATCH[CHANNEL_ID_OPT] = MON_OPT
-    
+async def start_monitor() -> bool:
+    """
+    Запустить монитор на диспетчере оптового бота (модели уже созданы init_models).
+    Остановка — shutdown-хендлерами dp_opt. False — нет каналов для мониторинга.
+    """
+    if not WATCH.channel_ids:
+        log.error("❌ Нет настроенных каналов для мониторинга. Проверьте CHANNEL_ID_STORE/CHANNEL_ID_OPT в .env.")
+        return False
+
+    # Загружаем настройки мониторинга из БД; дальше WATCH обновляется сам
+    await WATCH.start()
     if not WATCH:
-        log.error("❌ Нет настроенных каналов для мониторинга. Проверьте настройки в БД.")
+        log.warning("⚠️ Пока нет мониторимых постов — жду добавления через бота (WATCH обновится без перезапуска).")
+
+    # при остановке: отложенные правки -> очередь -> воркеры дописывают всё, что в очереди
+    INGEST.start()
+    maintenance = asyncio.create_task(_price_history_partitions_loop())
+
+    async def _stop_maintenance():
+        maintenance.cancel()
+
+    dp_opt.shutdown.register(_stop_maintenance)
+    dp_opt.shutdown.register(_EDITS.drain)
+    dp_opt.shutdown.register(INGEST.drain)
+    # воркеры дописали очередь — дождаться рассылок по их дифам
+    dp_opt.shutdown.register(drain_notifications)
+    dp_opt.shutdown.register(WATCH.stop)
+    dp_opt.shutdown.register(SAMPLES.drain)
+    return True
+
+async def main():
+    await init_models()
+    if not await start_monitor():
         return
-    
-    log.info("📡 Мониторинг каналов: %s", WATCH)
-    
-    # bot_opt уже создан в bot_wholesale.py с TG_TOKEN_OPT
-    await dp_opt.start_polling(
-        bot_opt,
-        allowed_updates=["message","callback_query","channel_post","edited_channel_post","my_chat_member"]
-    )
+
+    # bot_opt уже создан в bot_wholesale.py с TG_TOKEN_OPT; polling или webhook — по BOT_MODE.
+    # allowed_updates — по хендлерам dp_opt: посты канала сюда добавил монитор
+    await run_bot(dp_opt, bot_opt, name="wholesale")
 
 if __name__ == "__main__":
     asyncio.run(main())